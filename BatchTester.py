@@ -8,6 +8,7 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import re
 import sys
 import argparse
 import time
@@ -18,8 +19,13 @@ import platform
 import sqlite3
 import json
 import pickle
+import bisect
+import heapq
+import collections
+import zipfile
 
 import BuildGetter
+import BenchTester
 
 ##
 ##
@@ -52,6 +58,45 @@ def get_queued_job(dirname):
     return bcmd
   return False
 
+# Builds that fail are classified by what went wrong, from the phase that
+# failed and the error it gave:
+#   network - downloads, pushlog and other lookups failing or timing out
+#   crash   - the browser or test harness dying or disconnecting mid-test
+#   build   - a compile failing
+#   test    - the tests themselves failing
+#   unknown - anything else
+# Classes that are likely to go away by themselves are retried, with
+# exponential backoff, up to --retries times per build.
+gRetriedFailures = [ 'network', 'crash' ]
+# Longest wait before a retry
+gMaxRetryDelay = 6 * 60 * 60
+# Error patterns of each class, in the order they are tried
+gFailurePatterns = [
+  ('network', re.compile(r"URLError|HTTPError|socket|ftplib|error_temp|error_reply|EOFError|"
+                         r"timed out|Connection (reset|refused|closed)|Name or service|"
+                         r"Temporary failure|ReadError|truncated|CRC", re.I)),
+  ('crash', re.compile(r"crash|Segmentation|SIGSEGV|SIGABRT|signal|JSBridge|disconnect|"
+                       r"exited unexpectedly|exited without results|Broken pipe|killed", re.I))
+]
+
+# Returns the class of a failure in phase of build, given its error, which may
+# be None if the phase gave no more than its failure. Phases are 'prepare',
+# 'test', and 'task' for a test whose pool task died rather than returning.
+def classify_failure(phase, error, build=None):
+  if phase == 'task':
+    return 'crash'
+  if error:
+    for failure, pattern in gFailurePatterns:
+      if pattern.search(error):
+        return failure
+  if phase == 'prepare':
+    if build and isinstance(build.build, BuildGetter.CompileBuild):
+      return 'build'
+    # Downloaded builds only fail to prepare without an error when the
+    # download does
+    return 'network' if not error else 'unknown'
+  return 'test' if phase == 'test' else 'unknown'
+
 # Given a 'hook', which is a path to a python file,
 # imports it as a module and returns the handle. A bit hacky.
 def _get_hook(filename):
@@ -70,6 +115,101 @@ def _get_hook(filename):
     sys.path = sys.path[:-1]
   return ret
 
+# Given the sorted positions of the builds in a range and the positions already
+# covered by tested builds, returns the order to test the builds in so that the
+# largest untested gap is always filled next: the endpoints first, then
+# whichever build is nearest the middle of the widest gap between two tested
+# builds. Builds at an already covered position go last.
+def _coverage_order(coords, covered):
+  if not len(coords):
+    return []
+  covered = set(c for c in covered if coords[0] <= c <= coords[-1])
+  done = [ c in covered for c in coords ]
+  order = []
+  for x in (0, len(coords) - 1):
+    if not done[x]:
+      done[x] = True
+      order.append(x)
+
+  # Heap of (-width, low bound, high bound, first index, end index) for the
+  # untested builds strictly between two covered positions
+  gaps = []
+  def add_gap(lo, hi):
+    start = bisect.bisect_right(coords, lo)
+    end = bisect.bisect_left(coords, hi)
+    if start < end:
+      heapq.heappush(gaps, (lo - hi, lo, hi, start, end))
+
+  bounds = sorted(covered | set([ coords[0], coords[-1] ]))
+  for lo, hi in zip(bounds, bounds[1:]):
+    add_gap(lo, hi)
+
+  while len(gaps):
+    _, lo, hi, start, end = heapq.heappop(gaps)
+    middle = (lo + hi) / 2.0
+    x = bisect.bisect_left(coords, middle, start, end)
+    x = min([ y for y in (x - 1, x) if start <= y < end ], key=lambda y: abs(coords[y] - middle))
+    if not done[x]:
+      done[x] = True
+      order.append(x)
+    add_gap(lo, coords[x])
+    add_gap(coords[x], hi)
+
+  # Anything left is at a covered position, or shares its position with a
+  # build that was already picked
+  ordered = set(order)
+  order.extend(x for x in range(len(coords)) if x not in ordered)
+  return order
+
+# TestedIndex is an in-memory index of which tests have succeeded against which
+# revisions in the results database, so batches can skip already tested builds
+# without a query per build. It is refreshed incrementally from the highest
+# test id it has seen.
+class TestedIndex(object):
+  # Revisions are keyed by this many characters, so short and full revisions of
+  # the same commit match
+  keylen = 12
+
+  def __init__(self, path, required=None):
+    self.path = path
+    # Test names that must all have succeeded for a build to count as tested.
+    # If empty, any successful test counts
+    self.required = set(required) if required else set()
+    self.tests = {}
+    self.lastid = 0
+
+  # Loads any tests added since the last refresh. Returns the number loaded.
+  # If the database can't be read, e.g. because a writer has it locked for
+  # longer than timeout seconds, keeps what was already loaded, passing the
+  # error to log if given
+  def refresh(self, log=None, timeout=10):
+    try:
+      sqlite = BenchTester.open_results_db(self.path)
+      if not sqlite:
+        return 0
+      try:
+        # Not the long timeout writers use, this runs in the main loop
+        sqlite.execute("PRAGMA busy_timeout = %u" % (timeout * 1000,))
+        rows = BenchTester.get_tests_since(sqlite, self.lastid)
+      finally:
+        sqlite.close()
+    except sqlite3.Error, e:
+      if log:
+        log("Couldn't refresh the index of tested builds from %s, keeping it as of test %u: %s" % (self.path, self.lastid, e))
+      return 0
+    for testid, buildname, buildtime, testname in rows:
+      self.tests.setdefault(buildname[:self.keylen], set()).add(testname)
+      self.lastid = testid
+    return len(rows)
+
+  def is_tested(self, revision):
+    if not revision:
+      return False
+    tests = self.tests.get(revision[:self.keylen])
+    if not tests:
+      return False
+    return self.required.issubset(tests)
+
 # BatchBuild wraps BuildGetter.build with various info, and provides
 # a .(de)serialize for the status.json file output
 class BatchBuild():
@@ -99,6 +239,20 @@ class BatchBuild():
     # If true, retest the build even if its already queued. --hook scripts should
     # honor this in should_test as well
     self.force = None
+    # [ bisection uid, candidate index ] if this build was queued by a bisection
+    self.bisect = None
+    # Content hash of the prepared build, see BuildGetter.Build.get_content_hash
+    self.content_hash = None
+    # Number of repeat runs to schedule once this build has been tested, see
+    # BatchTest.schedule_repeats
+    self.repeats = None
+    # If this is a repeat run, the uid of the build it repeats
+    self.repeat_of = None
+    # Failed attempts at this build, as
+    # [ { 'phase', 'class', 'error', 'time' }, ... ], see classify_failure
+    self.attempts = []
+    # Timestamp the build is due to be retried at, while waiting to be
+    self.retry_at = None
 
   @staticmethod
   def deserialize(buildobj, args):
@@ -107,7 +261,8 @@ class BatchBuild():
         logfile = os.path.join(args.get('logdir'), "%s.build.log" % (buildobj['revision'],))
       else:
         logfile = None
-      build = BuildGetter.CompileBuild(args.get('repo'), args.get('mozconfig'), args.get('objdir'), pull=True, commit=buildobj['revision'], log=logfile)
+      build = BuildGetter.CompileBuild(args.get('repo'), args.get('mozconfig'), args.get('objdir'), pull=True, commit=buildobj['revision'], log=logfile,
+                                       cache=args.get('compiler_cache'), cachedir=args.get('compiler_cache_dir'), clobber=args.get('clobber', 'auto'))
     elif buildobj['type'] == 'tinderbox':
       build = BuildGetter.TinderboxBuild(buildobj['timestamp'], buildobj['branch'])
     elif buildobj['type'] == 'nightly':
@@ -125,6 +280,12 @@ class BatchBuild():
     ret.started = buildobj['started']
     ret.finished = buildobj['finished']
     ret.force = buildobj['force']
+    ret.bisect = buildobj.get('bisect')
+    ret.content_hash = buildobj.get('content_hash')
+    ret.repeats = buildobj.get('repeats')
+    ret.repeat_of = buildobj.get('repeat_of')
+    ret.attempts = list(buildobj.get('attempts') or [])
+    ret.retry_at = buildobj.get('retry_at')
 
     return ret
 
@@ -137,11 +298,18 @@ class BatchBuild():
       'finished' : self.finished,
       'force' : self.force,
       'uid' : self.uid,
-      'series': self.series
+      'series': self.series,
+      'bisect': self.bisect,
+      'content_hash': self.content_hash,
+      'repeats': self.repeats,
+      'repeat_of': self.repeat_of,
+      'attempts': self.attempts,
+      'retry_at': self.retry_at
     }
 
     if isinstance(self.build, BuildGetter.CompileBuild):
       ret['type'] = 'compile'
+      ret['cache_stats'] = self.build.get_cache_stats()
     elif isinstance(self.build, BuildGetter.FTPBuild):
       ret['type'] = 'ftp'
       ret['path'] = self.build._path
@@ -159,6 +327,300 @@ class BatchBuild():
       raise Exception("Unknown build type %s" % (build,))
     return ret
 
+# Bisection tracks a --mode bisect batch. Given the list of candidate builds in
+# a range (as --firstbuild values for the underlying mode), it tests the
+# endpoints, then repeatedly the midpoint of the remaining range, reading each
+# build's value for a datapoint back from the results database. A build is
+# regressed if its value differs from the first build's by at least threshold
+# (in the direction of threshold's sign). Builds that fail or have no data are
+# skipped over, as hg bisect --skip would.
+class Bisection(object):
+  def __init__(self, mode, candidates, batchargs):
+    self.uid = None
+    # Underlying build mode of the candidates
+    self.mode = mode
+    self.candidates = candidates
+    self.batchargs = batchargs
+    self.test = batchargs['bisect_test']
+    self.datapoint = batchargs['bisect_datapoint']
+    self.checkpoint = batchargs.get('bisect_checkpoint')
+    threshold = str(batchargs['bisect_threshold']).strip()
+    self.relative = threshold.endswith('%')
+    self.threshold = float(threshold[:-1]) / 100 if self.relative else float(threshold)
+    # candidate index -> value, or None if the build couldn't be tested
+    self.values = {}
+    # candidate index -> full revision, as builds are looked up
+    self.revisions = {}
+    # Candidate indexes currently queued for testing
+    self.outstanding = set()
+    self.baseline = None
+    self.lo = 0
+    self.hi = len(candidates) - 1
+    self.finished = None
+    self.note = None
+
+  # Gets the datapoint's value for a finished build from the results database.
+  # Returns the median of the matching rows, or None if there are none.
+  def lookup(self, sqlite, revision):
+    if not sqlite or not revision:
+      return None
+    rows = BenchTester.get_datapoint_values(sqlite, revision, self.test, self.datapoint)
+    if self.checkpoint:
+      rows = filter(lambda x: x[1] and x[1].startswith(self.checkpoint), rows)
+    values = sorted(x[0] for x in rows)
+    if not len(values):
+      return None
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+  def record(self, index, revision, value):
+    self.outstanding.discard(index)
+    self.values[index] = value
+    if revision:
+      self.revisions[index] = revision
+
+  def _regressed(self, value):
+    delta = value - self.baseline
+    if self.relative:
+      delta = float(delta) / self.baseline if self.baseline else 0
+    return delta >= self.threshold if self.threshold >= 0 else delta <= self.threshold
+
+  def _finish(self, note):
+    self.finished = time.time()
+    self.note = note
+    return []
+
+  def _describe(self, index):
+    return "%s (%s)" % (self.candidates[index], self.revisions.get(index, "unknown revision"))
+
+  # Advances the bisection as far as the known values allow. Returns the
+  # candidate indexes that need testing next, which may already be outstanding.
+  def step(self):
+    while not self.finished:
+      if self.lo >= self.hi:
+        return self._finish("Ran out of testable builds at the ends of the range")
+      if self.lo not in self.values or self.hi not in self.values:
+        return [ x for x in (self.lo, self.hi) if x not in self.values ]
+      if self.values[self.lo] is None:
+        self.lo += 1
+        continue
+      if self.values[self.hi] is None:
+        self.hi -= 1
+        continue
+      if self.baseline is None:
+        self.baseline = self.values[self.lo]
+        if not self._regressed(self.values[self.hi]):
+          return self._finish("No regression of %s across the range (%s -> %s)" % (self.datapoint, self.baseline, self.values[self.hi]))
+
+      # Pick the testable candidate nearest the middle of the remaining range
+      middle = (self.lo + self.hi) / 2.0
+      remaining = [ x for x in range(self.lo + 1, self.hi) if self.values.get(x, 0) is not None ]
+      if not len(remaining):
+        if self.hi - self.lo > 1:
+          return self._finish("Regression is in one of %u builds from %s to %s, the ones between could not be tested" % (self.hi - self.lo, self._describe(self.lo + 1), self._describe(self.hi)))
+        return self._finish("Regression introduced by %s" % (self._describe(self.hi),))
+      mid = min(remaining, key=lambda x: abs(x - middle))
+      if mid not in self.values:
+        self.note = "Bisecting, %u builds left" % (len(remaining),)
+        return [ mid ]
+      if self._regressed(self.values[mid]):
+        self.hi = mid
+      else:
+        self.lo = mid
+    return []
+
+  def serialize(self):
+    return {
+      'uid': self.uid,
+      'mode': self.mode,
+      'test': self.test,
+      'datapoint': self.datapoint,
+      'candidates': len(self.candidates),
+      'tested': len(self.values),
+      'range': [ self.candidates[self.lo], self.candidates[self.hi] ] if self.lo < len(self.candidates) and self.hi >= 0 else None,
+      'finished': self.finished,
+      'note': self.note,
+      # What deserialize needs to carry on after the tester is restarted
+      'state': { 'candidates': self.candidates,
+                 'batchargs': self.batchargs,
+                 'values': self.values.items(),
+                 'revisions': self.revisions.items(),
+                 'baseline': self.baseline,
+                 'lo': self.lo,
+                 'hi': self.hi }
+    }
+
+  # Candidates that were outstanding aren't restored, it's up to the caller to
+  # find which of their builds survived the restart
+  @staticmethod
+  def deserialize(obj):
+    state = obj['state']
+    ret = Bisection(obj['mode'], state['candidates'], state['batchargs'])
+    ret.uid = obj['uid']
+    ret.values = dict(state['values'])
+    ret.revisions = dict(state['revisions'])
+    ret.baseline = state['baseline']
+    ret.lo = state['lo']
+    ret.hi = state['hi']
+    ret.finished = obj['finished']
+    ret.note = obj['note']
+    return ret
+
+# Autotuner picks the number of tests to run at once for --autotune, between
+# its bounds, by hill climbing on throughput. Each window of tests finished at
+# one setting is scored by tests per hour. A better score than the last
+# window's keeps the climb going in the same direction, a worse one goes back
+# to the best setting seen (or turns around, if this is it), and a similar one
+# settles on the lower of the two settings. Windows
+# where the host was overloaded, or where the reference datapoint (if any)
+# varied too much between runs of the same build, step down and hold
+# regardless, as running more tests at once than that adds noise to the
+# measurements. Only builds tested more than once (--repeats) tell noise apart
+# from real differences between builds, so without them noise isn't judged.
+# After holding for a while it probes upwards again, in case conditions have
+# changed.
+class Autotuner(object):
+  # Throughput changes within this fraction count as no change
+  tolerance = 0.05
+  # Decisions kept for the status file
+  history = 20
+  # Windows to hold at a setting before probing again
+  explore = 10
+  # Builds whose last reference value is kept, to pair with later runs
+  remembered = 100
+
+  def __init__(self, lo, hi, window, max_load, max_noise, reference=None):
+    self.lo = lo
+    self.hi = hi
+    self.slots = lo
+    self.window = window
+    self.max_load = max_load
+    self.max_noise = max_noise
+    # [ test name, datapoint ] to judge noise by, or None
+    self.reference = reference
+    self.direction = 1
+    self.held = 0
+    self.last = None
+    # (slots, tests per hour) of the best window that wasn't too noisy
+    self.best = None
+    self.decisions = []
+    # { build key: last reference value }, oldest first
+    self.previous = collections.OrderedDict()
+    self._start()
+
+  def _start(self):
+    self.window_start = time.time()
+    self.finished = 0
+    # [ (value, previous value of the same build) ]
+    self.pairs = []
+
+  # Records a test finished at the current setting, and its reference value
+  # if it has one. Runs with the same key are of the same build.
+  def record(self, key=None, value=None):
+    self.finished += 1
+    if key is None or value is None:
+      return
+    if key in self.previous:
+      self.pairs.append((value, self.previous.pop(key)))
+    self.previous[key] = value
+    while len(self.previous) > self.remembered:
+      self.previous.popitem(last=False)
+
+  # Host load average per CPU, or None where there is no load average
+  @staticmethod
+  def load():
+    try:
+      return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (AttributeError, OSError, NotImplementedError):
+      return None
+
+  # Coefficient of variation of the reference value between runs of the same
+  # build, pooled over the window's pairs of runs, or None if it had none
+  def noise(self):
+    cvs = []
+    for a, b in self.pairs:
+      mean = (a + b) / 2.0
+      if mean:
+        # The standard deviation of a pair is |a - b| / sqrt(2)
+        cvs.append((a - b) ** 2 / 2.0 / mean ** 2)
+    if not len(cvs):
+      return None
+    return (sum(cvs) / len(cvs)) ** 0.5
+
+  # Once a window of tests has finished, decides the number of slots for the
+  # next. Returns a message describing the decision, or None if the window
+  # isn't over.
+  def step(self):
+    if self.finished < max(self.window, self.slots):
+      return None
+    rate = self.finished * 3600.0 / max(time.time() - self.window_start, 1)
+    load = self.load()
+    noise = self.noise()
+    slots = target = self.slots
+    if load is not None and load > self.max_load:
+      reason = "host overloaded"
+      target = slots - 1
+      self.direction = 0
+    elif noise is not None and noise > self.max_noise:
+      reason = "reference datapoint too noisy"
+      target = slots - 1
+      self.direction = 0
+    else:
+      if not self.best or rate > self.best[1]:
+        self.best = (slots, rate)
+      if not self.last:
+        reason = "first measurement"
+      elif self.last[0] == slots:
+        self.held += 1
+        reason = "holding"
+        if self.held >= self.explore:
+          reason = "probing"
+          self.held = 0
+          self.direction = 1
+      elif rate > self.last[1] * (1 + self.tolerance):
+        reason = "throughput improved"
+      elif rate < self.last[1] * (1 - self.tolerance):
+        reason = "throughput dropped"
+        if self.best[0] != slots:
+          # Past the peak: go back to the best setting seen and hold there
+          # until the next probe, rather than reversing back and forth
+          # across it
+          reason += ", settling at the best setting"
+          target = self.best[0]
+          self.direction = 0
+        else:
+          self.direction = -self.direction
+      else:
+        # The same throughput from fewer tests at once is less noisy
+        reason = "throughput unchanged"
+        target = min(slots, self.last[0])
+        self.direction = 0
+      if not self.last:
+        self.direction = 1
+    self.last = (slots, rate)
+    self.slots = min(self.hi, max(self.lo, target + self.direction))
+    if self.slots == slots:
+      # Held, or hit a bound
+      self.direction = 0
+    else:
+      self.held = 0
+    self.decisions.append({ 'time': time.time(), 'slots': slots, 'tests_per_hour': rate, 'load': load,
+                            'noise': noise, 'reason': reason, 'next': self.slots })
+    self.decisions = self.decisions[-self.history:]
+    self._start()
+    return "%u slots: %.01f tests/hour, load %s, noise %s -- %s, %s %u slots" % (
+           slots, rate, "%.02f" % load if load is not None else "unknown",
+           "%.03f" % noise if noise is not None else "unknown", reason,
+           "staying at" if self.slots == slots else "moving to", self.slots)
+
+  def serialize(self):
+    return {
+      'slots': self.slots,
+      'bounds': [ self.lo, self.hi ],
+      'best': { 'slots': self.best[0], 'tests_per_hour': self.best[1] } if self.best else None,
+      'decisions': self.decisions
+    }
+
 # Work around multiprocessing.Pool() quirkiness. We can't give it
 # BatchTest.test_build directly because that might not point to the same thing
 # in the child process (members are mutable). we also can't give it build
@@ -166,7 +628,9 @@ class BatchBuild():
 # (but just forcing it to pickle explicitly is fine as it would be pickled
 # eventually either way)
 def _pool_batchtest_build(build, args):
-  return BatchTest.test_build(pickle.loads(build), args)
+  build = pickle.loads(build)
+  ret = BatchTest.test_build(build, args)
+  return (ret, BatchTest.reference_value(build, args) if ret is True else None)
 
 ##
 ## BatchTest - a threaded test object. Given a list of builds, prepares them
@@ -187,17 +651,43 @@ class BatchTest(object):
     self.pool = None
     self.processed = 0
     self.tick = 0
+    # Tests started, and how many of those were repeats, for --repeat-budget
+    self.started = 0
+    self.started_repeats = 0
+    # Totals of sweep_extraction_root
+    self.extraction_gc = { 'last': None, 'removed': 0, 'reclaimed': 0 }
     self.builds = {
       'building' : None,
       'prepared': [],
       'running': [],
       'pending': [],
+      # Repeat runs waiting for their share of --repeat-budget
+      'repeats': [],
+      # Failed builds waiting to be retried
+      'retrying': [],
       'skipped': [],
       'completed': [],
       'failed': []
     }
     self.processedbatches = []
     self.pendingbatches = []
+    self.bisections = []
+    self.autotuner = None
+    if self.args.get('autotune'):
+      lo, hi = [ int(x) for x in self.args['autotune'].split(':') ]
+      if not 1 <= lo <= hi:
+        raise Exception("--autotune takes MIN:MAX slots, with 1 <= MIN <= MAX")
+      reference = self.args.get('autotune_datapoint')
+      self.autotuner = Autotuner(lo, hi, self.args.get('autotune_window') or 6,
+                                 self.args.get('autotune_max_load') or 1.0,
+                                 self.args.get('autotune_max_noise') or 0.02,
+                                 reference.split(':', 1) if reference else None)
+    required = self.args.get('required_tests')
+    self.required = required.split(',') if required else None
+    if self.args.get('results_db') and (self.args.get('skip_tested') or self.required):
+      self.tested = TestedIndex(self.args.get('results_db'), self.required)
+    else:
+      self.tested = None
 
     if (self.args.get('hook')):
       sys.path.append(os.path.abspath(os.path.dirname(self.args.get('hook'))))
@@ -209,7 +699,7 @@ class BatchTest(object):
     self.builder_mode = None
     self.builder_batch = None
     self.manager = multiprocessing.Manager()
-    self.builder_result = self.manager.dict({ 'result': 'not started', 'ret' : None })
+    self.builder_result = self.manager.dict({ 'result': 'not started', 'ret' : None, 'error': None })
 
   def stat(self, msg=""):
     msg = "%s :: %s\n" % (time.ctime(), msg)
@@ -226,7 +716,20 @@ class BatchTest(object):
       self.pool.close()
       self.pool.join()
     self.buildindex = 0
-    self.pool = multiprocessing.Pool(processes=self.args['processes'], maxtasksperchild=1)
+    self.pool = multiprocessing.Pool(processes=self.autotuner.hi if self.autotuner else self.args['processes'],
+                                     maxtasksperchild=1)
+
+  # Number of tests to run at once
+  def slots(self):
+    return self.autotuner.slots if self.autotuner else self.args['processes']
+
+  # Feeds a finished test, and its reference value if the test pool looked one
+  # up, to the autotuner, and applies its decision if it has one
+  def autotune(self, build, value=None):
+    self.autotuner.record(build.repeat_of if build.repeat_of is not None else build.uid, value)
+    decision = self.autotuner.step()
+    if decision:
+      self.stat("Autotune: %s" % (decision,))
 
   #
   # Writes/updates the status file
@@ -237,7 +740,12 @@ class BatchTest(object):
               'starttime' : self.starttime,
               'building': self.builds['building'].serialize() if self.builds['building'] else None,
               'batches' : self.processedbatches,
-              'pendingbatches' : self.pendingbatches
+              'pendingbatches' : self.pendingbatches,
+              'bisections' : map(lambda x: x.serialize(), self.bisections),
+              'started' : self.started,
+              'started_repeats' : self.started_repeats,
+              'autotune' : self.autotuner.serialize() if self.autotuner else None,
+              'extraction_gc' : self.extraction_gc
             }
     for x in self.builds:
       if type(self.builds[x]) == list:
@@ -274,13 +782,27 @@ class BatchTest(object):
 
       # Finished a batch queue job
       if self.builder_mode == 'batch':
-        if self.builder_result['result'] == 'success':
-          queued = self.queue_builds(self.builder_result['ret'][0], prepend=self.builder_batch['args'].get('prioritize'))
-          already_queued = len(self.builder_result['ret'][0]) - len(queued)
-          self.queue_builds(self.builder_result['ret'][1], target='skipped', prepend=self.builder_batch['args'].get('prioritize'))
-          self.builder_batch['note'] = "Queued %u builds, skipped %u" % (len(queued), already_queued + len(self.builder_result['ret'][1]))
+        if self.builder_result['result'] == 'success' and isinstance(self.builder_result['ret'], Bisection):
+          bisection = self.builder_result['ret']
+          bisection.uid = self.builder_batch['uid']
+          self.bisections.append(bisection)
+          self.builder_batch['note'] = "Bisecting %u builds" % (len(bisection.candidates),)
+          self.advance_bisection(bisection)
+        elif self.builder_result['result'] == 'success':
+          readybuilds, skippedbuilds, alreadytested = self.builder_result['ret']
+          for build in skippedbuilds:
+            if build.bisect:
+              self.bisection_build_finished(build)
+          queued = self.queue_builds(readybuilds, prepend=self.builder_batch['args'].get('prioritize'))
+          already_queued = len(readybuilds) - len(queued)
+          self.queue_builds(skippedbuilds, target='skipped', prepend=self.builder_batch['args'].get('prioritize'))
+          self.builder_batch['note'] = "Queued %u builds, skipped %u" % (len(queued), already_queued + len(skippedbuilds) + len(alreadytested))
+          if len(alreadytested):
+            self.builder_batch['note'] += " (%u already tested, not looked up)" % (len(alreadytested),)
         else:
           self.builder_batch['note'] = self.builder_result['ret']
+          if self.builder_batch['args'].get('bisect'):
+            self.bisection_build_finished(None, self.builder_batch['args']['bisect'])
         self.stat("Batch completed: %s (%s)" % (self.builder_batch['args'], self.builder_batch['note']))
         self.builder_batch = None
 
@@ -290,13 +812,23 @@ class BatchTest(object):
         self.stat("Test %u prepared" % (build.num,))
         self.builds['building'] = None
         if self.builder_result['result'] == 'success':
-          self.builds['prepared'].append(self.builder_result['ret'])
+          build = self.builder_result['ret']
+          if self.args.get('dedup') and self.reuse_identical_results(build):
+            build.finished = time.time()
+            build.build.cleanup()
+            self.builds['completed'].append(build)
+            if build.bisect:
+              self.bisection_build_finished(build)
+          else:
+            self.builds['prepared'].append(build)
         else:
-          build.note = "Build setup failed - see log"
-          build.finished = time.time()
-          self.builds['failed'].append(build)
+          error = self.builder_result['error']
+          self.stat("!! Test %u setup failed :: %s" % (build.num, error))
+          if not self.build_failed(build, 'prepare', error) and build.bisect:
+            self.bisection_build_finished(build)
       self.builder_result['result'] = 'uninitialied'
       self.builder_result['ret'] = None
+      self.builder_result['error'] = None
       self.builder_mode = None
 
     # Should it run?
@@ -307,30 +839,260 @@ class BatchTest(object):
       self.builder_batch['processed'] = time.time()
       self.processedbatches.append(self.builder_batch)
       self.builder_batch['note'] = "Processing - Looking up builds"
-      self.builder = multiprocessing.Process(target=self._process_batch, args=(self.args, self.builder_batch['args'], self.builder_result, self.hook))
+      if self.tested:
+        self.tested.refresh(self.stat)
+      self.builder = multiprocessing.Process(target=self._process_batch, args=(self.args, self.builder_batch['args'], self.builder_result, self.hook, self.tested))
       self.builder.start()
     elif not self.builder and self.builds['building']:
       self.builder_mode = 'build'
       self.stat("Starting build for %s :: %s" % (self.builds['building'].num, self.builds['building'].serialize()))
-      self.builder = multiprocessing.Process(target=self.prepare_build, args=(self.builds['building'], self.builder_result))
+      self.builder = multiprocessing.Process(target=self.prepare_build, args=(self.builds['building'], self.builder_result,
+                                                                                 self.args.get('dedup')))
       self.builder.start()
 
+  # Prepares a build in the builder process. Only --dedup needs its content
+  # hash, which means reading the whole build
   @staticmethod
-  def prepare_build(build, result):
-    if build.build.prepare():
+  def prepare_build(build, result, dedup=False):
+    try:
+      prepared = build.build.prepare()
+    except Exception, e:
+      prepared = False
+      result['error'] = "%s :: %s" % (type(e), e)
+    if prepared:
+      if dedup:
+        try:
+          build.content_hash = build.build.get_content_hash()
+        except (IOError, OSError, zipfile.BadZipfile) as e:
+          BuildGetter._stat("WARN: Failed to hash build: %s" % (e,))
       result['result'] = 'success'
     else:
       result['result'] = 'failed'
 
     result['ret'] = build
 
+  # If a byte-identical build has already been tested, copies its results to
+  # this build rather than testing it again. Returns True if results were copied
+  def reuse_identical_results(self, build):
+    if not build.content_hash or build.force:
+      return False
+    sqlite = BenchTester.open_results_db(self.args.get('results_db'))
+    if not sqlite:
+      return False
+    try:
+      identical = BenchTester.find_identical_build(sqlite, build.revision, build.content_hash, self.required)
+      if not identical:
+        return False
+      copied = BenchTester.copy_build_results(sqlite, identical[0], build.revision,
+                                              build.build.get_buildtime(), build.content_hash)
+    finally:
+      sqlite.close()
+    build.note = "Identical to already tested build %s, copied results of %s" % (identical[1], ', '.join(copied))
+    self.stat("Test %u: %s" % (build.num, build.note))
+    if self.tested:
+      self.tested.refresh(self.stat)
+    return True
+
+  # Remembers the content hash of a successfully tested build, so later
+  # identical builds can reuse its results with --dedup
+  def record_content_hash(self, build):
+    if not self.args.get('dedup') or not build.content_hash:
+      return
+    sqlite = BenchTester.open_results_db(self.args.get('results_db'))
+    if not sqlite:
+      return
+    try:
+      if not BenchTester.record_build_hash(sqlite, build.revision, build.content_hash):
+        self.stat("Test %u: build %s not found in results database, not recording its hash" % (build.num, build.revision))
+    finally:
+      sqlite.close()
+
+  # Queues batches for whatever builds a bisection needs tested next
+  def advance_bisection(self, bisection):
+    for index in bisection.step():
+      if index in bisection.outstanding:
+        continue
+      bisection.outstanding.add(index)
+      args = dict(bisection.batchargs)
+      args.update({ 'mode': bisection.mode,
+                    'firstbuild': bisection.candidates[index],
+                    'lastbuild': None,
+                    'prioritize': True,
+                    'bisect': [ bisection.uid, index ] })
+      self.add_batch(args)
+    if bisection.finished:
+      self.stat("Bisection %u finished: %s" % (bisection.uid, bisection.note))
+
+  # Restores the unfinished bisections of a resumed status file, after its
+  # builds have been recovered. Batch uids start over on a restart, so they get
+  # new uids and the recovered builds they were waiting on are retagged. Builds
+  # they were waiting on that weren't recovered, because their batch was still
+  # being looked up, are queued again. Returns the number resumed.
+  def resume_bisections(self, objs):
+    resumed = {}
+    for obj in objs:
+      if not obj.get('state'):
+        self.stat("Abandoning bisection %s, the status file predates bisections being resumable" % (obj.get('uid'),))
+        continue
+      bisection = Bisection.deserialize(obj)
+      bisection.uid = self.processed
+      self.processed += 1
+      resumed[obj['uid']] = bisection
+    for build in self.builds['running'] + self.builds['prepared'] + self.builds['pending'] + \
+                 self.builds['repeats'] + self.builds['retrying'] + [ self.builds['building'] ]:
+      if not build or not build.bisect:
+        continue
+      uid, index = build.bisect
+      if uid in resumed:
+        build.bisect = [ resumed[uid].uid, index ]
+        resumed[uid].outstanding.add(index)
+      else:
+        # Don't feed it to a new bisection that happens to get the same uid
+        build.bisect = None
+    for uid, bisection in sorted(resumed.iteritems()):
+      self.bisections.append(bisection)
+      self.stat("Resuming bisection %u as %u: %s" % (uid, bisection.uid, bisection.note))
+      self.advance_bisection(bisection)
+    return len(resumed)
+
+  # Feeds the result of a build queued by a bisection back to it. build may be
+  # None if the batch looking it up failed, in which case tag identifies it.
+  def bisection_build_finished(self, build, tag=None):
+    uid, index = tag if tag else build.bisect
+    for bisection in self.bisections:
+      if bisection.uid == uid and not bisection.finished:
+        break
+    else:
+      return
+    revision = build.revision if build else None
+    sqlite = BenchTester.open_results_db(self.args.get('results_db'))
+    try:
+      value = bisection.lookup(sqlite, revision)
+    finally:
+      if sqlite: sqlite.close()
+    self.stat("Bisection %u: build %s has %s = %s" % (uid, bisection.candidates[index], bisection.datapoint, value))
+    bisection.record(index, revision, value)
+    self.advance_bisection(bisection)
+
+  ##
+  ## Repeats
+  ##
+
+  # Builds with --repeats set are run that many more times once tested, so
+  # run-to-run noise can be told apart from a regression. Repeats are separate
+  # tests in the results database, summarized by
+  # BenchTester.update_build_variance. They are only queued once the build's
+  # first run has finished, and then only while repeats are within
+  # --repeat-budget of the tests started (or nothing else is waiting), so
+  # they are spread out between other builds' tests rather than run back to
+  # back, and land on different test slots.
+
+  # Adds the repeat runs of a successfully tested build to the repeats list
+  def schedule_repeats(self, build):
+    if not build.repeats or build.repeat_of is not None:
+      return
+    for x in range(build.repeats):
+      repeat = BatchBuild.deserialize(build.serialize(), self.args)
+      repeat.started = repeat.finished = None
+      repeat.force = True
+      repeat.bisect = None
+      repeat.repeats = None
+      repeat.repeat_of = build.uid
+      repeat.note = "Repeat %u of %u of test %u" % (x + 1, build.repeats, build.num)
+      self.queue_builds([ repeat ], target='repeats')
+    self.stat("Test %u: scheduled %u repeats" % (build.num, build.repeats))
+
+  # Moves a repeat to the front of the pending queue if the budget allows it
+  def release_repeats(self):
+    if not len(self.builds['repeats']):
+      return
+    waiting = self.builds['pending'] + self.builds['prepared'] + [ self.builds['building'] ]
+    if any(x and x.repeat_of is not None for x in waiting):
+      # One at a time, so the budget is judged against tests actually started
+      return
+    idle = not len(self.builds['pending']) and not len(self.pendingbatches) and not self.builder
+    budget = self.args.get('repeat_budget')
+    if budget is None:
+      budget = 0.25
+    if idle or self.started_repeats + 1 <= budget * (self.started + 1):
+      repeat = self.builds['repeats'].pop(0)
+      self.builds['pending'].insert(0, repeat)
+
+  # Updates the variance summary of a build whose repeat has finished
+  def update_variance(self, build):
+    sqlite = BenchTester.open_results_db(self.args.get('results_db'))
+    if not sqlite:
+      return
+    try:
+      rows = BenchTester.update_build_variance(sqlite, build.revision)
+    finally:
+      sqlite.close()
+    if rows is None:
+      self.stat("Test %u: build %s not found in results database, not updating its variance" % (build.num, build.revision))
+    else:
+      self.stat("Test %u: updated variance of build %s (%u datapoints)" % (build.num, build.revision, rows))
+
+  ##
+  ## Retries
+  ##
+
+  # Records a failed attempt at a build, queuing a new attempt at it to be
+  # retried if its failure is of a retried class and it has retries left.
+  # Otherwise moves it to failed. Returns True if it will be retried.
+  def build_failed(self, build, phase, error):
+    failure = classify_failure(phase, error, build)
+    build.attempts.append({ 'phase': phase, 'class': failure, 'error': error, 'time': time.time() })
+    build.finished = time.time()
+    retries = len(build.attempts) - 1
+    if failure in gRetriedFailures and retries < (self.args.get('retries') or 0):
+      delay = min((self.args.get('retry_backoff') or 300) * 2 ** retries, gMaxRetryDelay)
+      # A new build object, as the failed one may be half prepared
+      retry = BatchBuild.deserialize(build.serialize(), self.args)
+      retry.started = retry.finished = None
+      retry.retry_at = time.time() + delay
+      retry.note = "Retrying in %us after a %s failure in %s (attempt %u of %u)" % (
+                   delay, failure, phase, len(build.attempts) + 1, self.args.get('retries') + 1)
+      self.builds['retrying'].append(retry)
+      self.stat("Test %u: %s" % (build.num, retry.note))
+      return True
+    if phase == 'prepare':
+      build.note = "Build setup failed (%s) - see log" % (failure,)
+    else:
+      build.note = "Failed (%s): %s" % (failure, error)
+    if retries:
+      build.note += ", after %u retries" % (retries,)
+    self.builds['failed'].append(build)
+    return False
+
+  # Moves builds that are due to be retried to the front of the queue
+  def release_retries(self):
+    now = time.time()
+    for build in [ x for x in self.builds['retrying'] if x.retry_at <= now ]:
+      self.builds['retrying'].remove(build)
+      build.retry_at = None
+      self.builds['pending'].insert(0, build)
+
+  # Removes build extraction directories left behind by testers (or their
+  # workers) that are gone
+  def sweep_extractions(self):
+    try:
+      removed, reclaimed = BuildGetter.sweep_extraction_root()
+    except (IOError, OSError) as e:
+      self.stat("!! Failed to sweep extraction directories :: %s" % (e,))
+      return
+    self.extraction_gc['last'] = time.time()
+    self.extraction_gc['removed'] += removed
+    self.extraction_gc['reclaimed'] += reclaimed
+    if removed:
+      self.stat("Removed %u orphaned extraction directories, reclaiming %.1fMiB" % (removed, reclaimed / 1048576.0))
+
   # Add builds to self.builds[target], giving them a uid. Redirect builds from
   # pending -> skipped if they're already queued
   def queue_builds(self, builds, target='pending', prepend=False):
     skip = []
     ready = []
     for x in builds:
-      if not x.force and target == 'pending' and self.build_is_queued(x):
+      if not x.force and not x.bisect and target == 'pending' and self.build_is_queued(x):
         x.finished = time.time()
         skip.append(x)
         x.note = "A build with this revision is already in queue"
@@ -360,6 +1122,10 @@ class BatchTest(object):
 
     self.stat("Starting at %s with args \"%s\"" % (time.ctime(), sys.argv))
 
+    # Builds are extracted by children on our behalf, and are ours to clean up
+    BuildGetter.set_extraction_root(self.args.get('extraction_dir'))
+    self.sweep_extractions()
+
     self.reset_pool()
 
     batchmode = self.args.get('batch')
@@ -373,8 +1139,15 @@ class BatchTest(object):
         recover_builds.extend(ostat['prepared'])
         if ostat['building']: recover_builds.append(ostat['building'])
         recover_builds.extend(ostat['pending'])
-
-        if len(recover_builds):
+        # Repeats keep waiting for the --repeat-budget, which carries over, and
+        # builds waiting to be retried keep waiting out their backoff
+        recover_repeats = ostat.get('repeats', [])
+        recover_retries = ostat.get('retrying', [])
+        self.started = ostat.get('started', 0)
+        self.started_repeats = ostat.get('started_repeats', 0)
+        recover_bisections = [ x for x in ostat.get('bisections', []) if not x.get('finished') ]
+
+        if len(recover_builds) or len(recover_repeats) or len(recover_retries) or len(recover_bisections):
           # Create a dummy batch, process it on main thread, move it to completed.
           # this all happens before the helper thread starts so there are no other
           # batches to contend with
@@ -384,7 +1157,13 @@ class BatchTest(object):
           resumebatch['processed'] = time.time()
           self.write_status()
           self.queue_builds(map(lambda x: BatchBuild.deserialize(x, self.args), recover_builds))
-          resumebatch['note'] = "Recovered %u builds (%u skipped)" % (len(self.builds['pending']), len(self.builds['skipped']))
+          self.queue_builds(map(lambda x: BatchBuild.deserialize(x, self.args), recover_repeats), target='repeats')
+          self.queue_builds(map(lambda x: BatchBuild.deserialize(x, self.args), recover_retries), target='retrying')
+          resumebatch['note'] = "Recovered %u builds, %u repeats and %u waiting to be retried (%u skipped)" % (
+                                len(self.builds['pending']), len(self.builds['repeats']), len(self.builds['retrying']),
+                                len(self.builds['skipped']))
+          if len(recover_bisections):
+            resumebatch['note'] += ", resumed %u of %u bisections" % (self.resume_bisections(recover_bisections), len(recover_bisections))
     else:
       self.add_batch(self.args)
 
@@ -393,17 +1172,38 @@ class BatchTest(object):
       for build in self.builds['running']:
         if not build.task.ready(): continue
 
-        taskresult = build.task.get() if build.task.successful() else False
+        phase = 'test'
+        refvalue = None
+        if build.task.successful():
+          taskresult, refvalue = build.task.get()
+        else:
+          phase = 'task'
+          try:
+            build.task.get()
+          except BaseException, e:
+            taskresult = "Test task died :: %s :: %s" % (type(e), e)
+          else:
+            taskresult = "Test task died"
+        retrying = False
         if taskresult is True:
           self.stat("Test %u finished" % (build.num,))
           self.builds['completed'].append(build)
+          self.record_content_hash(build)
+          if self.tested:
+            self.tested.refresh(self.stat)
+          self.schedule_repeats(build)
+          if build.repeat_of is not None:
+            self.update_variance(build)
         else:
           self.stat("!! Test %u failed :: %s" % (build.num, taskresult))
-          build.note = "Failed: %s" % (taskresult,)
-          self.builds['failed'].append(build)
+          retrying = self.build_failed(build, phase, taskresult or None)
         build.finished = time.time()
         self.builds['running'].remove(build)
         build.build.cleanup()
+        if self.autotuner:
+          self.autotune(build, refvalue)
+        if build.bisect and not retrying:
+          self.bisection_build_finished(build)
 
       # Check on builder
       self.check_builder()
@@ -422,12 +1222,15 @@ class BatchTest(object):
         else:
           break
 
+      self.release_retries()
+      self.release_repeats()
+
       # Prepare pending builds, but not more than processes, as prepared builds
       # takeup space (hundreds of queued builds would fill /tmp with gigabytes
       # of things)
       if len(self.builds['pending']) \
           and not self.builds['building'] \
-          and len(self.builds['prepared']) < self.args['processes']:
+          and len(self.builds['prepared']) < self.slots():
         build = self.builds['pending'][0]
         self.builds['building'] = build
         self.builds['pending'].remove(build)
@@ -435,17 +1238,20 @@ class BatchTest(object):
         self.buildindex += 1
 
       # Start builds if pool is not filled
-      while len(self.builds['prepared']) and len(self.builds['running']) < self.args['processes']:
+      while len(self.builds['prepared']) and len(self.builds['running']) < self.slots():
         build = self.builds['prepared'][0]
         self.builds['prepared'].remove(build)
         build.started = time.time()
+        self.started += 1
+        if build.repeat_of is not None:
+          self.started_repeats += 1
         self.stat("Moving test %u to running" % (build.num,))
         build.task = self.pool.apply_async(_pool_batchtest_build, [pickle.dumps(build), self.args])
         self.builds['running'].append(build)
 
       self.write_status()
 
-      in_progress = len(self.builds['pending']) + len(self.builds['prepared']) + len(self.builds['running'])
+      in_progress = len(self.builds['pending']) + len(self.builds['prepared']) + len(self.builds['running']) + len(self.builds['repeats']) + len(self.builds['retrying'])
       if not self.builder and not self.builds['building'] and in_progress == 0:
         # Out of things to do
         if batchmode and self.buildindex > 0:
@@ -466,6 +1272,7 @@ class BatchTest(object):
         self.builds['failed'] = filter(lambda x: (x.finished + 60 * 60 * 24 * 3) > time.time(), self.builds['failed'])
         self.builds['skipped'] = filter(lambda x: (x.finished + 60 * 60 * 24) > time.time(), self.builds['skipped'])
         self.processedbatches = filter(lambda x: (x['processed'] + 60 * 60 * 24) > time.time(), self.processedbatches)
+        self.sweep_extractions()
       time.sleep(1)
 
     self.stat("No more tasks, exiting")
@@ -476,13 +1283,13 @@ class BatchTest(object):
   # Threaded call the builder is started on. Calls _process_batch_inner and
   # handles return results
   @staticmethod
-  def _process_batch(globalargs, batchargs, returnproxy, hook):
+  def _process_batch(globalargs, batchargs, returnproxy, hook, tested=None):
     try:
       if hook:
         mod = _get_hook(globalargs.get('hook'))
       else:
         mod = None
-      ret = BatchTest._process_batch_inner(globalargs, batchargs, mod)
+      ret = BatchTest._process_batch_inner(globalargs, batchargs, mod, tested)
     except Exception, e:
       ret = "An exception occured while processing batch -- %s: %s" % (type(e), e)
 
@@ -495,25 +1302,36 @@ class BatchTest(object):
   #
   # Inner call for _process_batch
   @staticmethod
-  def _process_batch_inner(globalargs, batchargs, hook):
+  def _process_batch_inner(globalargs, batchargs, hook, tested=None):
     if not batchargs['firstbuild']:
       raise Exception("--firstbuild is required")
 
+    force = batchargs.get('force') if batchargs.get('force') else globalargs.get('force')
+    # Builds a bisection asked for need to go through the skipped list so it
+    # hears about them, so only skip ahead of lookups for everything else
+    skipahead = tested if not force and not batchargs.get('bisect') else None
+    alreadytested = []
+
     if not globalargs.get('no_pull'):
       # Do a tip lookup to pull the repo so get_full_revision is up to date
       BuildGetter.get_hg_range(globalargs.get('repo'), '.', '.', True)
 
     mode = batchargs['mode']
     dorange = 'lastbuild' in batchargs and batchargs['lastbuild']
+    backfill = dorange and (batchargs.get('backfill') or globalargs.get('backfill'))
     builds = []
     # Queue builds
-    if mode == 'nightly':
+    if mode == 'bisect':
+      return BatchTest._bisect_candidates(globalargs, batchargs)
+    elif mode == 'nightly':
       startdate = parse_nightly_time(batchargs['firstbuild'])
       if dorange:
         enddate = parse_nightly_time(batchargs['lastbuild'])
         dates = range(startdate.toordinal(), enddate.toordinal() + 1)
       else:
         dates = [ startdate.toordinal() ]
+      if backfill:
+        dates = BatchTest._backfill_order(mode, dates, globalargs)
       for x in dates:
         builds.append(BuildGetter.NightlyBuild(datetime.date.fromordinal(x)))
     elif mode == 'tinderbox':
@@ -521,6 +1339,8 @@ class BatchTest(object):
       if dorange:
         enddate = float(batchargs['lastbuild'])
         tinderbuilds = BuildGetter.list_tinderbox_builds(startdate, enddate)
+        if backfill:
+          tinderbuilds = BatchTest._backfill_order(mode, tinderbuilds, globalargs)
         for x in tinderbuilds:
           builds.append(BuildGetter.TinderboxBuild(x))
       else:
@@ -531,34 +1351,47 @@ class BatchTest(object):
       repo = batchargs.get('repo') if batchargs.get('repo') else globalargs.get('repo')
       objdir = batchargs.get('objdir') if batchargs.get('objdir') else globalargs.get('objdir')
       mozconfig = batchargs.get('mozconfig') if batchargs.get('mozconfig') else globalargs.get('mozconfig')
+      cache = batchargs.get('compiler_cache') if batchargs.get('compiler_cache') else globalargs.get('compiler_cache')
+      cachedir = batchargs.get('compiler_cache_dir') if batchargs.get('compiler_cache_dir') else globalargs.get('compiler_cache_dir')
+      clobber = batchargs.get('clobber') if batchargs.get('clobber') else globalargs.get('clobber', 'auto')
       if not repo or not mozconfig or not objdir:
         raise Exception("Build mode requires --repo, --mozconfig, and --objdir to be set")
       if dorange:
         lastbuild = batchargs['lastbuild']
       else:
         lastbuild = batchargs['firstbuild']
-      for commit in BuildGetter.get_hg_range(repo, batchargs['firstbuild'], lastbuild, not globalargs.get("no_pull")):
+      commits = BuildGetter.get_hg_range(repo, batchargs['firstbuild'], lastbuild, not globalargs.get("no_pull"))
+      if backfill:
+        commits = BatchTest._backfill_order(mode, commits, globalargs)
+      for commit in commits:
+        if skipahead and skipahead.is_tested(commit):
+          alreadytested.append(commit)
+          continue
         if globalargs.get('logdir'):
           logfile = os.path.join(globalargs.get('logdir'), "%s.build.log" % (commit,))
         else:
           logfile = None
-        builds.append(BuildGetter.CompileBuild(repo, mozconfig, objdir, pull=False, commit=commit, log=logfile))
+        builds.append(BuildGetter.CompileBuild(repo, mozconfig, objdir, pull=False, commit=commit, log=logfile,
+                                               cache=cache, cachedir=cachedir, clobber=clobber))
     else:
       raise Exception("Unknown mode %s" % mode)
 
     readybuilds = []
     skippedbuilds = []
-    force = batchargs.get('force') if batchargs.get('force') else globalargs.get('force')
     for build in builds:
       rev = build.get_revision()
 
       build = BatchBuild(build, rev)
       build.force = force
       build.series = batchargs.get('series')
+      build.bisect = batchargs.get('bisect')
+      build.repeats = batchargs.get('repeats') if batchargs.get('repeats') is not None else globalargs.get('repeats')
       if not build.build.get_valid():
         # Can happen with FTP builds we failed to lookup on ftp.m.o, or any
         # builds that arn't found in pushlog
         build.note = "Build is not found or missing from pushlog"
+      elif tested and not force and tested.is_tested(rev):
+        build.note = "Build already tested"
       elif hook and not hook.should_test(build, globalargs):
         if not build.note:
           build.note = "Build skipped by tester";
@@ -569,7 +1402,67 @@ class BatchTest(object):
       build.finished = time.time()
       skippedbuilds.append(build)
 
-    return [ readybuilds, skippedbuilds ]
+    return [ readybuilds, skippedbuilds, alreadytested ]
+
+  #
+  # Reorders the builds of a --backfill range (nightly date ordinals, tinderbox
+  # timestamps or compile revisions, in chronological order) so the gaps in
+  # what --results-db already has tested are filled in progressively
+  @staticmethod
+  def _backfill_order(mode, keys, globalargs):
+    tested = []
+    sqlite = BenchTester.open_results_db(globalargs.get('results_db'))
+    if sqlite:
+      try:
+        tested = BenchTester.get_tested_builds(sqlite)
+      finally:
+        sqlite.close()
+
+    if mode == 'nightly':
+      # A nightly is built from the pushes before roughly 11:00 UTC on its date
+      coords = keys
+      covered = [ datetime.datetime.utcfromtimestamp(x[1] + 13 * 60 * 60).date().toordinal() for x in tested ]
+    elif mode == 'tinderbox':
+      coords = keys
+      covered = [ x[1] for x in tested ]
+    else:
+      # Revisions have no usable position but their place in the range
+      coords = range(len(keys))
+      names = [ x[0] for x in tested ]
+      covered = [ i for i, rev in enumerate(keys)
+                  if any(rev.startswith(x) or x.startswith(rev) for x in names) ]
+
+    return [ keys[x] for x in _coverage_order(coords, covered) ]
+
+  #
+  # Lists the builds a --mode bisect batch will choose from, without looking
+  # any of them up, and returns a Bisection for them
+  @staticmethod
+  def _bisect_candidates(globalargs, batchargs):
+    for arg in ('lastbuild', 'bisect_test', 'bisect_datapoint', 'bisect_threshold'):
+      if not batchargs.get(arg):
+        raise Exception("Bisect mode requires --%s" % (arg.replace('_', '-'),))
+    if not globalargs.get('results_db'):
+      raise Exception("Bisect mode requires --results-db")
+
+    mode = batchargs.get('bisect_type') or 'tinderbox'
+    if mode == 'nightly':
+      startdate = parse_nightly_time(batchargs['firstbuild'])
+      enddate = parse_nightly_time(batchargs['lastbuild'])
+      candidates = [ datetime.date.fromordinal(x).isoformat()
+                     for x in range(startdate.toordinal(), enddate.toordinal() + 1) ]
+    elif mode == 'tinderbox':
+      candidates = [ str(x) for x in BuildGetter.list_tinderbox_builds(float(batchargs['firstbuild']), float(batchargs['lastbuild'])) ]
+    elif mode == 'compile':
+      repo = batchargs.get('repo') if batchargs.get('repo') else globalargs.get('repo')
+      candidates = BuildGetter.get_hg_range(repo, batchargs['firstbuild'], batchargs['lastbuild'], not globalargs.get("no_pull"))
+    else:
+      raise Exception("Cannot bisect builds of type %s" % (mode,))
+
+    if not candidates or len(candidates) < 2:
+      raise Exception("Bisect range must contain at least two builds")
+
+    return Bisection(mode, candidates, batchargs)
 
   #
   # Build testing pool
@@ -581,31 +1474,81 @@ class BatchTest(object):
     if not globalargs.get('hook'):
       return "Cannot test builds without a --hook providing run_tests(Build)"
 
+    # The hook's exception is usually generic, the testers it ran recorded
+    # why they failed
+    del BenchTester.gProcessErrors[:]
     try:
       mod = _get_hook(globalargs.get('hook'))
       mod.run_tests(build, globalargs)
     except (Exception, KeyboardInterrupt) as e:
       err = "%s :: %s" % (type(e), e)
+      if len(BenchTester.gProcessErrors):
+        err += " :: Tester errors: %s" % (' | '.join(BenchTester.gProcessErrors[-10:]),)
       ret = err
     return ret
 
+  # Run by the test pool after a build's test succeeds: the median of the
+  # --autotune-datapoint from it, or None. Only builds tested more than once
+  # have a value looked up, as only those are paired up to judge noise by.
+  @staticmethod
+  def reference_value(build, globalargs):
+    if not globalargs.get('autotune') or not globalargs.get('autotune_datapoint') or not globalargs.get('results_db'):
+      return None
+    if not build.repeats and build.repeat_of is None:
+      return None
+    reference = globalargs.get('autotune_datapoint').split(':', 1)
+    try:
+      sqlite = BenchTester.open_results_db(globalargs.get('results_db'))
+      if not sqlite:
+        return None
+      try:
+        values = sorted(x[0] for x in BenchTester.get_datapoint_values(sqlite, build.revision, *reference))
+      finally:
+        sqlite.close()
+    except sqlite3.Error:
+      return None
+    return values[len(values) // 2] if len(values) else None
+
 class BatchTestCLI(BatchTest):
   def __init__(self, args=sys.argv[1:]):
     self.parser = argparse.ArgumentParser(description='Run tests against one or more builds in parallel')
-    self.parser.add_argument('--mode', help='nightly or tinderbox or compile')
+    self.parser.add_argument('--mode', help='nightly or tinderbox or compile, or bisect to search --firstbuild..--lastbuild for the build that regressed a datapoint')
     self.parser.add_argument('--batch', help='Batch mode -- given a folder name, treat each file within as containing a set of arguments to this script, deleting each file as it is processed.')
     self.parser.add_argument('--firstbuild', help='For nightly, the date (YYYY-MM-DD) of the first build to test. For tinderbox, the timestamp to start testing builds at. For build, the first revision to build.')
     self.parser.add_argument('--lastbuild', help='[optional] For nightly builds, the last date to test. For tinderbox, the timestamp to stop testing builds at. For build, the last revision to build If omitted, first_build is the only build tested.')
     self.parser.add_argument('-p', '--processes', help='Number of tests to run in parallel.', default=1, type=int)
+    self.parser.add_argument('--autotune', metavar='MIN:MAX', help='Rather than a fixed --processes, adjust the number of tests run at once between MIN and MAX, by the throughput, host load and noise measured at each setting. Decisions are logged and kept in the status file')
+    self.parser.add_argument('--autotune-window', type=int, default=6, help='With --autotune, tests to finish at a setting before judging it (at least one per slot)')
+    self.parser.add_argument('--autotune-max-load', type=float, default=1.0, help='With --autotune, the load average per CPU above which to run fewer tests at once')
+    self.parser.add_argument('--autotune-datapoint', metavar='TEST:DATAPOINT', help='With --autotune and --results-db, a datapoint whose coefficient of variation between runs of the same build (see --repeats) at a setting judges how noisy it is')
+    self.parser.add_argument('--autotune-max-noise', type=float, default=0.02, help='With --autotune-datapoint, the coefficient of variation above which to run fewer tests at once')
     self.parser.add_argument('--hook', help='Name of a python file to import for each test. The test will call should_test(BatchBuild), run_tests(BatchBuild), and cli_hook(argparser) in this file.')
     self.parser.add_argument('--logdir', '-l', help="Directory to log progress to. Doesn't make sense for batched processes. Creates 'tester.log', 'buildname.test.log' and 'buildname.build.log' (for compile builds).")
     self.parser.add_argument('--repo', help="For build mode, the checked out FF repo to use")
     self.parser.add_argument('--mozconfig', help="For build mode, the mozconfig to use")
     self.parser.add_argument('--objdir', help="For build mode, the objdir provided mozconfig will create")
+    self.parser.add_argument('--compiler-cache', choices=sorted(BuildGetter.gCompilerCaches.keys()), help="For build mode, wrap the compilers with this compiler cache")
+    self.parser.add_argument('--compiler-cache-dir', help="For build mode, the directory the compiler cache should keep its cache in. Defaults to the cache's own default")
+    self.parser.add_argument('--clobber', choices=[ 'auto', 'always', 'never' ], default='auto', help="For build mode, when to start from a fresh object directory. 'auto' (the default) clobbers when the tree's CLOBBER file requires it, or to retry a failed incremental build")
     self.parser.add_argument('--no-pull', action='store_true', help="For build mode, don't run a hg pull in the repo before messing with a commit")
+    self.parser.add_argument('--extraction-dir', help="Directory to extract downloaded builds into. Directories left there by testers that have since exited are removed at startup and periodically. Defaults to BuildGetter in the system temporary directory")
     self.parser.add_argument('--status-file', help="A file to keep a json-dump of the currently running job status in. This file is mv'd into place to avoid read/write issues")
     self.parser.add_argument('--status-resume', action='store_true', help="Resume any jobs still present in the status file. Useful for interrupted sessions")
     self.parser.add_argument('--prioritize', action='store_true', help="For batch'd builds, insert at the beginning of the pending queue rather than the end")
+    self.parser.add_argument('--backfill', action='store_true', help="Rather than queuing a range's builds in chronological order, queue them so the largest untested gaps (according to --results-db, if given) are filled first, giving a progressively finer picture of the range")
+    self.parser.add_argument('--results-db', help="The sqlite database the hook's tests log results to. Builds are looked up in it by revision. Required for bisect mode")
+    self.parser.add_argument('--dedup', action='store_true', help="With --results-db, don't test builds that are byte-identical to an already tested build but for their build ID and source stamp, copy that build's results to them instead (recording where they came from)")
+    self.parser.add_argument('--skip-tested', action='store_true', help="With --results-db, don't test builds that already have successful results in it, unless forced. See --required-tests")
+    self.parser.add_argument('--required-tests', help="With --results-db, a comma separated list of test names a build must have successfully run to count as already tested, implying --skip-tested. Also limits which identical builds --dedup copies results from. By default any successful test counts")
+    self.parser.add_argument('--bisect-type', choices=[ 'nightly', 'tinderbox', 'compile' ], default='tinderbox', help="For bisect mode, the kind of build to bisect across")
+    self.parser.add_argument('--bisect-test', help="For bisect mode, the name of the test whose results to check")
+    self.parser.add_argument('--bisect-datapoint', help="For bisect mode, the datapoint to check")
+    self.parser.add_argument('--bisect-checkpoint', help="For bisect mode, only consider values of the datapoint whose checkpoint (meta) starts with this")
+    self.parser.add_argument('--bisect-threshold', help="For bisect mode, how far the datapoint must move from its value in the first build for a build to count as regressed. Either absolute, or relative with a %% suffix. Negative values look for decreases")
+    self.parser.add_argument('--repeats', type=int, help="Test each build this many more times once it has been tested, storing each run as a separate test, and summarize the spread of the runs per build in --results-db. May be given per batch to only repeat selected builds")
+    self.parser.add_argument('--repeat-budget', type=float, default=0.25, help="The fraction of tests started that may be repeats while other builds are waiting to be tested. Repeats run regardless when there is nothing else to do")
+    self.parser.add_argument('--retries', type=int, default=2, help="Times to retry a build that failed in a way that is likely transient, such as a download failing or the browser crashing. Build and test failures are not retried")
+    self.parser.add_argument('--retry-backoff', type=int, default=300, help="Seconds to wait before the first retry of a build, doubling for each retry after")
     self.parser.add_argument('--force', action='store_true', help="Test/queue given builds even if they have already been tested or are already in queue")
     temp = vars(self.parser.parse_known_args(args)[0])
     if temp.get('hook'):
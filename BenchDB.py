@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012 Mozilla Corporation
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Maintenance commands for BenchTester results databases. Run with --help for
+# the list of commands.
+
+import sys
+import argparse
+import time
+import sqlite3
+
+import BenchTester
+
+output = sys.stdout
+
+def _stat(msg):
+  output.write("[BenchDB] %s\n" % msg)
+
+def _open(path):
+  sqlite = BenchTester.open_results_db(path)
+  if not sqlite:
+    raise Exception("No database at %s" % (path,))
+  return sqlite
+
+# VACUUMs a database through a connection of its own, as the shard views of
+# an open results database would get in its way. If incremental is set,
+# switches the database to incremental auto_vacuum, doing nothing if it
+# already is. Returns whether it was vacuumed.
+def _vacuum(path, incremental=False):
+  sqlite = sqlite3.connect(path, timeout=900)
+  try:
+    if incremental:
+      if sqlite.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+      sqlite.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    begin = time.time()
+    sqlite.execute("VACUUM")
+    _stat("Vacuumed %s in %.02fs" % (path, time.time() - begin))
+  finally:
+    sqlite.close()
+  return True
+
+##
+## Commands
+##
+
+def migrate(args):
+  sqlite = _open(args.sqlitedb)
+  version = BenchTester.get_schema_version(sqlite)
+  _stat("Database is at schema version %u, latest is %u" % (version, BenchTester.gMigrations[-1][0]))
+  applied = BenchTester.migrate(sqlite, args.target, _stat)
+  if not len(applied) and args.analyze:
+    BenchTester.analyze(sqlite, _stat)
+  for path in BenchTester.get_shard_files(sqlite):
+    _stat("Migrating shard %s" % (path,))
+    shard = sqlite3.connect(path, timeout=900)
+    applied = BenchTester.migrate(shard, args.target, _stat)
+    if not len(applied) and args.analyze:
+      BenchTester.analyze(shard, _stat)
+    shard.close()
+
+def shard(args):
+  sqlite = _open(args.sqlitedb)
+  begin = time.time()
+  def progress(done, total):
+    if done % 1000 == 0 or done == total:
+      _stat("Moved %u/%u tests" % (done, total))
+  count = BenchTester.shard_database(sqlite, args.months, progress)
+  _stat("Moved the results of %u tests into %u shards in %.02fs" % (
+        count, len(BenchTester.get_shard_files(sqlite)), time.time() - begin))
+  if args.vacuum:
+    _vacuum(args.sqlitedb)
+
+def compact(args):
+  sqlite = _open(args.sqlitedb)
+  if args.enable_incremental_vacuum:
+    for path in [ args.sqlitedb ] + BenchTester.get_shard_files(sqlite):
+      if _vacuum(path, True):
+        _stat("Converted %s to incremental vacuum" % (path,))
+  if args.keep_builds is None and args.keep_days is None:
+    sys.exit("One of --keep-builds or --keep-days is required")
+  cutoff = BenchTester.compaction_cutoff(sqlite, args.keep_builds, args.keep_days)
+  if cutoff is None:
+    _stat("No builds old enough to compact")
+    return
+  _stat("Compacting tests of builds before %s" % (time.ctime(cutoff),))
+  begin = time.time()
+  def progress(done, total):
+    if done % 1000 == 0 or done == total:
+      _stat("Compacted %u/%u tests" % (done, total))
+  tests, rows = BenchTester.compact_results(sqlite, cutoff, args.keep, progress)
+  _stat("Removed %u rows of raw data from %u tests in %.02fs" % (rows, tests, time.time() - begin))
+
+def merge_spool(args):
+  sqlite = _open(args.sqlitedb)
+  begin = time.time()
+  merged, bad = BenchTester.merge_spool(sqlite, args.spooldir, args.batch, _stat)
+  _stat("Merged %u spooled tests in %.02fs%s" % (merged, time.time() - begin,
+        ", skipped %u unreadable files" % (bad,) if bad else ""))
+
+def rebuild_aggregates(args):
+  sqlite = _open(args.sqlitedb)
+  begin = time.time()
+  def progress(done, total):
+    if done % 100 == 0 or done == total:
+      _stat("Aggregated %u/%u tests" % (done, total))
+  count = BenchTester.rebuild_aggregates(sqlite, args.all, progress)
+  _stat("Rebuilt aggregates of %u tests in %.02fs" % (count, time.time() - begin))
+
+def diff(args):
+  sqlite = _open(args.sqlitedb)
+  begin = time.time()
+  rows = BenchTester.diff_builds(sqlite, args.testname, args.a.split(','), args.b.split(','), args.sort)
+  _stat("Compared %u datapoints in %.03fs" % (len(rows), time.time() - begin))
+  for datapoint, checkpoint, a, b, delta, relative in rows[:args.limit]:
+    output.write("%14s %14s %14s %8s  %s  %s\n" % (
+      "%.0f" % a if a is not None else "-",
+      "%.0f" % b if b is not None else "-",
+      "%+.0f" % delta if delta is not None else "-",
+      "%+.1f%%" % (relative * 100) if relative is not None else "-",
+      checkpoint, datapoint))
+
+#
+# Main
+#
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Maintenance commands for BenchTester results databases')
+  commands = parser.add_subparsers()
+
+  cmd = commands.add_parser('migrate', help='Bring a database up to the latest schema version')
+  cmd.add_argument('sqlitedb', help='The results database')
+  cmd.add_argument('--target', type=int, help='Only migrate up to this schema version')
+  cmd.add_argument('--analyze', action='store_true', help='Refresh the query planner statistics even if no migrations are needed')
+  cmd.set_defaults(command=migrate)
+
+  cmd = commands.add_parser('shard', help='Split a database by build time, moving test results into one file per period. The database is kept as the manifest, and later results are written to the shards')
+  cmd.add_argument('sqlitedb', help='The results database')
+  cmd.add_argument('--months', type=int, default=3, help='Months of builds per shard, e.g. 3 for quarterly shards. A connection can only attach 10 shards at once')
+  cmd.add_argument('--vacuum', action='store_true', help='VACUUM the manifest afterwards to return the space the moved results took')
+  cmd.set_defaults(command=shard)
+
+  cmd = commands.add_parser('compact', help='Remove the raw data of tests of older builds, keeping their aggregates')
+  cmd.add_argument('sqlitedb', help='The results database')
+  cmd.add_argument('--keep-builds', type=int, help='Keep the raw data of this many of the latest tested builds')
+  cmd.add_argument('--keep-days', type=float, help='Keep the raw data of builds from this many days back')
+  cmd.add_argument('--keep', action='append', metavar='PATTERN', help='Keep the raw data of datapoints matching this SQL LIKE pattern for every build. May be given more than once')
+  cmd.add_argument('--enable-incremental-vacuum', action='store_true', help='First switch databases not using incremental auto_vacuum over to it, with a one-off VACUUM, so compaction returns space as it goes')
+  cmd.set_defaults(command=compact)
+
+  cmd = commands.add_parser('merge-spool', help='Load results spooled by testers run with --spool into a database')
+  cmd.add_argument('sqlitedb', help='The results database')
+  cmd.add_argument('spooldir', help='The spool directory. Files are removed as they are merged')
+  cmd.add_argument('--batch', type=int, default=50, help='Spooled tests to load per transaction')
+  cmd.set_defaults(command=merge_spool)
+
+  cmd = commands.add_parser('rebuild-aggregates', help='Compute the per-checkpoint aggregates of tests from their raw datapoints')
+  cmd.add_argument('sqlitedb', help='The results database')
+  cmd.add_argument('--all', action='store_true', help='Recompute every test, not just those without aggregates')
+  cmd.set_defaults(command=rebuild_aggregates)
+
+  cmd = commands.add_parser('diff', help='Compare the results of a test between two builds, or two sets of builds')
+  cmd.add_argument('sqlitedb', help='The results database')
+  cmd.add_argument('testname', help='The test to compare')
+  cmd.add_argument('a', help='The build (or comma separated builds) to compare from')
+  cmd.add_argument('b', help='The build (or comma separated builds) to compare to')
+  cmd.add_argument('--sort', choices=[ 'absolute', 'relative' ], default='absolute', help='Order by the largest absolute or relative change')
+  cmd.add_argument('--limit', type=int, default=50, help='Number of datapoints to list')
+  cmd.set_defaults(command=diff)
+
+  args = parser.parse_args()
+  args.command(args)
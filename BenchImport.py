@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012 Mozilla Corporation
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Imports results files that never went through a BenchTester run into a
+# results database. Two kinds of file, optionally gzipped, are understood:
+# - Endurance results, { "iterations": [ { "checkpoints": [ ... ] } ] }, as the
+#   endurance test sends them to EnduranceTest, flattened the same way
+# - about:memory reports, { "version": 1, "reports": [ ... ] }, stored under
+#   a single checkpoint
+# Either may also have "buildname", "buildtime", "testname" and "time" keys,
+# which override the ones given on the command line.
+#
+# Files are parsed and flattened by a pool of processes. Their rows are
+# streamed back as each file is done, and inserted by this process a batch of
+# files to a transaction.
+
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import argparse
+import sqlite3
+import multiprocessing
+
+import BenchTester
+import EnduranceTest
+
+output = sys.stdout
+
+# Prefixes given to about:memory report values by their units, matching the
+# ones endurance results use. Bytes have none.
+gReportUnits = { 0: "", 1: "cnt:", 2: "cnt:", 3: "pct:" }
+
+def _stat(msg):
+  output.write("[BenchImport] %s\n" % msg)
+
+# Flattens an about:memory report into datapoints as add_test_results takes
+# them, all with the given checkpoint as meta. Reports of the main process keep
+# their paths, other processes' are prefixed with the process name. Duplicate
+# paths are summed, as about:memory does.
+def flatten_memory_report(report, checkpoint):
+  values = {}
+  for entry in report['reports']:
+    process = re.sub(r" \(pid \d+\)$", "", entry.get('process') or "")
+    name = "%s%s" % (gReportUnits.get(entry.get('units', 0), ""), entry['path'])
+    if process and not process.startswith("Main Process"):
+      name = "%s/%s" % (process, name)
+    values[name] = values.get(name, 0) + entry['amount']
+  return [ [ name, value, checkpoint ] for name, value in values.iteritems() ]
+
+# Reads and flattens one file. Returns (info, datapoints), where info has any
+# of buildname, buildtime, testname and time the file itself gives.
+def parse_file(path, checkpoint):
+  f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+  try:
+    obj = json.load(f)
+  finally:
+    f.close()
+  if 'reports' in obj:
+    datapoints = flatten_memory_report(obj, checkpoint)
+  elif 'iterations' in obj:
+    datapoints = EnduranceTest.flatten_endurance_results(obj)
+  else:
+    raise Exception("Not endurance results or a memory report")
+  info = dict((key, obj[key]) for key in [ 'buildname', 'buildtime', 'testname', 'time' ] if key in obj)
+  return (info, datapoints)
+
+# Pool worker, returning (path, info, datapoints, error)
+def _parse_worker(job):
+  path, checkpoint = job
+  try:
+    info, datapoints = parse_file(path, checkpoint)
+    return (path, info, datapoints, None)
+  except Exception, e:
+    return (path, None, None, "%s: %s" % (type(e).__name__, e))
+
+def _insert_batch(sqlite, runs):
+  # Shards can only be attached outside of a transaction
+  schemas = BenchTester.get_results_schemas(sqlite, [ run['buildtime'] for run in runs ])
+  cur = sqlite.cursor()
+  try:
+    for run, schema in zip(runs, schemas):
+      build_id = BenchTester._get_build_id(cur, run['buildname'], run['buildtime'], _stat)
+      BenchTester.insert_test_results(cur, build_id, run['testname'], run['time'],
+                                      run['datapoints'], True, schema)
+    sqlite.commit()
+  except:
+    sqlite.rollback()
+    raise
+
+# Imports files into the database. defaults gives the buildname, buildtime and
+# testname of files that don't have their own, and the checkpoint to file
+# memory reports under. Returns (files imported, files failed, rows imported).
+def import_files(sqlite, paths, defaults, jobs=None, batch=20):
+  BenchTester.migrate(sqlite)
+  pool = multiprocessing.Pool(jobs)
+  imported = failed = rows = 0
+  pending = []
+  try:
+    work = [ (path, defaults.get('checkpoint')) for path in paths ]
+    for path, info, datapoints, error in pool.imap_unordered(_parse_worker, work):
+      run = dict(defaults)
+      if not error:
+        run.update(info)
+        missing = [ key for key in [ 'buildname', 'buildtime', 'testname' ] if not run.get(key) ]
+        if missing:
+          error = "No %s given" % (', '.join(missing),)
+        elif not len(datapoints):
+          error = "No datapoints"
+      if error:
+        _stat("Failed to import %s: %s" % (path, error))
+        failed += 1
+        continue
+      run['datapoints'] = datapoints
+      if not run.get('time'):
+        run['time'] = os.path.getmtime(path)
+      pending.append(run)
+      rows += len(datapoints)
+      if len(pending) >= batch:
+        _insert_batch(sqlite, pending)
+        imported += len(pending)
+        pending = []
+        _stat("Imported %u/%u files, %u rows" % (imported, len(paths), rows))
+    if len(pending):
+      _insert_batch(sqlite, pending)
+      imported += len(pending)
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.close()
+    pool.join()
+  return (imported, failed, rows)
+
+#
+# Main
+#
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Import endurance results and about:memory report JSON files into a results database')
+  parser.add_argument('sqlitedb', help='The results database, created if it does not exist')
+  parser.add_argument('files', nargs='+', help='Files to import, optionally gzipped')
+  parser.add_argument('--buildname', help='Build name for files that do not give one')
+  parser.add_argument('--buildtime', type=int, help='Build time (unix timestamp) for files that do not give one')
+  parser.add_argument('--testname', help='Test name for files that do not give one')
+  parser.add_argument('--checkpoint', default='Report', help='Checkpoint to record about:memory reports under')
+  parser.add_argument('--jobs', '-j', type=int, help='Processes to parse files with. Defaults to the number of CPUs')
+  parser.add_argument('--batch', type=int, default=20, help='Files to insert per transaction')
+  args = parser.parse_args()
+
+  sqlite = sqlite3.connect(os.path.abspath(args.sqlitedb), timeout=900)
+  begin = time.time()
+  imported, failed, rows = import_files(sqlite, args.files,
+                                        { 'buildname': args.buildname,
+                                          'buildtime': args.buildtime,
+                                          'testname': args.testname,
+                                          'checkpoint': args.checkpoint },
+                                        args.jobs, args.batch)
+  _stat("Imported %u rows from %u files in %.02fs%s" % (rows, imported, time.time() - begin,
+        ", %u files failed" % (failed,) if failed else ""))
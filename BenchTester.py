@@ -12,8 +12,14 @@ import os
 import argparse
 import sqlite3
 import subprocess
-import mercurial, mercurial.ui, mercurial.hg, mercurial.commands
+import datetime
+import calendar
 import time
+import math
+import json
+import gzip
+import tempfile
+import multiprocessing
 
 gTableSchemas = [
   # Builds - info on builds we have tests for
@@ -47,6 +53,1027 @@ gTableSchemas = [
   '''CREATE INDEX IF NOT EXISTS data_for_test ON benchtester_data ( test_id DESC, datapoint_id )'''
 ];
 
+# Changes to the schema since gTableSchemas, as ( version, description,
+# [ statements ] ). migrate() applies the ones a database doesn't have yet, in
+# order, committing after each statement so that a large database is only ever
+# locked for one step at a time. Statements must be safe to re-run, in case a
+# migration is interrupted or two processes migrate at once.
+gMigrations = [
+  (1, "Build content hashes and copied tests", [
+    # Build hashes - content hash of builds' binaries, see
+    # BuildGetter.Build.get_content_hash()
+    '''CREATE TABLE IF NOT EXISTS
+        "benchtester_build_hashes" ("build_id" INTEGER PRIMARY KEY NOT NULL,
+                                    "hash" VARCHAR NOT NULL)''',
+    # Test copies - tests whose results were copied from a test of an
+    # identical build rather than run
+    '''CREATE TABLE IF NOT EXISTS
+        "benchtester_test_copies" ("test_id" INTEGER PRIMARY KEY NOT NULL,
+                                   "source_test_id" INTEGER NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS build_by_hash ON benchtester_build_hashes ( hash )'''
+  ]),
+
+  (2, "Per-checkpoint aggregates", [
+    # Aggregates - summary of each datapoint per test and checkpoint,
+    # maintained by add_test_results. The checkpoint is the datapoint's meta
+    # without any ":<iteration>" suffix.
+    '''CREATE TABLE IF NOT EXISTS
+        "benchtester_aggregates" ("test_id" INTEGER NOT NULL,
+                                  "datapoint_id" INTEGER NOT NULL,
+                                  "checkpoint" VARCHAR,
+                                  "count" INTEGER NOT NULL,
+                                  "min" INTEGER NOT NULL,
+                                  "max" INTEGER NOT NULL,
+                                  "mean" REAL NOT NULL,
+                                  "median" REAL NOT NULL)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS aggregates_for_test ON benchtester_aggregates ( test_id, datapoint_id, checkpoint )'''
+  ]),
+
+  (3, "Covering index for build diffs", [
+    # Covers diff_builds' reads of a test's aggregates
+    '''CREATE INDEX IF NOT EXISTS aggregates_diff ON benchtester_aggregates ( test_id, datapoint_id, checkpoint, median )'''
+  ]),
+
+  (4, "Covering indexes for series and latest build queries", [
+    # Covers reading one datapoint's history, e.g. rewriting a SeriesExport
+    # series
+    '''CREATE INDEX IF NOT EXISTS aggregates_series ON benchtester_aggregates ( datapoint_id, test_id, checkpoint, median )''',
+    # Latest builds, and builds in a time range
+    '''CREATE INDEX IF NOT EXISTS builds_by_time ON benchtester_builds ( time, id, name )''',
+    # Tests of a build, for the many "latest successful run against this build"
+    # lookups
+    '''CREATE INDEX IF NOT EXISTS tests_for_build ON benchtester_tests ( build_id, name, successful, id )'''
+  ]),
+
+  (5, "Time sharding", [
+    # Settings - per database options, e.g. shard_months
+    '''CREATE TABLE IF NOT EXISTS
+        "benchtester_settings" ("name" VARCHAR PRIMARY KEY NOT NULL,
+                                "value" VARCHAR)''',
+    # Shards - the files holding data of builds with start <= time < end, see
+    # attach_shards()
+    '''CREATE TABLE IF NOT EXISTS
+        "benchtester_shards" ("id" INTEGER PRIMARY KEY NOT NULL,
+                              "file" VARCHAR NOT NULL UNIQUE,
+                              "start" DATETIME NOT NULL,
+                              "end" DATETIME NOT NULL)'''
+  ]),
+
+  (6, "Compaction", [
+    # Compacted tests - tests whose raw data was removed by compact_results,
+    # except for datapoints matching the newline separated SQL LIKE patterns
+    # in kept
+    '''CREATE TABLE IF NOT EXISTS
+        "benchtester_compacted" ("test_id" INTEGER PRIMARY KEY NOT NULL,
+                                 "time" DATETIME NOT NULL,
+                                 "kept" VARCHAR)'''
+  ]),
+
+  (7, "Spooled results", [
+    # Spooled - spool files merged by merge_spool, so a merge interrupted
+    # before it removed them doesn't add their results twice
+    '''CREATE TABLE IF NOT EXISTS
+        "benchtester_spooled" ("file" VARCHAR PRIMARY KEY NOT NULL,
+                               "test_id" INTEGER NOT NULL)'''
+  ]),
+
+  (8, "Per-build variance", [
+    # Variance - spread of each datapoint's checkpoint medians across the
+    # repeated runs of a test against one build, see update_build_variance
+    '''CREATE TABLE IF NOT EXISTS
+        "benchtester_variance" ("build_id" INTEGER NOT NULL,
+                                "test_name" VARCHAR NOT NULL,
+                                "datapoint_id" INTEGER NOT NULL,
+                                "checkpoint" VARCHAR,
+                                "runs" INTEGER NOT NULL,
+                                "mean" REAL NOT NULL,
+                                "stddev" REAL NOT NULL,
+                                "min" REAL NOT NULL,
+                                "max" REAL NOT NULL)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS variance_for_build ON benchtester_variance ( build_id, test_name, datapoint_id, checkpoint )'''
+  ])
+]
+
+gSchemaVersionTable = '''CREATE TABLE IF NOT EXISTS
+    "benchtester_schema_version" ("version" INTEGER PRIMARY KEY NOT NULL,
+                                  "description" VARCHAR NOT NULL,
+                                  "applied" DATETIME NOT NULL)'''
+
+def get_schema_version(sqlite):
+  cur = sqlite.cursor()
+  cur.execute(gSchemaVersionTable)
+  cur.execute("SELECT MAX(version) FROM benchtester_schema_version")
+  return cur.fetchone()[0] or 0
+
+# Creates the tables of a new database and brings an existing one up to date,
+# applying migrations up to target (or all of them). Refreshes the query
+# planner's statistics if anything was applied. log, if given, is called with
+# progress messages. Returns the versions applied.
+def migrate(sqlite, target=None, log=None):
+  cur = sqlite.cursor()
+  # The statements name tables without a schema, which would find any shard
+  # views first
+  for table in gShardTables:
+    cur.execute("DROP VIEW IF EXISTS temp.%s" % (table,))
+  for schema in gTableSchemas:
+    cur.execute(schema)
+  sqlite.commit()
+  version = get_schema_version(sqlite)
+  applied = []
+  for migration, description, statements in gMigrations:
+    if migration <= version or (target is not None and migration > target):
+      continue
+    if log:
+      log("Applying schema migration %u: %s" % (migration, description))
+    begin = time.time()
+    for statement in statements:
+      cur.execute(statement)
+      sqlite.commit()
+    cur.execute("INSERT OR IGNORE INTO benchtester_schema_version(version, description, applied) "
+                "VALUES (?, ?, ?)", (migration, description, int(time.time())))
+    sqlite.commit()
+    if log:
+      log("Applied schema migration %u in %.02fs" % (migration, time.time() - begin))
+    applied.append(migration)
+  if len(applied):
+    analyze(sqlite, log)
+  _create_shard_views(sqlite)
+  return applied
+
+# Updates the statistics the query planner uses to pick indexes. Sampling is
+# limited where sqlite supports it, so this stays quick on large databases.
+def analyze(sqlite, log=None):
+  begin = time.time()
+  cur = sqlite.cursor()
+  # Both are silently ignored by versions of sqlite that don't know them
+  cur.execute("PRAGMA analysis_limit = 1000")
+  cur.execute("ANALYZE")
+  cur.execute("PRAGMA optimize")
+  sqlite.commit()
+  if log:
+    log("Analyzed database in %.02fs" % (time.time() - begin,))
+
+##
+## Time sharding
+##
+
+# A results database can be split by build time. The database file then
+# becomes a manifest holding builds, tests and datapoint names, while the bulk
+# of the results - the gShardTables rows - live in one shard file per period of
+# build time, listed in benchtester_shards. Every file has the full schema, the
+# tables that belong to the other side are just left empty.
+#
+# attach_shards() ATTACHes the shards covering a time range and shadows each
+# gShardTables table with a TEMP view of the same name unioning the main
+# database's table with the attached shards', so the queries in this file read
+# a sharded database unchanged. Writers only attach the shard of the build
+# they're recording (get_results_schema), so once a period is over its shard
+# stops changing and can be backed up or cached as is.
+#
+# sqlite limits the number of attached databases, to 10 unless built
+# otherwise, which bounds the time range a single connection can read. Shards
+# are attached as needed - readers of particular builds attach their shards
+# (attach_build_shards), detaching others to make room - and reads of the
+# whole history go through a connection per shard (query_results) instead.
+gShardTables = [ 'benchtester_data', 'benchtester_aggregates' ]
+gMaxAttachedShards = 10
+
+def _db_path(sqlite, schema='main'):
+  for row in sqlite.execute("PRAGMA database_list"):
+    if row[1] == schema:
+      return row[2]
+  return None
+
+# Returns the number of months each shard of the database covers, or None if
+# it isn't sharded
+def get_shard_months(sqlite):
+  try:
+    row = sqlite.execute("SELECT value FROM main.benchtester_settings "
+                         "WHERE name = 'shard_months'").fetchone()
+  except sqlite3.OperationalError:
+    # Predates migration 5
+    return None
+  return int(row[0]) if row else None
+
+# Returns the paths of all shards of the database, oldest first
+def get_shard_files(sqlite):
+  if not get_shard_months(sqlite):
+    return []
+  directory = os.path.dirname(_db_path(sqlite))
+  return [ os.path.join(directory, row[0]) for row in
+           sqlite.execute("SELECT file FROM main.benchtester_shards ORDER BY start") ]
+
+# Returns (start, end, label) of the shard period holding buildtime. Periods
+# are runs of months counted from the start of year 0, so e.g. 3 month shards
+# are calendar quarters.
+def _shard_period(buildtime, months):
+  date = datetime.datetime.utcfromtimestamp(int(buildtime))
+  period = (date.year * 12 + date.month - 1) // months * months
+  start = datetime.datetime(period // 12, period % 12 + 1, 1)
+  period += months
+  end = datetime.datetime(period // 12, period % 12 + 1, 1)
+  return (calendar.timegm(start.timetuple()), calendar.timegm(end.timetuple()),
+          start.strftime('%Y-%m'))
+
+# Returns the id of the shard for builds at buildtime, adding it to the
+# manifest if needed
+def _get_shard(sqlite, buildtime, months):
+  start, end, label = _shard_period(buildtime, months)
+  cur = sqlite.cursor()
+  cur.execute("SELECT id FROM main.benchtester_shards WHERE start = ?", (start,))
+  row = cur.fetchone()
+  if not row:
+    name = os.path.splitext(os.path.basename(_db_path(sqlite)))[0]
+    cur.execute("INSERT OR IGNORE INTO main.benchtester_shards(file, start, end) "
+                "VALUES (?, ?, ?)", ("%s.%s.sqlite" % (name, label), start, end))
+    sqlite.commit()
+    cur.execute("SELECT id FROM main.benchtester_shards WHERE start = ?", (start,))
+    row = cur.fetchone()
+  return row[0]
+
+def _create_shard_views(sqlite):
+  schemas = [ 'main' ] + sorted(row[1] for row in sqlite.execute("PRAGMA database_list")
+                                if row[1].startswith('shard_'))
+  for table in gShardTables:
+    sqlite.execute("DROP VIEW IF EXISTS temp.%s" % (table,))
+    if len(schemas) > 1:
+      sqlite.execute("CREATE TEMP VIEW %s AS %s" % (table, " UNION ALL ".join(
+        "SELECT * FROM %s.%s" % (schema, table) for schema in schemas)))
+
+# Attaches a shard, creating or migrating its file as needed. Returns the
+# schema name it is attached as.
+def _attach_shard(sqlite, shard_id):
+  schema = "shard_%u" % (shard_id,)
+  if _db_path(sqlite, schema) is not None:
+    return schema
+  row = sqlite.execute("SELECT file FROM main.benchtester_shards WHERE id = ?", (shard_id,)).fetchone()
+  path = os.path.join(os.path.dirname(_db_path(sqlite)), row[0])
+  new = not os.path.exists(path)
+  shard = sqlite3.connect(path, timeout=900)
+  if new:
+    # Lets compact_results hand back the space of older results as it goes
+    shard.execute("PRAGMA auto_vacuum = INCREMENTAL")
+  migrate(shard)
+  shard.close()
+  sqlite.commit()
+  sqlite.execute("ATTACH DATABASE ? AS %s" % (schema,), (path,))
+  _create_shard_views(sqlite)
+  return schema
+
+def _detach_shard(sqlite, schema):
+  sqlite.commit()
+  sqlite.execute("DETACH DATABASE %s" % (schema,))
+  _create_shard_views(sqlite)
+
+# Attaches the given shards, first detaching shards attached for earlier reads
+# if there wouldn't be room for them. Raises if there are more than can be
+# attached at once. Returns their schema names, in the order given.
+def _attach_shard_ids(sqlite, shard_ids):
+  wanted = set("shard_%u" % (x,) for x in shard_ids)
+  if len(wanted) > gMaxAttachedShards:
+    raise Exception("Reading %u shards at once, but sqlite can only attach %u databases. "
+                    "Read a shorter time range" % (len(wanted), gMaxAttachedShards))
+  attached = [ row[1] for row in sqlite.execute("PRAGMA database_list")
+               if row[1].startswith('shard_') ]
+  excess = len(wanted.union(attached)) - gMaxAttachedShards
+  for schema in [ x for x in attached if x not in wanted ][:max(0, excess)]:
+    _detach_shard(sqlite, schema)
+  return [ _attach_shard(sqlite, x) for x in shard_ids ]
+
+# Attaches the shards of a sharded database that hold builds with
+# starttime <= time <= endtime, or all of them if unset, raising if that's
+# more than can be attached at once (see query_results for reading every
+# shard). Does nothing for a database that isn't sharded. Returns the schema
+# names attached.
+def attach_shards(sqlite, starttime=None, endtime=None):
+  if not get_shard_months(sqlite):
+    return []
+  cur = sqlite.cursor()
+  cur.execute("SELECT id FROM main.benchtester_shards WHERE end > ? AND start <= ? ORDER BY start",
+              (starttime if starttime is not None else 0,
+               endtime if endtime is not None else sys.maxint))
+  return _attach_shard_ids(sqlite, [ row[0] for row in cur.fetchall() ])
+
+# Attaches the existing shards holding builds at any of buildtimes, so their
+# results can be read through the shard views. Does nothing for a database that
+# isn't sharded. Returns the schema names attached.
+def attach_build_shards(sqlite, buildtimes):
+  if not get_shard_months(sqlite):
+    return []
+  cur = sqlite.cursor()
+  shard_ids = set()
+  for buildtime in set(buildtimes):
+    cur.execute("SELECT id FROM main.benchtester_shards WHERE start <= ? AND end > ?",
+                (buildtime, buildtime))
+    shard_ids.update(row[0] for row in cur.fetchall())
+  return _attach_shard_ids(sqlite, sorted(shard_ids))
+
+# Returns the schemas the results of builds at each of buildtimes are to be
+# written to: their shards, attached together if need be, or 'main' for an
+# unsharded database
+def get_results_schemas(sqlite, buildtimes):
+  months = get_shard_months(sqlite)
+  if not months:
+    return [ 'main' ] * len(buildtimes)
+  return _attach_shard_ids(sqlite, [ _get_shard(sqlite, x, months) for x in buildtimes ])
+
+# Returns the schema the results of a build at buildtime are to be written to,
+# see get_results_schemas
+def get_results_schema(sqlite, buildtime):
+  return get_results_schemas(sqlite, [ buildtime ])[0]
+
+# Returns [ (connection, manifest schema), ... ] for each database holding
+# results: sqlite itself, then for a sharded database a new connection to each
+# shard, with the manifest attached as 'manifest' for the tables that live
+# there. The caller closes the shard connections.
+def _results_databases(sqlite):
+  ret = [ (sqlite, 'main') ]
+  for path in get_shard_files(sqlite):
+    shard = sqlite3.connect(path, timeout=900)
+    migrate(shard)
+    shard.execute("ATTACH DATABASE ? AS manifest", (_db_path(sqlite),))
+    ret.append((shard, 'manifest'))
+  return ret
+
+# Runs a query against every database holding results in turn (see
+# _results_databases), yielding lists of up to size of their rows, so large
+# results needn't be held at once. The query names the gShardTables tables as
+# main.<table>, and the other tables as %(manifest)s.<table>. Rows aren't
+# ordered across databases.
+def iterate_results(sqlite, query, params=(), size=10000):
+  databases = _results_databases(sqlite)
+  try:
+    for db, manifest in databases:
+      cur = db.execute(query % { 'manifest': manifest }, params)
+      while True:
+        rows = cur.fetchmany(size)
+        if not rows: break
+        yield rows
+  finally:
+    for db, manifest in databases[1:]:
+      db.close()
+
+# As iterate_results, returning all the rows at once
+def query_results(sqlite, query, params=()):
+  ret = []
+  for rows in iterate_results(sqlite, query, params):
+    ret.extend(rows)
+  return ret
+
+# Splits a database into shards of the given number of months, moving the
+# results of existing tests out of the main file. Safe to interrupt and re-run,
+# each batch of tests is moved in one transaction. The main file keeps its size
+# until it is VACUUMed. progress, if given, is called with (tests moved, total).
+# Returns the number of tests moved.
+def shard_database(sqlite, months, progress=None):
+  migrate(sqlite)
+  current = get_shard_months(sqlite)
+  if current and current != months:
+    raise Exception("Database is already sharded by %u months" % (current,))
+  # Shards are only given aggregates alongside their data, so fill in any
+  # older tests first
+  rebuild_aggregates(sqlite)
+  sqlite.execute("INSERT OR REPLACE INTO main.benchtester_settings(name, value) "
+                 "VALUES ('shard_months', ?)", (str(months),))
+  sqlite.commit()
+
+  cur = sqlite.cursor()
+  cur.execute("SELECT t.id, b.time FROM main.benchtester_tests t "
+              "JOIN main.benchtester_builds b ON b.id = t.build_id "
+              "WHERE EXISTS (SELECT 1 FROM main.benchtester_data d WHERE d.test_id = t.id) "
+              "   OR EXISTS (SELECT 1 FROM main.benchtester_aggregates a WHERE a.test_id = t.id) "
+              "ORDER BY b.time, t.id")
+  periods = {}
+  for testid, buildtime in cur.fetchall():
+    periods.setdefault(_get_shard(sqlite, buildtime, months), []).append(testid)
+  total = sum(len(x) for x in periods.values())
+  done = 0
+  for shard_id, testids in sorted(periods.iteritems()):
+    # Attach one shard at a time, to stay under sqlite's attached database limit
+    attached = _db_path(sqlite, "shard_%u" % (shard_id,)) is not None
+    schema = _attach_shard_ids(sqlite, [ shard_id ])[0]
+    for x in range(0, len(testids), 100):
+      chunk = testids[x:x + 100]
+      params = ','.join('?' * len(chunk))
+      try:
+        for table in gShardTables:
+          cur.execute("INSERT INTO %s.%s SELECT * FROM main.%s WHERE test_id IN (%s)"
+                      % (schema, table, table, params), chunk)
+          cur.execute("DELETE FROM main.%s WHERE test_id IN (%s)" % (table, params), chunk)
+        sqlite.commit()
+      except:
+        sqlite.rollback()
+        raise
+      done += len(chunk)
+      if progress:
+        progress(done, total)
+    if not attached:
+      _detach_shard(sqlite, schema)
+  return total
+
+##
+## Writing results
+##
+
+# Returns the id of the named build, adding it if needed, or updating its time
+# if it differs. warn, if given, is called with a message in the latter case.
+# Does not commit.
+def _get_build_id(cur, buildname, buildtime, warn=None):
+  cur.execute("SELECT `time`, `id` FROM `benchtester_builds` WHERE `name` = ?", [ buildname ])
+  buildrow = cur.fetchone()
+  if not buildrow:
+    cur.execute("INSERT INTO `benchtester_builds` (`name`, `time`) VALUES (?, ?)", (buildname, int(buildtime)))
+    return cur.lastrowid
+  if buildrow[0] != int(buildtime):
+    if warn:
+      warn("Build '%s' already exists in the database, but with a differing timestamp. Overwriting old record (%s -> %s)" % (buildname, buildrow[0], buildtime))
+    cur.execute("UPDATE `benchtester_builds` SET `time` = ? WHERE `id` = ?", [ int(buildtime), buildrow[1] ])
+  return buildrow[1]
+
+# Adds a test run and its datapoints, given as add_test_results takes them, to
+# the database, writing data to the given schema (see get_results_schema). log,
+# if given, is called with progress messages. Does not commit. Returns the new
+# test's id.
+def insert_test_results(cur, build_id, testname, timestamp, datapoints, succeeded=True, schema='main', log=None):
+  cur.execute("INSERT INTO "
+              "  benchtester_tests(name, time, build_id, successful) "
+              "VALUES (?, ?, ?, ?)",
+              (testname, int(timestamp), build_id, succeeded))
+  testid = cur.lastrowid
+  insertbegin = time.time()
+  if log:
+    log("Inserting %u datapoints into DB" % len(datapoints))
+  cur.executemany("INSERT OR IGNORE INTO `benchtester_datapoints`(name) "
+                  "VALUES (?)",
+                  ([ datapoint[0] ] for datapoint in datapoints))
+  if log:
+    log("Filled datapoint names in %.02fs" % (time.time() - insertbegin))
+  insertbegin = time.time()
+  # If val is a list, it is interpreted as [ value, meta ]
+  cur.executemany("INSERT INTO %s.`benchtester_data` "
+                  "SELECT ?, p.id, ?, ? FROM `benchtester_datapoints` p "
+                  "WHERE p.name = ?" % (schema,),
+                  ( [ testid,
+                      dp[1],
+                      dp[2] if len(dp) > 2 else None,
+                      dp[0] ]
+                    for dp in datapoints ))
+  if log:
+    log("Filled datapoint values in %.02fs" % (time.time() - insertbegin))
+  insertbegin = time.time()
+  _insert_aggregates(cur, testid, datapoints, schema)
+  if log:
+    log("Filled datapoint aggregates in %.02fs" % (time.time() - insertbegin))
+  return testid
+
+##
+## Spooling
+##
+
+# When the database can't be written to, or --spool-only is given, a tester
+# with --spool set writes each test's results to a file of their own in the
+# spool directory instead, to be loaded later by merge_spool. Files are only
+# ever added to the spool, under a temporary name until complete, and named so
+# that they sort in the order they were written. Each is a gzipped JSON object:
+#   { "version": 1, "buildname": ..., "buildtime": ..., "testname": ...,
+#     "time": ..., "succeeded": ..., "names": [ datapoint name, ... ],
+#     "datapoints": [ [ index into names, value, meta ], ... ] }
+gSpoolVersion = 1
+gSpoolSuffix = '.json.gz'
+
+# Writes a test's results to a new file in spooldir. Returns its path.
+def spool_test_results(spooldir, buildname, buildtime, testname, timestamp, datapoints, succeeded=True):
+  if not os.path.exists(spooldir):
+    os.makedirs(spooldir)
+  names = {}
+  for dp in datapoints:
+    names.setdefault(dp[0], len(names))
+  run = { 'version': gSpoolVersion,
+          'buildname': buildname,
+          'buildtime': int(buildtime),
+          'testname': testname,
+          'time': int(timestamp),
+          'succeeded': bool(succeeded),
+          'names': sorted(names, key=names.get),
+          'datapoints': [ [ names[dp[0]], dp[1], dp[2] if len(dp) > 2 else None ]
+                          for dp in datapoints ] }
+  fd, temppath = tempfile.mkstemp(prefix="%013u-" % (int(timestamp * 1000),), suffix='.tmp', dir=spooldir)
+  try:
+    raw = os.fdopen(fd, 'wb')
+    try:
+      f = gzip.GzipFile(fileobj=raw, mode='wb')
+      json.dump(run, f, separators=(',', ':'))
+      f.close()
+    finally:
+      raw.close()
+    path = temppath[:-len('.tmp')] + gSpoolSuffix
+    os.rename(temppath, path)
+  except:
+    os.remove(temppath)
+    raise
+  return path
+
+# Reads a spool file, returning its object with datapoints in the form
+# add_test_results takes
+def read_spool_file(path):
+  f = gzip.open(path, 'rb')
+  try:
+    run = json.load(f)
+  finally:
+    f.close()
+  if run.get('version') != gSpoolVersion:
+    raise Exception("Spool file %s has version %s, expected %s" % (path, run.get('version'), gSpoolVersion))
+  names = run.pop('names')
+  run['datapoints'] = [ [ names[dp[0]], dp[1], dp[2] ] for dp in run['datapoints'] ]
+  return run
+
+# Loads the spooled results in spooldir into the database, oldest first, batch
+# files to a transaction, removing each file once it is committed. Files that
+# can't be read are renamed to <file>.bad and skipped. log, if given, is
+# called with progress messages. Returns (tests merged, files skipped).
+def merge_spool(sqlite, spooldir, batch=50, log=None):
+  migrate(sqlite)
+  files = sorted(x for x in os.listdir(spooldir) if x.endswith(gSpoolSuffix))
+  merged = bad = 0
+  cur = sqlite.cursor()
+  for x in range(0, len(files), batch):
+    runs = []
+    for name in files[x:x + batch]:
+      path = os.path.join(spooldir, name)
+      cur.execute("SELECT 1 FROM benchtester_spooled WHERE file = ?", (name,))
+      if cur.fetchone():
+        # Merged by an earlier run that didn't get to remove it
+        os.remove(path)
+        continue
+      try:
+        runs.append((name, read_spool_file(path)))
+      except Exception, e:
+        if log:
+          log("Skipping unreadable spool file %s: %s" % (path, e))
+        os.rename(path, path + '.bad')
+        bad += 1
+    # Shards can only be attached outside of a transaction
+    schemas = get_results_schemas(sqlite, [ run['buildtime'] for name, run in runs ])
+    try:
+      for (name, run), schema in zip(runs, schemas):
+        build_id = _get_build_id(cur, run['buildname'], run['buildtime'], log)
+        testid = insert_test_results(cur, build_id, run['testname'], run['time'],
+                                     run['datapoints'], run['succeeded'], schema)
+        cur.execute("INSERT INTO benchtester_spooled(file, test_id) VALUES (?, ?)", (name, testid))
+      sqlite.commit()
+    except:
+      sqlite.rollback()
+      raise
+    for name, run in runs:
+      os.remove(os.path.join(spooldir, name))
+    merged += len(runs)
+    if log:
+      log("Merged %u/%u spooled tests" % (merged, len(files)))
+  return (merged, bad)
+
+##
+## Reading results back
+##
+
+# Opens an existing results database for reading. Returns None if there is no
+# database at path. If the database is sharded and a time range is given, the
+# shards holding builds with starttime <= time <= endtime are attached (see
+# attach_shards). Otherwise no shards are attached up front: the functions
+# below attach the shards of the builds they read, or use query_results.
+def open_results_db(path, starttime=None, endtime=None):
+  if not path or not os.path.exists(path):
+    return None
+  sqlite = sqlite3.connect(os.path.abspath(path), timeout=900)
+  if starttime is not None or endtime is not None:
+    attach_shards(sqlite, starttime, endtime)
+  return sqlite
+
+# Returns [ (value, meta), ... ] for every row of the datapoint recorded by the
+# most recent successful run of testname against buildname. Build names are
+# compared by prefix, so that a short and a full revision match the same build
+def get_datapoint_values(sqlite, buildname, testname, datapoint):
+  cur = sqlite.cursor()
+  cur.execute("SELECT t.id, b.time FROM benchtester_tests t "
+              "JOIN benchtester_builds b ON b.id = t.build_id "
+              "WHERE t.name = ?1 AND t.successful "
+              "  AND (substr(b.name, 1, length(?2)) = ?2 "
+              "       OR substr(?2, 1, length(b.name)) = b.name) "
+              "ORDER BY t.id DESC LIMIT 1",
+              (testname, buildname))
+  row = cur.fetchone()
+  if not row:
+    return []
+  attach_build_shards(sqlite, [ row[1] ])
+  cur.execute("SELECT d.value, d.meta FROM benchtester_data d "
+              "JOIN benchtester_datapoints p ON p.id = d.datapoint_id "
+              "WHERE p.name = ? AND d.test_id = ?",
+              (datapoint, row[0]))
+  return cur.fetchall()
+
+# Returns [ (name, time), ... ] for every build with at least one successful
+# test, optionally limited to builds with starttime <= time <= endtime
+def get_tested_builds(sqlite, starttime=None, endtime=None):
+  cur = sqlite.cursor()
+  cur.execute("SELECT b.name, b.time FROM benchtester_builds b "
+              "WHERE b.time >= ? AND b.time <= ? AND EXISTS "
+              "  (SELECT 1 FROM benchtester_tests t "
+              "   WHERE t.build_id = b.id AND t.successful) "
+              "ORDER BY b.time",
+              (starttime if starttime is not None else 0,
+               endtime if endtime is not None else sys.maxint))
+  return cur.fetchall()
+
+# Returns [ (test id, build name, build time, test name), ... ] for every
+# successful test with an id greater than since, in id order
+def get_tests_since(sqlite, since=0):
+  cur = sqlite.cursor()
+  cur.execute("SELECT t.id, b.name, b.time, t.name FROM benchtester_tests t "
+              "JOIN benchtester_builds b ON b.id = t.build_id "
+              "WHERE t.id > ? AND t.successful ORDER BY t.id",
+              (since,))
+  return cur.fetchall()
+
+##
+## Aggregates
+##
+
+# The checkpoint a datapoint's meta refers to, i.e. without the iteration
+# number EnduranceTest appends
+def checkpoint_label(meta):
+  if meta:
+    parts = meta.rsplit(':', 1)
+    if len(parts) == 2 and parts[1].isdigit():
+      return parts[0]
+  return meta
+
+# Given [ [ key, value, meta ], ... ], returns
+# [ [ key, checkpoint, count, min, max, mean, median ], ... ]
+# for each distinct key and checkpoint_label(meta).
+def _aggregate(rows):
+  groups = {}
+  for row in rows:
+    meta = row[2] if len(row) > 2 else None
+    groups.setdefault((row[0], checkpoint_label(meta)), []).append(row[1])
+  ret = []
+  for (key, checkpoint), values in groups.iteritems():
+    values.sort()
+    count = len(values)
+    mid = count // 2
+    median = values[mid] if count % 2 else (values[mid - 1] + values[mid]) / 2.0
+    ret.append([ key, checkpoint, count, values[0], values[-1],
+                 float(sum(values)) / count, median ])
+  return ret
+
+# Computes and stores the aggregates of a test's datapoints, given as
+# add_test_results takes them, in the given schema's aggregates table. Does not
+# commit.
+def _insert_aggregates(cur, testid, datapoints, schema='main'):
+  cur.executemany("INSERT OR REPLACE INTO %s.benchtester_aggregates "
+                  "SELECT ?, p.id, ?, ?, ?, ?, ?, ? FROM benchtester_datapoints p "
+                  "WHERE p.name = ?" % (schema,),
+                  ( [ testid ] + agg[1:] + [ agg[0] ] for agg in _aggregate(datapoints) ))
+
+# Whether compact_results has removed a test's raw data. manifest is the schema
+# holding the tests table, see _results_databases.
+def _is_compacted(cur, testid, manifest='main'):
+  try:
+    cur.execute("SELECT 1 FROM %s.benchtester_compacted WHERE test_id = ?" % (manifest,), (testid,))
+  except sqlite3.OperationalError:
+    # Not migrated that far, so nothing is compacted
+    return False
+  return cur.fetchone() is not None
+
+# Recomputes the aggregates of one test from its raw data, storing them in the
+# given schema. Compacted tests are refused, as their aggregates are all that
+# is left of most of their data. Does not commit.
+def _rebuild_test_aggregates(cur, testid, schema='main', manifest='main'):
+  if _is_compacted(cur, testid, manifest):
+    raise Exception("Test %u has been compacted, its aggregates can't be rebuilt" % (testid,))
+  cur.execute("SELECT datapoint_id, value, meta FROM benchtester_data WHERE test_id = ?", (testid,))
+  aggregates = _aggregate(cur.fetchall())
+  cur.execute("DELETE FROM %s.benchtester_aggregates WHERE test_id = ?" % (schema,), (testid,))
+  cur.executemany("INSERT INTO %s.benchtester_aggregates VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % (schema,),
+                  ( [ testid ] + agg for agg in aggregates ))
+
+# The ids of tests with raw data in sqlite's main database but no aggregates,
+# or all tests with raw data there if everything is set. Compacted tests are
+# left out, as the raw data they have left is only what compaction kept.
+# manifest is the schema holding the tests table, see _results_databases.
+def _tests_to_aggregate(sqlite, everything, manifest='main'):
+  where = [ "EXISTS (SELECT 1 FROM main.benchtester_data d WHERE d.test_id = t.id)",
+            "NOT EXISTS (SELECT 1 FROM %s.benchtester_compacted c WHERE c.test_id = t.id)" % (manifest,) ]
+  if not everything:
+    where.append("NOT EXISTS (SELECT 1 FROM main.benchtester_aggregates a WHERE a.test_id = t.id)")
+  cur = sqlite.cursor()
+  cur.execute("SELECT t.id FROM %s.benchtester_tests t WHERE %s ORDER BY t.id" % (manifest, " AND ".join(where)))
+  return [ x[0] for x in cur.fetchall() ]
+
+# Recomputes the aggregates of existing tests from their raw data. By default
+# only tests with no aggregates are done, all tests if everything is set.
+# Compacted tests are never done. Commits after each test. Returns the number of tests aggregated.
+def rebuild_aggregates(sqlite, everything=False, progress=None):
+  migrate(sqlite)
+  work = [ (db, manifest, _tests_to_aggregate(db, everything, manifest))
+           for db, manifest in _results_databases(sqlite) ]
+  total = sum(len(testids) for db, manifest, testids in work)
+  done = 0
+  for db, manifest, testids in work:
+    cur = db.cursor()
+    for testid in testids:
+      _rebuild_test_aggregates(cur, testid, 'main', manifest)
+      db.commit()
+      done += 1
+      if progress:
+        progress(done, total)
+    if db != sqlite:
+      db.close()
+  return total
+
+# Finds the id of the build named buildname, by prefix as in
+# get_datapoint_values. Returns None if there is no such build.
+def _find_build(cur, buildname):
+  cur.execute("SELECT id FROM benchtester_builds "
+              "WHERE substr(name, 1, length(?1)) = ?1 "
+              "   OR substr(?1, 1, length(name)) = name "
+              "ORDER BY id DESC LIMIT 1",
+              (buildname,))
+  row = cur.fetchone()
+  return row[0] if row else None
+
+##
+## Compaction
+##
+
+# Old tests can have their raw, per iteration, data removed once their
+# aggregates exist, since the aggregates are all that graphs, diffs and exports
+# of them read. Readers of raw data (get_datapoint_values) only see the
+# datapoints that were kept for compacted tests.
+
+# Returns the build time before which builds' raw data is compacted, keeping
+# the keep_builds latest tested builds and builds from the last keep_days. None
+# if neither is given or there aren't keep_builds builds yet.
+def compaction_cutoff(sqlite, keep_builds=None, keep_days=None):
+  cutoffs = []
+  if keep_builds is not None:
+    cur = sqlite.cursor()
+    cur.execute("SELECT b.time FROM main.benchtester_builds b WHERE EXISTS "
+                "  (SELECT 1 FROM main.benchtester_tests t WHERE t.build_id = b.id) "
+                "ORDER BY b.time DESC LIMIT 1 OFFSET ?", (max(keep_builds - 1, 0),))
+    row = cur.fetchone()
+    if not row:
+      return None
+    cutoffs.append(row[0])
+  if keep_days is not None:
+    cutoffs.append(int(time.time() - keep_days * 24 * 60 * 60))
+  return min(cutoffs) if len(cutoffs) else None
+
+# Removes the raw data of tests of builds older than cutoff, except for
+# datapoints whose name matches one of the SQL LIKE patterns in keep. Tests
+# without aggregates get them first. Work is committed in batches of tests,
+# after each of which the freed pages are returned to the filesystem if the
+# database uses incremental auto_vacuum (shards created by sharding do,
+# 'BenchDB.py compact --enable-incremental-vacuum' converts others). Tests
+# already compacted are skipped. progress, if given, is called with (tests
+# done, total). Returns (tests compacted, rows removed).
+def compact_results(sqlite, cutoff, keep=None, progress=None, batch=50):
+  migrate(sqlite)
+  keep = keep or []
+  work = []
+  for db, manifest in _results_databases(sqlite):
+    cur = db.cursor()
+    cur.execute("SELECT t.id FROM %(m)s.benchtester_tests t "
+                "JOIN %(m)s.benchtester_builds b ON b.id = t.build_id "
+                "WHERE b.time < ? "
+                "  AND NOT EXISTS (SELECT 1 FROM %(m)s.benchtester_compacted c WHERE c.test_id = t.id) "
+                "  AND EXISTS (SELECT 1 FROM main.benchtester_data d WHERE d.test_id = t.id) "
+                "ORDER BY t.id" % { 'm': manifest }, (cutoff,))
+    work.append((db, manifest, [ x[0] for x in cur.fetchall() ]))
+  total = sum(len(testids) for db, manifest, testids in work)
+  done = removed = 0
+
+  for db, manifest, testids in work:
+    cur = db.cursor()
+    incremental = cur.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    where = ""
+    if len(keep):
+      where = (" AND datapoint_id NOT IN (SELECT id FROM %s.benchtester_datapoints WHERE %s)"
+               % (manifest, " OR ".join([ "name LIKE ?" ] * len(keep))))
+    for x in range(0, len(testids), batch):
+      chunk = testids[x:x + batch]
+      try:
+        for testid in chunk:
+          cur.execute("SELECT 1 FROM main.benchtester_aggregates WHERE test_id = ? LIMIT 1", (testid,))
+          if not cur.fetchone():
+            _rebuild_test_aggregates(cur, testid, 'main', manifest)
+          cur.execute("DELETE FROM main.benchtester_data WHERE test_id = ?" + where, [ testid ] + keep)
+          removed += cur.rowcount
+          cur.execute("INSERT OR REPLACE INTO %s.benchtester_compacted(test_id, time, kept) "
+                      "VALUES (?, ?, ?)" % (manifest,), (testid, int(time.time()), '\n'.join(keep)))
+        db.commit()
+      except:
+        db.rollback()
+        raise
+      if incremental:
+        # Each row returned is a page freed, so it must be read to completion
+        cur.execute("PRAGMA incremental_vacuum").fetchall()
+      done += len(chunk)
+      if progress:
+        progress(done, total)
+    if db != sqlite:
+      db.close()
+  return (done, removed)
+
+##
+## Comparing builds
+##
+
+# Returns the ids of the latest successful run of testname against each of
+# buildnames, with their shards attached, computing the aggregates of any that
+# predate the aggregates table
+def _latest_tests(sqlite, testname, buildnames):
+  cur = sqlite.cursor()
+  tests = []
+  for buildname in buildnames:
+    build_id = _find_build(cur, buildname)
+    if build_id is None:
+      raise Exception("No build named %s" % (buildname,))
+    cur.execute("SELECT t.id, b.time FROM benchtester_tests t "
+                "JOIN benchtester_builds b ON b.id = t.build_id "
+                "WHERE t.name = ? AND t.build_id = ? AND t.successful "
+                "ORDER BY t.id DESC LIMIT 1", (testname, build_id))
+    row = cur.fetchone()
+    if not row:
+      raise Exception("Build %s has no successful run of %s" % (buildname, testname))
+    tests.append(row)
+  attach_build_shards(sqlite, [ buildtime for testid, buildtime in tests ])
+  for testid, buildtime in tests:
+    cur.execute("SELECT 1 FROM benchtester_aggregates WHERE test_id = ? LIMIT 1", (testid,))
+    if not cur.fetchone():
+      _rebuild_test_aggregates(cur, testid, get_results_schema(sqlite, buildtime))
+      sqlite.commit()
+  return [ testid for testid, buildtime in tests ]
+
+# Compares the results of testname between two builds, or two sets of builds
+# (whose checkpoint medians are averaged). Returns
+# [ (datapoint, checkpoint, a, b, b - a, (b - a) / a), ... ]
+# sorted by the largest absolute change first, or the largest relative change
+# if sort is 'relative'. Values missing on one side are None, as are the
+# changes involving them, which sort last.
+def diff_builds(sqlite, testname, builds_a, builds_b, sort='absolute'):
+  migrate(sqlite)
+  # Both sides at once, so their shards are attached together
+  tests = _latest_tests(sqlite, testname, builds_a + builds_b)
+  tests_a = tests[:len(builds_a)]
+  tests_b = tests[len(builds_a):]
+  cur = sqlite.cursor()
+  # Both sides are read through the aggregates_diff covering index and paired
+  # up by a single grouping pass
+  cur.execute("SELECT p.name, x.checkpoint, x.a, x.b, x.b - x.a, (x.b - x.a) / x.a "
+              "FROM (SELECT datapoint_id, checkpoint, "
+              "             AVG(CASE WHEN side = 0 THEN median END) AS a, "
+              "             AVG(CASE WHEN side = 1 THEN median END) AS b "
+              "      FROM (SELECT 0 AS side, datapoint_id, checkpoint, median "
+              "            FROM benchtester_aggregates WHERE test_id IN (%s) "
+              "            UNION ALL "
+              "            SELECT 1 AS side, datapoint_id, checkpoint, median "
+              "            FROM benchtester_aggregates WHERE test_id IN (%s)) "
+              "      GROUP BY datapoint_id, checkpoint) x "
+              "JOIN benchtester_datapoints p ON p.id = x.datapoint_id "
+              "ORDER BY abs(%s) DESC"
+              % (','.join('?' * len(tests_a)), ','.join('?' * len(tests_b)),
+                 "(x.b - x.a) / x.a" if sort == 'relative' else "x.b - x.a"),
+              tests_a + tests_b)
+  return cur.fetchall()
+
+##
+## Run-to-run variance
+##
+
+# Summarizes the spread of the successful runs of each test against the named
+# build into benchtester_variance, replacing what was there: for every
+# datapoint and checkpoint, the mean, sample standard deviation and range of
+# the runs' medians. Runs copied from an identical build aren't repeats and
+# are left out, as are tests with fewer than two runs. Returns the number of
+# rows written, or None if there is no such build.
+def update_build_variance(sqlite, buildname):
+  migrate(sqlite)
+  cur = sqlite.cursor()
+  build_id = _find_build(cur, buildname)
+  if build_id is None:
+    return None
+  cur.execute("SELECT time FROM benchtester_builds WHERE id = ?", (build_id,))
+  attach_build_shards(sqlite, [ cur.fetchone()[0] ])
+  cur.execute("SELECT name, id FROM benchtester_tests t "
+              "WHERE build_id = ? AND successful "
+              "  AND NOT EXISTS (SELECT 1 FROM benchtester_test_copies c WHERE c.test_id = t.id)",
+              (build_id,))
+  runs = {}
+  for testname, test_id in cur.fetchall():
+    runs.setdefault(testname, []).append(test_id)
+  rows = []
+  for testname, testids in runs.iteritems():
+    if len(testids) < 2:
+      continue
+    cur.execute("SELECT datapoint_id, checkpoint, median FROM benchtester_aggregates "
+                "WHERE test_id IN (%s)" % (','.join('?' * len(testids)),), testids)
+    medians = {}
+    for datapoint_id, checkpoint, median in cur.fetchall():
+      medians.setdefault((datapoint_id, checkpoint), []).append(median)
+    for (datapoint_id, checkpoint), values in medians.iteritems():
+      count = len(values)
+      if count < 2:
+        continue
+      mean = float(sum(values)) / count
+      stddev = math.sqrt(sum((value - mean) ** 2 for value in values) / (count - 1))
+      rows.append((build_id, testname, datapoint_id, checkpoint, count, mean, stddev, min(values), max(values)))
+  try:
+    cur.execute("DELETE FROM benchtester_variance WHERE build_id = ?", (build_id,))
+    cur.executemany("INSERT INTO benchtester_variance(build_id, test_name, datapoint_id, checkpoint, "
+                    "                                 runs, mean, stddev, min, max) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    sqlite.commit()
+  except:
+    sqlite.rollback()
+    raise
+  return len(rows)
+
+##
+## Identical build handling
+##
+
+# Records the content hash of a tested build. Returns False if the build isn't
+# in the database.
+def record_build_hash(sqlite, buildname, contenthash):
+  migrate(sqlite)
+  cur = sqlite.cursor()
+  build_id = _find_build(cur, buildname)
+  if build_id is None:
+    return False
+  cur.execute("INSERT OR REPLACE INTO benchtester_build_hashes(build_id, hash) "
+              "VALUES (?, ?)", (build_id, contenthash))
+  sqlite.commit()
+  return True
+
+# Finds another build with the given content hash that has successful results
+# for every test in testnames (or any test, if testnames is empty). Returns
+# (build id, build name) or None.
+def find_identical_build(sqlite, buildname, contenthash, testnames=None):
+  migrate(sqlite)
+  cur = sqlite.cursor()
+  cur.execute("SELECT b.id, b.name FROM benchtester_build_hashes h "
+              "JOIN benchtester_builds b ON b.id = h.build_id "
+              "WHERE h.hash = ? ORDER BY b.id DESC", (contenthash,))
+  for build_id, name in cur.fetchall():
+    if name.startswith(buildname) or buildname.startswith(name):
+      continue
+    cur.execute("SELECT DISTINCT name FROM benchtester_tests "
+                "WHERE build_id = ? AND successful", (build_id,))
+    tested = set(x[0] for x in cur.fetchall())
+    if len(tested) and set(testnames or []).issubset(tested):
+      return (build_id, name)
+  return None
+
+# Copies the latest successful run of each test of the source build to the
+# named build, creating it if needed, and records where the copies came from.
+# Returns the names of the tests copied.
+def copy_build_results(sqlite, source_build_id, buildname, buildtime, contenthash=None):
+  migrate(sqlite)
+  cur = sqlite.cursor()
+  cur.execute("SELECT time FROM benchtester_builds WHERE id = ?", (source_build_id,))
+  # The source build's shard is read from through the shard views
+  schema = get_results_schemas(sqlite, [ buildtime, cur.fetchone()[0] ])[0]
+  try:
+    build_id = _find_build(cur, buildname)
+    if build_id is None:
+      cur.execute("INSERT INTO benchtester_builds(name, time) VALUES (?, ?)",
+                  (buildname, int(buildtime)))
+      build_id = cur.lastrowid
+    cur.execute("SELECT MAX(id), name FROM benchtester_tests "
+                "WHERE build_id = ? AND successful GROUP BY name",
+                (source_build_id,))
+    copied = []
+    for source_test_id, testname in cur.fetchall():
+      cur.execute("INSERT INTO benchtester_tests(name, time, build_id, successful) "
+                  "VALUES (?, ?, ?, 1)", (testname, int(time.time()), build_id))
+      test_id = cur.lastrowid
+      cur.execute("INSERT INTO %s.benchtester_data "
+                  "SELECT ?, datapoint_id, value, meta FROM benchtester_data "
+                  "WHERE test_id = ?" % (schema,), (test_id, source_test_id))
+      cur.execute("INSERT INTO %s.benchtester_aggregates "
+                  "SELECT ?, datapoint_id, checkpoint, count, min, max, mean, median "
+                  "FROM benchtester_aggregates WHERE test_id = ?" % (schema,), (test_id, source_test_id))
+      cur.execute("INSERT INTO benchtester_test_copies(test_id, source_test_id) "
+                  "VALUES (?, ?)", (test_id, source_test_id))
+      copied.append(testname)
+    if contenthash:
+      cur.execute("INSERT OR REPLACE INTO benchtester_build_hashes(build_id, hash) "
+                  "VALUES (?, ?)", (build_id, contenthash))
+    sqlite.commit()
+  except:
+    sqlite.rollback()
+    raise
+  return copied
+
 # TODO:
 # - doxygen or at least some sort of documentation
 # - Add indexes to sqlitedb by default
@@ -79,6 +1106,10 @@ class BenchTest():
   def info(self, msg):
     return self.tester.info("[%s] %s" % (self.name, msg))
 
+# Errors recorded by every tester in this process, so that a harness running
+# testers through a hook (BatchTester) can report why they failed
+gProcessErrors = []
+
 # The main class for running tests
 class BenchTester():
 
@@ -87,6 +1118,7 @@ class BenchTester():
 
   def error(self, msg):
     self.errors.append(msg)
+    gProcessErrors.append(msg)
     self.log('error', msg)
     return False
 
@@ -114,7 +1146,7 @@ class BenchTester():
       return self.error("run_test() called before setup")
 
     # make sure a record is created, even if no testdata is produced
-    if not self._open_db():
+    if self.collected is None and not self.args.get('spool_only') and not self._open_db() and not self.args.get('spool'):
       return self.error("Failed to open sqlite database")
 
     if self.modules.has_key(testtype):
@@ -123,6 +1155,94 @@ class BenchTester():
     else:
       return self.error("Test '%s' is of unknown type '%s'" % (testname, testtype))
 
+  # Runs a list of independent tests, [ (testname, testtype, testvars), ... ],
+  # up to concurrency of them at once, each in a child process of its own.
+  # Each concurrently running test has a slot, which picks its DISPLAY from
+  # displays, if given, and a temporary directory for its profile, and is
+  # visible to modules as self.tester.slot. The results of all tests are
+  # stored together, in one transaction, once they have all finished.
+  # concurrency and displays default to --concurrency and --displays.
+  # Returns [ (testname, succeeded, seconds), ... ] in the order of tests, or
+  # False if the tests couldn't be run.
+  def run_tests(self, tests, concurrency=None, displays=None):
+    if not self.ready:
+      return self.error("run_tests() called before setup")
+    concurrency = max(1, concurrency or self.args.get('concurrency') or 1)
+    if displays is None and self.args.get('displays'):
+      displays = self.args['displays'].split(',')
+
+    if not self.args.get('spool_only') and not self._open_db() and not self.args.get('spool'):
+      return self.error("Failed to open sqlite database")
+
+    self.info("Running %u tests, %u at a time" % (len(tests), concurrency))
+    begin = time.time()
+    pending = list(enumerate(tests))
+    free = range(concurrency)
+    # slot -> (test index, process, connection, start time)
+    running = {}
+    outcomes = [ None ] * len(tests)
+    collected = []
+    while len(pending) or len(running):
+      while len(pending) and len(free):
+        index, test = pending.pop(0)
+        slot = free.pop(0)
+        receiver, sender = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(target=self._run_test_child,
+                                       args=(sender, slot, displays, test))
+        proc.start()
+        sender.close()
+        running[slot] = (index, proc, receiver, time.time())
+        self.info("Started test '%s' in slot %u" % (test[0], slot))
+      # Results are read before joining, a child can't exit with a full pipe
+      for slot, (index, proc, receiver, started) in running.items():
+        if not receiver.poll(0.1 / len(running)):
+          if proc.is_alive():
+            continue
+          result = (self.error("Test '%s' exited without results (%s)" % (tests[index][0], proc.exitcode)),
+                    [], [], [])
+        else:
+          try:
+            result = receiver.recv()
+          except EOFError:
+            result = (self.error("Test '%s' exited without results" % (tests[index][0],)), [], [], [])
+        proc.join()
+        receiver.close()
+        succeeded, results, errors, warnings = result
+        self.errors.extend(errors)
+        gProcessErrors.extend(errors)
+        self.warnings.extend(warnings)
+        collected.extend(results)
+        outcomes[index] = (tests[index][0], bool(succeeded), time.time() - started)
+        self.info("Test '%s' %s in %.02fs" % (outcomes[index][0], "finished" if succeeded else "failed",
+                                             outcomes[index][2]))
+        del running[slot]
+        free.append(slot)
+
+    self.info("Ran %u tests in %.02fs" % (len(tests), time.time() - begin))
+    if len(collected) and not self._store_results(collected):
+      return False
+    return outcomes
+
+  def _run_test_child(self, sender, slot, displays, test):
+    self.slot = slot
+    if displays:
+      os.environ['DISPLAY'] = displays[slot % len(displays)]
+    tempfile.tempdir = os.path.join(tempfile.gettempdir(), "benchtester-slot-%u" % (slot,))
+    if not os.path.exists(tempfile.tempdir):
+      os.makedirs(tempfile.tempdir)
+    # Results are sent back rather than written, the parent's database
+    # connection mustn't be used from another process
+    self.collected = []
+    self.errors = []
+    self.warnings = []
+    testname, testtype, testvars = test
+    try:
+      succeeded = self.run_test(testname, testtype, testvars)
+    except Exception, e:
+      succeeded = self.error("Test '%s' raised %s: %s" % (testname, type(e), e))
+    sender.send((succeeded, self.collected, self.errors, self.warnings))
+    sender.close()
+
   # Modules are named 'SomeModule.py' and have a class named 'SomeModule' based on BenchTest
   def load_module(self, modname):
     if self.ready:
@@ -142,9 +1262,11 @@ class BenchTester():
   # datapoints a list of the format [ [ "key", value, "meta"], ... ].
   # Duplicate keys are allowed. Value is numeric and required, meta is an
   # optional string (see db format)
+  # If --spool is set, results that can't be written to the database are
+  # spooled instead, see spool_test_results.
   def add_test_results(self, testname, datapoints, succeeded=True):
     # Ensure DB is open
-    if not self._open_db():
+    if self.collected is None and not self.args.get('spool_only') and not self._open_db() and not self.args.get('spool'):
       return self.error("Failed to open sqlite database")
 
     if not testname or not len(datapoints):
@@ -154,38 +1276,43 @@ class BenchTester():
 
     #for datapoint, val in datapoints.iteritems():
     #  self.info("Datapoint: Test '%s', Datapoint '%s', Value '%s'" % (testname, datapoint, val))
+    if self.collected is not None:
+      # Running under run_tests, which stores results once all tests are done
+      self.collected.append((testname, timestamp, datapoints, succeeded))
+      return True
+    return self._store_results([ (testname, timestamp, datapoints, succeeded) ])
+
+  # Writes [ (testname, timestamp, datapoints, succeeded), ... ] to the
+  # database in one transaction, or spools them if that fails and --spool is
+  # set
+  def _store_results(self, runs):
     if self.sqlite:
       try:
         cur = self.sqlite.cursor()
-        cur.execute("INSERT INTO "
-                    "  benchtester_tests(name, time, build_id, successful) "
-                    "VALUES (?, ?, ?, ?)",
-                    (testname, int(timestamp), self.build_id, succeeded))
-        cur.execute("SELECT last_insert_rowid()")
-        testid = cur.fetchone()[0]
-        insertbegin = time.time()
-        self.info("Inserting %u datapoints into DB" % len(datapoints))
-        cur.executemany("INSERT OR IGNORE INTO `benchtester_datapoints`(name) "
-                        "VALUES (?)",
-                        ([ datapoint[0] ] for datapoint in datapoints))
-        self.sqlite.commit()
-        self.info("Filled datapoint names in %.02fs" % (time.time() - insertbegin))
-        insertbegin = time.time()
-        # If val is a list, it is interpreted as [ value, meta ]
-        cur.executemany("INSERT INTO `benchtester_data` "
-                        "SELECT ?, p.id, ?, ? FROM `benchtester_datapoints` p "
-                        "WHERE p.name = ?",
-                        ( [ testid,
-                            dp[1],
-                            dp[2] if len(dp) > 2 else None,
-                            dp[0] ]
-                          for dp in datapoints ))
+        for testname, timestamp, datapoints, succeeded in runs:
+          insert_test_results(cur, self.build_id, testname, timestamp, datapoints,
+                              succeeded, self.results_schema, self.info)
         self.sqlite.commit()
-        self.info("Filled datapoint values in %.02fs" % (time.time() - insertbegin))
+        return True
       except Exception, e:
-        self.error("Failed to insert data into sqlite, got '%s': %s" % (type(e), e))
         self.sqlite.rollback()
-        return False
+        if not self.args.get('spool'):
+          return self.error("Failed to insert data into sqlite, got '%s': %s" % (type(e), e))
+        self.warn("Failed to insert data into sqlite, got '%s': %s" % (type(e), e))
+    if self.args.get('spool'):
+      spooled = [ self._spool_results(*run) for run in runs ]
+      return all(spooled)
+    return True
+
+  def _spool_results(self, testname, timestamp, datapoints, succeeded):
+    if not self.buildname or not self.buildtime:
+      return self.error("Cannot spool results without a buildname and buildtime set")
+    try:
+      path = spool_test_results(self.args['spool'], self.buildname, self.buildtime,
+                                testname, timestamp, datapoints, succeeded)
+    except Exception, e:
+      return self.error("Failed to spool results to '%s': %s - %s" % (self.args['spool'], type(e), e))
+    self.info("Spooled %u datapoints to %s" % (len(datapoints), path))
     return True
 
   def __init__(self, out=sys.stdout):
@@ -200,6 +1327,12 @@ class BenchTester():
     self.buildtime = None
     self.buildname = None
     self.sqlite = False
+    # Where results are written, see get_results_schema
+    self.results_schema = 'main'
+    # Results held for run_tests rather than written, in its child processes
+    self.collected = None
+    # The run_tests slot of a child process
+    self.slot = None
     self.errors = []
     self.warnings = []
 
@@ -218,6 +1351,15 @@ class BenchTester():
                                                      action='append')
     self.add_argument('-l', '--logfile',             help='Log to given file')
     self.add_argument('-s', '--sqlitedb',            help='Merge datapoint into specified sqlite database')
+    self.add_argument('--sqlite-timeout',            help='Seconds to wait for a lock on the sqlite database before giving up',
+                                                     type=float, default=900)
+    self.add_argument('--spool',                     help='Directory to spool results to if they can\'t be written to the sqlite \
+                                                           database, to be loaded later with BenchDB.py merge-spool')
+    self.add_argument('--spool-only',                help='Always spool results, without touching the sqlite database',
+                                                     action='store_true')
+    self.add_argument('--concurrency',               help='Number of tests run_tests runs at once', type=int, default=1)
+    self.add_argument('--displays',                  help='Comma separated X displays for the tests run_tests runs at once \
+                                                           to use, e.g. :1,:2')
 
     self.info("BenchTester instantiated")
 
@@ -257,35 +1399,26 @@ class BenchTester():
     if not self.args['sqlitedb'] or self.sqlite: return True
 
     self.info("Setting up SQLite")
+    # Failures aren't fatal if results can be spooled instead
+    error = self.warn if self.args.get('spool') else self.error
     if not self.buildname or not self.buildtime:
-      self.error("Cannot use db without a buildname and buildtime set")
+      error("Cannot use db without a buildname and buildtime set")
       self.sqlitedb = self.args['sqlitedb'] = None
       return False
     try:
       sql_path = os.path.abspath(self.args['sqlitedb'])
-      self.sqlite = sqlite3.connect(sql_path, timeout=900)
-      cur = self.sqlite.cursor()
-      for schema in gTableSchemas:
-        cur.execute(schema)
+      self.sqlite = sqlite3.connect(sql_path, timeout=self.args.get('sqlite_timeout', 900))
+      migrate(self.sqlite, log=self.info)
       # Create/update build ID
-      cur.execute("SELECT `time`, `id` FROM `benchtester_builds` WHERE `name` = ?", [ self.buildname ])
-      buildrow = cur.fetchone()
-
-      if buildrow and buildrow[0] != int(self.buildtime):
-        self.warn("Build '%s' already exists in the database, but with a differing timestamp. Overwriting old record (%s -> %s)" % (self.buildname, buildrow[0], self.buildtime))
-        cur.execute("UPDATE `benchtester_builds` SET `time` = ? WHERE `id` = ?", [ int(self.buildtime), buildrow[1] ])
-        self.build_id = buildrow[1]
-      elif not buildrow:
-        self.info("Creating new build record")
-        cur.execute("INSERT INTO `benchtester_builds` (`name`, `time`) VALUES (?, ?)", (self.buildname, int(self.buildtime)))
-        cur.execute("SELECT last_insert_rowid()")
-        self.build_id = cur.fetchone()[0]
-      else:
-        self.build_id = buildrow[1]
-        self.info("Found build record")
+      self.build_id = _get_build_id(self.sqlite.cursor(), self.buildname, self.buildtime, self.warn)
+      self.info("Using build record %u" % (self.build_id,))
       self.sqlite.commit()
+      self.results_schema = get_results_schema(self.sqlite, self.buildtime)
+      if self.results_schema != 'main':
+        self.info("Writing results to shard %s" % (_db_path(self.sqlite, self.results_schema),))
     except Exception, e:
-      self.error("Failed to setup sqliteDB '%s': %s - %s\n" % (self.args['sqlitedb'], type(e), e))
+      error("Failed to setup sqliteDB '%s': %s - %s\n" % (self.args['sqlitedb'], type(e), e))
+      self.sqlite = False
       self.sqlitedb = self.args['sqlitedb'] = None
       return False
 
@@ -293,6 +1426,10 @@ class BenchTester():
 
   def setup(self, args):
     self.info("Performing setup")
+    # Imported here rather than with the module, as it is slow to import and
+    # only needed to run tests, not by the many tools that use this module for
+    # its database helpers
+    import mercurial, mercurial.ui, mercurial.hg, mercurial.commands
     self.hg_ui = mercurial.ui.ui()
 
     # args will already contain defaults from add_argument calls
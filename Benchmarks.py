@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012 Mozilla Corporation
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Benchmarks for the performance sensitive paths of the tester, run against
+# synthetic data shaped like real endurance test results. Run with --help for
+# the list of benchmarks.
+
+import os
+import sys
+import time
+import random
+import re
+import argparse
+import sqlite3
+import subprocess
+import multiprocessing
+
+import BenchTester
+import EnduranceTest
+
+output = sys.stdout
+
+gCheckpoints = [ 'Start', 'StartSettled', 'TabsOpen', 'TabsOpenSettled',
+                 'TabsOpenForceGC', 'TabsClosed', 'TabsClosedSettled',
+                 'TabsClosedForceGC' ]
+
+def _stat(msg):
+  output.write("[Benchmarks] %s\n" % msg)
+
+# Times fn over repeat runs, returning the median time
+def _time(fn, repeat):
+  times = []
+  for x in range(repeat):
+    begin = time.time()
+    fn()
+    times.append(time.time() - begin)
+  times.sort()
+  return times[len(times) // 2]
+
+# Datapoints of a synthetic test, as add_test_results takes them: every
+# datapoint at every checkpoint of every iteration, with some drift per build
+def synthetic_results(build, datapoints, checkpoints, iterations):
+  rnd = random.Random(build)
+  ret = []
+  for iteration in range(iterations):
+    for checkpoint in gCheckpoints[:checkpoints]:
+      meta = "%s:%u" % (checkpoint, iteration)
+      for x in range(datapoints):
+        name = "explicit/heap-%u/node-%u/leaf-%u" % (x % 7, x % 97, x)
+        ret.append([ name, int((x + 1) * 4096 * (1 + build * 0.001) * rnd.uniform(0.95, 1.05)), meta ])
+  return ret
+
+# Creates a results database at path with one test run against each of builds
+# synthetic builds, named build0..buildN, unless it already exists
+def synthetic_db(path, builds, datapoints, checkpoints, iterations, testname='Endurance'):
+  if os.path.exists(path):
+    _stat("Using existing database %s" % (path,))
+    return
+  _stat("Creating %s: %u builds of %u rows" % (path, builds, datapoints * checkpoints * iterations))
+  devnull = open(os.devnull, 'w')
+  for build in range(builds):
+    tester = BenchTester.BenchTester(out=devnull)
+    tester.args['sqlitedb'] = path
+    tester.buildname = "build%u" % (build,)
+    tester.buildtime = str(1300000000 + build * 3600)
+    if not tester.add_test_results(testname, synthetic_results(build, datapoints, checkpoints, iterations)):
+      raise Exception("Failed to create synthetic database: %s" % (tester.errors,))
+  devnull.close()
+
+# Creates a database at path with only the original schema (gTableSchemas) and
+# the raw data of builds synthetic tests, bulk inserted, unless it already
+# exists. Used to measure migrations against databases of a realistic size.
+def synthetic_baseline_db(path, builds, datapoints, checkpoints, iterations, testname='Endurance'):
+  if os.path.exists(path):
+    _stat("Using existing database %s" % (path,))
+    return
+  _stat("Creating %s at the baseline schema: %u builds of %u rows" % (path, builds, datapoints * checkpoints * iterations))
+  sqlite = sqlite3.connect(path)
+  cur = sqlite.cursor()
+  for schema in BenchTester.gTableSchemas:
+    cur.execute(schema)
+  ids = {}
+  for build in range(builds):
+    cur.execute("INSERT INTO benchtester_builds(name, time) VALUES (?, ?)",
+                ("build%u" % (build,), 1300000000 + build * 3600))
+    cur.execute("INSERT INTO benchtester_tests(name, time, build_id, successful) VALUES (?, ?, ?, 1)",
+                (testname, 1300000000 + build * 3600, cur.lastrowid))
+    test_id = cur.lastrowid
+    rows = synthetic_results(build, datapoints, checkpoints, iterations)
+    for row in rows:
+      if row[0] not in ids:
+        cur.execute("INSERT INTO benchtester_datapoints(name) VALUES (?)", (row[0],))
+        ids[row[0]] = cur.lastrowid
+    cur.executemany("INSERT INTO benchtester_data VALUES (?, ?, ?, ?)",
+                    ( (test_id, ids[row[0]], row[1], row[2]) for row in rows ))
+    sqlite.commit()
+  sqlite.close()
+
+# Endurance results as the endurance test sends them: entries memory reporter
+# values per checkpoint, some with units, and iterations in order
+def synthetic_endurance_results(iterations, checkpoints, entries):
+  rnd = random.Random(0)
+  ret = { 'iterations': [] }
+  for iteration in range(iterations):
+    ret['iterations'].append({ 'checkpoints': [] })
+    for checkpoint in gCheckpoints[:checkpoints]:
+      memory = {}
+      for x in range(entries):
+        name = "explicit/heap-%u/node-%u/leaf-%u" % (x % 7, x % 97, x)
+        if x % 50 == 0:
+          memory[name] = { 'unit': 'cnt', 'val': rnd.randint(0, 1000) }
+        else:
+          memory[name] = rnd.randint(0, 1 << 24)
+      ret['iterations'][-1]['checkpoints'].append({ 'label': "%s [i:%u e:5]" % (checkpoint, iteration),
+                                                    'memory': memory })
+  return ret
+
+# The list per row flattening EnduranceTest did before EnduranceResults, to
+# compare against
+def _flatten_lists(endurance_results):
+  results = list()
+  for iteration in endurance_results['iterations']:
+    for checkpoint in iteration['checkpoints']:
+      label_re = re.match("^(.+) \[i:(\d+) e:\d+\]$", checkpoint['label'])
+      if not label_re:
+        continue
+      iternum = int(label_re.group(2))
+      label = label_re.group(1)
+      for memtype,memval in checkpoint['memory'].items():
+        if type(memval) is dict:
+          prefix = memval['unit'] + ":"
+          memval = memval['val']
+        else:
+          prefix = ""
+        results.append([ "%s%s" % (prefix, memtype), memval, "%s:%u" % (label, iternum) ])
+  return results
+
+##
+## Benchmarks
+##
+
+def bench_flatten(args):
+  results = synthetic_endurance_results(args.iterations, args.checkpoints, args.entries)
+  rows = args.iterations * args.checkpoints * args.entries
+  _stat("%u iterations of %u checkpoints of %u entries, %u rows" % (args.iterations, args.checkpoints, args.entries, rows))
+
+  lists = _flatten_lists(results)
+  # Rows and their strings, not counting the names shared with the input
+  size = sys.getsizeof(lists) + sum(sys.getsizeof(row) + sys.getsizeof(row[2]) for row in lists)
+  size += sum(sys.getsizeof(row[0]) for row in lists if row[0].startswith('cnt:'))
+  del lists
+  _stat("lists: %.03fs, ~%.1fMiB" % (_time(lambda: _flatten_lists(results), args.repeat), size / 1048576.0))
+
+  flattened = EnduranceTest.flatten_endurance_results(results)
+  size = (flattened.name_ids.buffer_info()[1] * flattened.name_ids.itemsize +
+          flattened.values.buffer_info()[1] * flattened.values.itemsize)
+  _stat("EnduranceResults: %.03fs, ~%.1fMiB" % (_time(lambda: EnduranceTest.flatten_endurance_results(results), args.repeat),
+                                                size / 1048576.0))
+  def iterate():
+    for row in flattened:
+      pass
+  _stat("Iterating EnduranceResults rows: %.03fs" % (_time(iterate, args.repeat),))
+
+
+def bench_migrations(args):
+  synthetic_baseline_db(args.db, args.builds, args.datapoints, args.checkpoints, args.iterations)
+  sqlite = BenchTester.open_results_db(args.db)
+  version = BenchTester.get_schema_version(sqlite)
+  if version:
+    _stat("Database is already at schema version %u, only later migrations are measured" % (version,))
+  cur = sqlite.cursor()
+  aggregated = False
+  for migration, description, statements in BenchTester.gMigrations:
+    if migration <= version:
+      continue
+    begin = time.time()
+    BenchTester.migrate(sqlite, target=migration)
+    _stat("Migration %u (%s): %.02fs (including ANALYZE)" % (migration, description, time.time() - begin))
+    # Fill in aggregates as soon as the table exists, so the migrations that
+    # index it are measured against a realistically sized table
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'benchtester_aggregates'")
+    if not aggregated and cur.fetchone():
+      begin = time.time()
+      # Not rebuild_aggregates(), which would apply the remaining migrations
+      cur.execute("SELECT id FROM benchtester_tests")
+      for (test_id,) in cur.fetchall():
+        BenchTester._rebuild_test_aggregates(cur, test_id)
+      sqlite.commit()
+      _stat("Aggregating baseline data: %.02fs" % (time.time() - begin,))
+      aggregated = True
+
+  # The hot queries the migrations' indexes are meant for
+  cur.execute("SELECT id FROM benchtester_datapoints ORDER BY id LIMIT 1")
+  datapoint_id = cur.fetchone()[0]
+  def series():
+    cur.execute("SELECT b.time, a.checkpoint, a.median FROM benchtester_aggregates a "
+                "JOIN benchtester_tests t ON t.id = a.test_id "
+                "JOIN benchtester_builds b ON b.id = t.build_id "
+                "WHERE a.datapoint_id = ? AND t.name = 'Endurance' AND t.successful "
+                "ORDER BY b.time", (datapoint_id,))
+    return cur.fetchall()
+  _stat("Series of one datapoint: %.04fs" % (_time(series, args.repeat),))
+  def latest():
+    cur.execute("SELECT b.name FROM benchtester_builds b WHERE EXISTS "
+                "  (SELECT 1 FROM benchtester_tests t WHERE t.build_id = b.id AND t.successful) "
+                "ORDER BY b.time DESC LIMIT 1")
+    return cur.fetchall()
+  _stat("Latest tested build: %.04fs" % (_time(latest, args.repeat),))
+  def diff():
+    return BenchTester.diff_builds(sqlite, 'Endurance', [ "build0" ], [ "build%u" % (args.builds - 1,) ])
+  _stat("Diff of first and last builds: %.04fs" % (_time(diff, args.repeat),))
+
+
+def bench_diff(args):
+  synthetic_db(args.db, args.builds, args.datapoints, args.checkpoints, args.iterations)
+  sqlite = BenchTester.open_results_db(args.db)
+  first, last = "build0", "build%u" % (args.builds - 1,)
+  def run():
+    return BenchTester.diff_builds(sqlite, 'Endurance', [ first ], [ last ])
+  count = len(run())
+  _stat("diff %s -> %s: %u datapoints in %.03fs" % (first, last, count, _time(run, args.repeat)))
+  half = args.builds // 2
+  sets = ([ "build%u" % x for x in range(half) ], [ "build%u" % x for x in range(half, args.builds) ])
+  def runsets():
+    BenchTester.diff_builds(sqlite, 'Endurance', sets[0], sets[1])
+  _stat("diff of two sets of %u builds: %.03fs" % (half, _time(runsets, args.repeat)))
+
+# Modules that are slow to import, and which the tester's entry points should
+# only import when they need them
+gHeavyModules = [ 'mercurial', 'mozmill', 'numpy' ]
+
+# Pool task for bench_startup, importing the hook if there is one as a test
+# would
+def _worker_task(hook):
+  if hook:
+    import BatchTester
+    BatchTester._get_hook(hook)
+  return os.getpid()
+
+def bench_startup(args):
+  here = os.path.dirname(os.path.abspath(__file__))
+  def python(*argv):
+    devnull = open(os.devnull, 'w')
+    try:
+      subprocess.check_call([ sys.executable ] + list(argv), cwd=here, stdout=devnull)
+    finally:
+      devnull.close()
+  hookargs = [ '--hook', os.path.abspath(args.hook) ] if args.hook else []
+
+  for module in [ 'BenchTester', 'BatchTester' ]:
+    _stat("import %s: %.03fs" % (module, _time(lambda: python('-c', 'import %s' % (module,)), args.repeat)))
+    loaded = subprocess.check_output([ sys.executable, '-c',
+                                       "import sys, %s; print ' '.join(x for x in %r if x in sys.modules)"
+                                       % (module, gHeavyModules) ], cwd=here).strip()
+    if loaded:
+      _stat("  importing %s also imports %s" % (module, loaded))
+  _stat("BenchTester.py --help: %.03fs" % (_time(lambda: python('BenchTester.py', '--help'), args.repeat),))
+  _stat("BatchTester.py --help: %.03fs" % (_time(lambda: python(*[ 'BatchTester.py', '--help' ] + hookargs), args.repeat),))
+
+  # BatchTest runs each test in a new pool worker, forked from the tester
+  if args.hook:
+    import BatchTester
+    BatchTester._get_hook(args.hook)
+  pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+  try:
+    _stat("Spawning a worker: %.04fs" % (_time(lambda: pool.apply(_worker_task, [ args.hook ]), args.repeat),))
+  finally:
+    pool.close()
+    pool.join()
+
+# Runs the autotuner against a simulated throughput curve, a rate in tests per
+# hour for each number of slots, with the host never overloaded and no noise.
+# Raises if, once past the first half of the windows, it does anything but
+# hold at the fastest setting, probing away from it for a window at a time
+# once it has held for Autotuner.explore windows.
+def bench_autotune(args):
+  import BatchTester
+  curve = dict((int(slots), float(rate)) for slots, rate in
+               (x.split(':') for x in args.curve.split(',')))
+  tuner = BatchTester.Autotuner(min(curve), max(curve), args.window, 1.0, 1.0)
+  tuner.load = lambda: None
+  visited = []
+  for x in range(args.windows):
+    slots = tuner.slots
+    visited.append(slots)
+    for test in range(max(args.window, slots)):
+      tuner.record()
+    # Backdate the window to the length it would have taken at this rate
+    tuner.window_start = time.time() - tuner.finished * 3600.0 / curve[slots]
+    tuner.step()
+  _stat("Slots of each window: %s" % (' '.join(str(x) for x in visited),))
+  peak = max(curve, key=lambda x: curve[x])
+  late = visited[len(visited) // 2:]
+  probes = [ x for x in range(len(late)) if late[x] != peak ]
+  if peak not in late or any(b - a <= tuner.explore for a, b in zip(probes, probes[1:])):
+    raise Exception("Autotuner didn't settle at %u slots" % (peak,))
+  _stat("Settled at %u slots, probing %u times in the last %u windows" % (peak, len(probes), len(late)))
+
+#
+# Main
+#
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the tester against synthetic data')
+  benchmarks = parser.add_subparsers()
+
+  def add_db_arguments(cmd):
+    cmd.add_argument('--db', default='benchmark.sqlite', help='Synthetic database to use, created if it does not exist')
+    cmd.add_argument('--builds', type=int, default=10, help='Builds in the synthetic database')
+    cmd.add_argument('--datapoints', type=int, default=5000, help='Datapoints per checkpoint')
+    cmd.add_argument('--checkpoints', type=int, default=len(gCheckpoints), help='Checkpoints per iteration')
+    cmd.add_argument('--iterations', type=int, default=3, help='Iterations per test')
+    cmd.add_argument('--repeat', type=int, default=5, help='Times to repeat each measurement')
+
+  cmd = benchmarks.add_parser('autotune', help='Check the --autotune hill climbing settles at the peak of a simulated throughput curve')
+  cmd.add_argument('--curve', default='1:50,2:80,3:100,4:80,5:60,6:50', help='Comma separated SLOTS:TESTS_PER_HOUR of the simulated host')
+  cmd.add_argument('--window', type=int, default=6, help='Tests per window, as --autotune-window')
+  cmd.add_argument('--windows', type=int, default=60, help='Windows to simulate')
+  cmd.set_defaults(benchmark=bench_autotune)
+
+  cmd = benchmarks.add_parser('diff', help='Time BenchTester.diff_builds between builds and sets of builds')
+  add_db_arguments(cmd)
+  cmd.set_defaults(benchmark=bench_diff)
+
+  cmd = benchmarks.add_parser('flatten', help='Time flattening endurance results into rows, and the memory the rows take')
+  cmd.add_argument('--iterations', type=int, default=5, help='Iterations of the endurance test')
+  cmd.add_argument('--checkpoints', type=int, default=len(gCheckpoints), help='Checkpoints per iteration')
+  cmd.add_argument('--entries', type=int, default=5000, help='Memory reporter entries per checkpoint')
+  cmd.add_argument('--repeat', type=int, default=5, help='Times to repeat each measurement')
+  cmd.set_defaults(benchmark=bench_flatten)
+
+  cmd = benchmarks.add_parser('migrations', help='Time each schema migration, and the queries they speed up, against a synthetic database at the baseline schema')
+  add_db_arguments(cmd)
+  cmd.set_defaults(benchmark=bench_migrations)
+
+  cmd = benchmarks.add_parser('startup', help='Time importing the tester modules, their --help, and starting a test worker')
+  cmd.add_argument('--hook', help='A BatchTester --hook to include, as the batch tester would import it')
+  cmd.add_argument('--repeat', type=int, default=5, help='Times to repeat each measurement')
+  cmd.set_defaults(benchmark=bench_startup)
+
+  args = parser.parse_args()
+  args.benchmark(args)
@@ -12,6 +12,7 @@
 
 import os
 import sys
+import errno
 import ftplib
 import time
 import re
@@ -25,11 +26,36 @@ import subprocess
 import json
 import urllib
 import urllib2
+import hashlib
+import zipfile
 
 gDefaultBranch = 'integration/mozilla-inbound'
 gPushlog = 'https://hg.mozilla.org/%s/json-pushes'
 output = sys.stdout
 
+# Files, relative to the directory containing the binary, that make up a build
+# for the purposes of Build.get_content_hash(). application.ini/platform.ini
+# are left out as they always differ by revision.
+gContentFiles = [ 'firefox', 'libxul.so', 'omni.ja', 'browser/omni.ja' ]
+
+# Keys of application.ini/platform.ini whose values are stamped into the
+# gContentFiles of every build, and are masked out of the content hash so
+# builds of the same code from different pushes hash the same
+gStampKeys = [ 'BuildID', 'SourceStamp' ]
+
+# Compiler caches CompileBuild can wrap the compilers with. 'dirvar' is the
+# environment variable selecting the cache directory, 'zero' resets the cache's
+# counters before a build, and 'stats' dumps them in a machine-readable format
+# afterwards, which _compiler_cache_command understands.
+gCompilerCaches = {
+  'ccache': { 'dirvar': 'CCACHE_DIR',
+              'zero': [ 'ccache', '-z' ],
+              'stats': [ 'ccache', '--print-stats' ] },
+  'sccache': { 'dirvar': 'SCCACHE_DIR',
+               'zero': [ 'sccache', '--zero-stats' ],
+               'stats': [ 'sccache', '--show-stats', '--stats-format', 'json' ] }
+}
+
 # TODO
 # This currently selects the linux-64 (non-pgo) build
 # hardcoded at a few spots. This will need to be changed for non-linux testing
@@ -61,10 +87,170 @@ def _subprocess(environment, command, cwd, logfile):
 
   return proc.wait()
 
+# Returns the environment that wraps the compilers with the given cache (one of
+# gCompilerCaches), or an empty dict if cache is None
+def _compiler_cache_env(cache, cachedir=None):
+  if not cache:
+    return {}
+  if cache not in gCompilerCaches:
+    raise Exception("Unknown compiler cache '%s'" % (cache,))
+  # Mozconfigs that set CC/CXX themselves will override these, they should use
+  # ac_add_options --with-ccache instead
+  env = { 'CC': "%s %s" % (cache, os.environ.get('CC', 'gcc')),
+          'CXX': "%s %s" % (cache, os.environ.get('CXX', 'g++')) }
+  if cachedir:
+    env[gCompilerCaches[cache]['dirvar']] = os.path.abspath(cachedir)
+  return env
+
+# Runs the given cache's 'zero' or 'stats' command. For 'stats', returns a
+# dict of { 'hits', 'misses', 'hit_rate' }, or None if they couldn't be read
+def _compiler_cache_command(cache, command, environment):
+  newenv = os.environ.copy()
+  newenv.update(environment)
+  try:
+    proc = subprocess.Popen(gCompilerCaches[cache][command],
+                            env=newenv,
+                            stderr=subprocess.STDOUT,
+                            stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+  except OSError as e:
+    _stat("WARN: Failed to run %s: %s" % (cache, e))
+    return None
+  if command != 'stats' or proc.returncode != 0:
+    return None
+
+  try:
+    if cache == 'ccache':
+      # ccache --print-stats is tab separated key/value lines
+      counters = dict(line.split('\t', 1) for line in out.splitlines() if '\t' in line)
+      hits = int(counters.get('direct_cache_hit', 0)) + int(counters.get('preprocessed_cache_hit', 0))
+      misses = int(counters.get('cache_miss', 0))
+    else:
+      # sccache reports either plain counts or per-language { 'counts': {} }
+      stats = json.loads(out)['stats']
+      def count(x):
+        return sum(x['counts'].values()) if type(x) is dict else int(x)
+      hits = count(stats['cache_hits'])
+      misses = count(stats['cache_misses'])
+  except (ValueError, KeyError) as e:
+    _stat("WARN: Could not parse %s statistics: %s" % (cache, e))
+    return None
+
+  total = hits + misses
+  return { 'hits': hits,
+           'misses': misses,
+           'hit_rate': float(hits) / total if total else None }
+
+##
+## Extraction directories
+##
+
+# Builds are extracted into directories under an extraction root, each with a
+# lease file naming the process that owns it, so that directories left behind
+# by a tester that crashed or was killed can be found and removed by
+# sweep_extraction_root. The owner is the process that called
+# set_extraction_root (or the extracting process, if none did), so builds
+# extracted by short lived children on behalf of a long running tester belong
+# to the tester.
+
+gExtractionRoot = None
+gLeaseOwner = None
+gLeaseFile = '.lease'
+# Directories without a readable lease are only removed once they are this
+# old, as their lease may not have been written yet
+gLeaseGrace = 60 * 60
+
+def get_extraction_root():
+  return gExtractionRoot or os.path.join(tempfile.gettempdir(), 'BuildGetter')
+
+# Sets the extraction root, or the default if path is None, and makes the
+# calling process the owner of directories extracted into it
+def set_extraction_root(path=None):
+  global gExtractionRoot, gLeaseOwner
+  gExtractionRoot = os.path.abspath(path) if path else None
+  gLeaseOwner = os.getpid()
+
+def _write_lease(directory):
+  lease = { 'pid': gLeaseOwner or os.getpid(), 'host': socket.gethostname(), 'created': time.time() }
+  f = open(os.path.join(directory, gLeaseFile), 'w')
+  try:
+    json.dump(lease, f)
+  finally:
+    f.close()
+
+def _pid_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno != errno.ESRCH
+  return True
+
+# Returns why directory is orphaned, or None if its owner may still be using it
+def _orphaned(directory):
+  try:
+    f = open(os.path.join(directory, gLeaseFile), 'r')
+    try:
+      lease = json.load(f)
+    finally:
+      f.close()
+  except (IOError, ValueError):
+    if time.time() - os.path.getmtime(directory) > gLeaseGrace:
+      return "no lease"
+    return None
+  # Processes of other hosts sharing the root can't be checked
+  if lease.get('host') != socket.gethostname():
+    return None
+  if not _pid_alive(lease['pid']):
+    return "owner %u is gone" % (lease['pid'],)
+  return None
+
+def _tree_size(path):
+  size = 0
+  for dirpath, dirnames, filenames in os.walk(path):
+    for name in filenames:
+      try:
+        size += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+      except OSError:
+        pass
+  return size
+
+# Removes the directories of the extraction root whose owner is gone. Returns
+# (directories removed, bytes reclaimed).
+def sweep_extraction_root(root=None):
+  root = root or get_extraction_root()
+  if not os.path.isdir(root):
+    return (0, 0)
+  removed = reclaimed = 0
+  for name in os.listdir(root):
+    directory = os.path.join(root, name)
+    try:
+      if not os.path.isdir(directory) or os.path.islink(directory):
+        continue
+      reason = _orphaned(directory)
+    except OSError:
+      # Removed while we looked
+      continue
+    if not reason:
+      continue
+    size = _tree_size(directory)
+    shutil.rmtree(directory, True)
+    if not os.path.exists(directory):
+      _stat("Removed orphaned extraction directory %s (%s, %.1fMiB)" % (directory, reason, size / 1048576.0))
+      removed += 1
+      reclaimed += size
+  return (removed, reclaimed)
+
 # Given a firefox build file handle, extract it to a temp directory, return that
 def _extract_build(fileobject):
+  root = get_extraction_root()
+  try:
+    os.makedirs(root)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  ret = tempfile.mkdtemp("BuildGetter_firefox", dir=root)
+  _write_lease(ret)
   # cross-platform FIXME, this is hardcoded to .tar.bz2 at the moment
-  ret = tempfile.mkdtemp("BuildGetter_firefox")
   tar = tarfile.open(fileobj=fileobject, mode='r:bz2')
   tar.extractall(path=ret)
   tar.close()
@@ -257,6 +443,42 @@ def list_tinderbox_builds(starttime = 0, endtime = int(time.time()), branch = gD
 # Build classes
 #
 
+# The values of gStampKeys in the application.ini/platform.ini in bindir
+def _build_stamps(bindir):
+  stamps = set()
+  for name in [ 'application.ini', 'platform.ini' ]:
+    path = os.path.join(bindir, name)
+    if not os.path.exists(path):
+      continue
+    f = open(path, 'r')
+    try:
+      for line in f:
+        key, sep, value = line.strip().partition('=')
+        if sep and key.strip() in gStampKeys and value.strip():
+          stamps.add(value.strip())
+    finally:
+      f.close()
+  # Longest first, in case one contains another
+  return sorted(stamps, key=len, reverse=True)
+
+# Feeds the data read from the file object f to digest, with every occurrence
+# of stamps replaced by as many NULs
+def _hash_masked(digest, f, stamps):
+  keep = max([ len(x) for x in stamps ] + [ 1 ]) - 1
+  carry = ''
+  while True:
+    data = f.read(1024 * 1024)
+    buf = carry + data
+    for stamp in stamps:
+      buf = buf.replace(stamp, '\0' * len(stamp))
+    if not data:
+      digest.update(buf)
+      return
+    # Hold back the tail, which may be the start of a stamp split across reads
+    split = len(buf) - keep
+    digest.update(buf[:split])
+    carry = buf[split:]
+
 # Abstract base class
 class Build():
   # Downloads or builds and extracts the build to a temporary directory
@@ -273,6 +495,41 @@ class Build():
   # Requires prepare()'d
   def get_binary(self):
     raise Exception("Attempt to call method on abstract base class")
+  # Requires prepare()'d. Returns a hex digest of the build's gContentFiles,
+  # which is the same for two builds only if they are byte-identical but for
+  # their build ID and source stamp (see gStampKeys). Archives are hashed by
+  # the contents of their members, leaving out the copies of
+  # application.ini/platform.ini and the members' timestamps.
+  def get_content_hash(self):
+    bindir = os.path.dirname(self.get_binary())
+    stamps = _build_stamps(bindir)
+    digest = hashlib.sha1()
+    for name in gContentFiles:
+      path = os.path.join(bindir, name)
+      if not os.path.exists(path):
+        continue
+      digest.update("%s\0" % (name,))
+      if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path, 'r')
+        try:
+          for member in sorted(archive.namelist()):
+            if os.path.basename(member) in [ 'application.ini', 'platform.ini' ]:
+              continue
+            digest.update("%s\0" % (member,))
+            f = archive.open(member)
+            try:
+              _hash_masked(digest, f, stamps)
+            finally:
+              f.close()
+        finally:
+          archive.close()
+        continue
+      f = open(path, 'rb')
+      try:
+        _hash_masked(digest, f, stamps)
+      finally:
+        f.close()
+    return digest.hexdigest()
 
 # Abstract class with shared helpers for TinderboxBuild/NightlyBuild
 class BaseFTPBuild(Build):
@@ -323,8 +580,18 @@ class BaseFTPBuild(Build):
 # pull - If true, pull before building/checking-out
 # objdir - the object directory said mozconfig will create
 # log - If set, where to put build spew
+# cache - If set, a compiler cache from gCompilerCaches to build with
+# cachedir - If set, the directory the compiler cache should use
+# clobber - When to start from a fresh object directory:
+#           'auto' - When the tree's CLOBBER file says so, or to retry a failed
+#                    build that didn't already start from a fresh objdir
+#           'always' - Before every build
+#           'never' - Never, failed builds are not retried
 class CompileBuild(Build):
-  def __init__(self, repo, mozconfig, objdir, pull=False, commit=None, log=None):
+  def __init__(self, repo, mozconfig, objdir, pull=False, commit=None, log=None,
+               cache=None, cachedir=None, clobber='auto'):
+    if clobber not in ('auto', 'always', 'never'):
+      raise Exception("Unknown clobber policy '%s'" % (clobber,))
     self._repopath = repo
     self._commit = commit
     self._mozconfig = mozconfig
@@ -334,6 +601,10 @@ class CompileBuild(Build):
     self._logfile = None
     self._checkout = True if commit else False
     self._valid = False
+    self._cache = cache
+    self._cachedir = cachedir
+    self._cache_stats = None
+    self._clobber = clobber
 
     ##
     ## Get info about commit
@@ -399,17 +670,43 @@ class CompileBuild(Build):
 
     _stat("Building")
     # Build
+    buildenv = _compiler_cache_env(self._cache, self._cachedir)
+    buildenv['MOZCONFIG'] = os.path.abspath(self._mozconfig)
+    if self._cache:
+      _compiler_cache_command(self._cache, 'zero', buildenv)
+
     def build():
-      return _subprocess({ 'MOZCONFIG' : os.path.abspath(self._mozconfig) }, [ 'make', '-f', 'client.mk' ], self._repopath, self._logfile)
+      return _subprocess(buildenv, [ 'make', '-f', 'client.mk' ], self._repopath, self._logfile)
+
+    clobbered = False
+    if os.path.exists(self._objdir) and (self._clobber == 'always' or
+                                         (self._clobber == 'auto' and self._needs_clobber())):
+      _stat("Clobbering object directory before building (policy: %s)" % (self._clobber,))
+      shutil.rmtree(self._objdir)
+      clobbered = True
 
     ret = build()
-    if ret != 0 and os.path.exists(self._objdir):
+    if ret != 0 and self._clobber == 'auto' and not clobbered and os.path.exists(self._objdir):
       _stat("Build failed, trying again with fresh object directory")
       shutil.rmtree(self._objdir)
+      clobbered = True
       ret = build()
 
+    if self._cache:
+      self._cache_stats = _compiler_cache_command(self._cache, 'stats', buildenv)
+      if self._cache_stats:
+        msg = "Compiler cache: %u hits, %u misses" % (self._cache_stats['hits'], self._cache_stats['misses'])
+        if self._cache_stats['hit_rate'] is not None:
+          msg += " (%.1f%% hit rate)" % (self._cache_stats['hit_rate'] * 100,)
+        _stat(msg)
+        if self._logfile:
+          self._logfile.write("%s\n" % (msg,))
+
     if ret != 0:
-      _stat("Build with fresh object directory failed")
+      if clobbered:
+        _stat("Build with fresh object directory failed")
+      else:
+        _stat("Build failed")
       return False
 
     _stat("Packaging")
@@ -441,12 +738,27 @@ class CompileBuild(Build):
     self._prepared = True
     return True
 
+  # The build system refuses to build in an objdir whose copy of the tree's
+  # CLOBBER file is older than the tree's, so check for that up front rather
+  # than failing a build first
+  def _needs_clobber(self):
+    srcclobber = os.path.join(self._repopath, "CLOBBER")
+    objclobber = os.path.join(self._objdir, "CLOBBER")
+    if not os.path.exists(srcclobber) or not os.path.exists(objclobber):
+      return False
+    return os.path.getmtime(srcclobber) > os.path.getmtime(objclobber)
+
   def cleanup(self):
     if self._prepared:
       shutil.rmtree(self._extracted)
       self._prepared = False
     return True
 
+  # Compiler cache hits/misses/hit_rate of the last prepare(), or None if no
+  # cache was used or its statistics were unavailable
+  def get_cache_stats(self):
+    return self._cache_stats
+
   def get_buildtime(self):
     return self._timestamp
 
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012 Mozilla Corporation
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Finds the builds at which datapoints changed, across every datapoint of a
+# test at once, from a BenchTester results database.
+#
+# Each datapoint's series is its mean value per build (over all checkpoints and
+# runs of the test against that build, read from the per-checkpoint aggregates
+# rather than the raw data, which compaction may have removed), with builds
+# ordered by build time. The series of all datapoints are held as rows of one
+# matrix, so each step of the detection is a numpy operation over the whole
+# history of a chunk of datapoints:
+# - For each build, the mean of the window of builds before it is compared to
+#   the mean of the window starting at it
+# - The difference is scored against the datapoint's noise, estimated from the
+#   median absolute difference between consecutive builds, which a handful of
+#   real changes doesn't disturb
+# - Only the highest scoring build within a window of each change is kept, as
+#   every build near a step scores highly
+#
+# ChangeDetector.update() only loads tests it hasn't seen yet, so a long running
+# detector can be kept current as add_test_results adds builds.
+#
+# Memory: the sums and counts are held as a dense matrix of 12 bytes per
+# datapoint and build, with up to as much again spare for growth (5000
+# datapoints across 2000 builds is 120MiB, up to 240MiB). Detection needs about
+# ten temporary arrays the size of the chunk of datapoints it works on, which
+# is limited to gDetectCells values.
+
+import sys
+import time
+import argparse
+import warnings
+import numpy
+
+import BenchTester
+
+output = sys.stdout
+
+# Datapoints times builds scored at once by ChangeDetector.detect(), bounding
+# its temporaries at ~10 * 8 bytes per cell
+gDetectCells = 1000000
+
+# Aggregate rows read from the database at once by ChangeDetector.update()
+gLoadRows = 100000
+
+def _stat(msg):
+  output.write("[ChangeDetector] %s\n" % msg)
+
+class ChangeDetector(object):
+  # testname - The test whose datapoints to look at
+  # datapoints - If set, a SQL LIKE pattern limiting the datapoints loaded
+  # checkpoint - If set, only values from checkpoints starting with this are
+  #              used
+  def __init__(self, sqlite, testname, datapoints=None, checkpoint=None):
+    self.sqlite = sqlite
+    self.testname = testname
+    self.datapoints = datapoints
+    self.checkpoint = checkpoint
+    # Highest test id loaded
+    self.lastid = 0
+    # Datapoint id -> matrix row, build id -> matrix column
+    self.rows = {}
+    self.columns = {}
+    self.names = []
+    self.buildnames = []
+    self.buildtimes = []
+    # Per datapoint (row) and build (column) sum and count of values. Allocated
+    # with spare capacity, only [:len(self.names), :len(self.buildnames)] is used
+    self.sums = numpy.zeros((0, 0))
+    self.counts = numpy.zeros((0, 0), dtype=numpy.int32)
+
+  def _grow(self, rows, columns):
+    have_rows, have_columns = self.sums.shape
+    if rows <= have_rows and columns <= have_columns:
+      return
+    # Only the dimension that is full gets spare capacity
+    shape = (have_rows if rows <= have_rows else max(rows, have_rows * 2),
+             have_columns if columns <= have_columns else max(columns, have_columns * 2))
+    sums = numpy.zeros(shape)
+    counts = numpy.zeros(shape, dtype=numpy.int32)
+    sums[:have_rows, :have_columns] = self.sums
+    counts[:have_rows, :have_columns] = self.counts
+    self.sums = sums
+    self.counts = counts
+
+  # Loads results of tests added since the last update. Returns the number of
+  # values loaded.
+  def update(self):
+    # Read shard by shard, as the whole history may span more shards than can
+    # be attached at once, and a chunk at a time, as it may be too much to hold
+    # as rows
+    query = ("SELECT a.datapoint_id, t.build_id, a.mean, a.count, t.id FROM main.benchtester_aggregates a "
+             "JOIN %(manifest)s.benchtester_tests t ON t.id = a.test_id ")
+    where = [ "t.name = ?", "t.successful", "t.id > ?" ]
+    params = [ self.testname, self.lastid ]
+    if self.datapoints:
+      query += "JOIN %(manifest)s.benchtester_datapoints p ON p.id = a.datapoint_id "
+      where.append("p.name LIKE ?")
+      params.append(self.datapoints)
+    if self.checkpoint:
+      where.append("substr(a.checkpoint, 1, length(?)) = ?")
+      params.extend([ self.checkpoint, self.checkpoint ])
+    loaded = 0
+    lastid = self.lastid
+    for rows in BenchTester.iterate_results(self.sqlite, query + "WHERE " + " AND ".join(where), params, gLoadRows):
+      data = numpy.array(rows, dtype=numpy.float64)
+      self._add(data)
+      loaded += int(data[:, 3].sum())
+      lastid = max(lastid, int(data[:, 4].max()))
+    # Only once everything is in, as the shards aren't read in test order
+    self.lastid = lastid
+    return loaded
+
+  # Adds rows of (datapoint id, build id, mean, count, test id) to the sums
+  def _add(self, data):
+    cur = self.sqlite.cursor()
+    datapoint_ids = data[:, 0].astype(numpy.int64)
+    build_ids = data[:, 1].astype(numpy.int64)
+
+    # Assign rows/columns to datapoints/builds we haven't seen
+    new_datapoints = [ x for x in numpy.unique(datapoint_ids) if x not in self.rows ]
+    if len(new_datapoints):
+      cur.execute("SELECT id, name FROM benchtester_datapoints WHERE id >= ?", (int(min(new_datapoints)),))
+      names = dict(cur.fetchall())
+      for x in new_datapoints:
+        self.rows[x] = len(self.names)
+        self.names.append(names[x])
+    new_builds = [ x for x in numpy.unique(build_ids) if x not in self.columns ]
+    if len(new_builds):
+      cur.execute("SELECT id, name, time FROM benchtester_builds")
+      builds = dict((x[0], x[1:]) for x in cur.fetchall())
+      for x in new_builds:
+        self.columns[x] = len(self.buildnames)
+        self.buildnames.append(builds[x][0])
+        self.buildtimes.append(builds[x][1])
+
+    self._grow(len(self.names), len(self.buildnames))
+    rows = numpy.array([ self.rows[x] for x in datapoint_ids ])
+    columns = numpy.array([ self.columns[x] for x in build_ids ])
+    numpy.add.at(self.sums, (rows, columns), data[:, 2] * data[:, 3])
+    numpy.add.at(self.counts, (rows, columns), data[:, 3].astype(numpy.int32))
+
+  # Returns the per-build means of the datapoints in rows [first, last) (all by
+  # default) as a matrix with builds in time order (NaN where a datapoint has no
+  # value for a build), and that order
+  def series(self, first=0, last=None, order=None):
+    if order is None:
+      order = numpy.argsort(numpy.array(self.buildtimes), kind='mergesort')
+    if last is None:
+      last = len(self.names)
+    sums = self.sums[first:last, order]
+    counts = self.counts[first:last, order]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+      means = numpy.where(counts > 0, sums / counts, numpy.nan)
+    return means, order
+
+  # Scores every build of every datapoint as a possible change point. Returns a
+  # list of dicts, highest score first, of changes scoring at least threshold
+  # (in units of the datapoint's noise). window is the number of builds either
+  # side of a change that are compared.
+  def detect(self, window=5, threshold=6.0, minvalues=3):
+    nbuilds = len(self.buildnames)
+    if nbuilds < 2 * minvalues:
+      return []
+    order = numpy.argsort(numpy.array(self.buildtimes), kind='mergesort')
+    chunk = max(1, gDetectCells // nbuilds)
+    ret = []
+    for first in range(0, len(self.names), chunk):
+      means, order = self.series(first, first + chunk, order)
+      ret.extend(self._detect_chunk(means, order, first, window, threshold, minvalues))
+    # Stable, so ties stay in datapoint then build order
+    ret.sort(key=lambda x: -x['score'])
+    return ret
+
+  # detect() for the datapoints of means, which start at row first
+  def _detect_chunk(self, means, order, first, window, threshold, minvalues):
+    ndatapoints, nbuilds = means.shape
+    present = ~numpy.isnan(means)
+    values = numpy.where(present, means, 0)
+
+    # Windowed sums via cumulative sums, with a leading zero column so column j
+    # is the sum of builds [0, j)
+    zeros = numpy.zeros((ndatapoints, 1))
+    csum = numpy.hstack((zeros, numpy.cumsum(values, axis=1)))
+    ccount = numpy.hstack((zeros, numpy.cumsum(present, axis=1)))
+    split = numpy.arange(nbuilds)
+    start = numpy.maximum(split - window, 0)
+    end = numpy.minimum(split + window, nbuilds)
+    nbefore = ccount[:, split] - ccount[:, start]
+    nafter = ccount[:, end] - ccount[:, split]
+    # Datapoints without two consecutive values have all-NaN steps, for which
+    # nanmedian and nanmean warn rather than set the error state
+    with numpy.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+      warnings.simplefilter('ignore', RuntimeWarning)
+      before = (csum[:, split] - csum[:, start]) / nbefore
+      after = (csum[:, end] - csum[:, split]) / nafter
+
+      # Noise, from consecutive builds that both have values
+      steps = numpy.abs(numpy.diff(means, axis=1))
+      noise = numpy.nanmedian(steps, axis=1) * 1.4826 / numpy.sqrt(2)
+      # Flat series would otherwise score infinitely for any change at all
+      noise = numpy.maximum(noise, numpy.abs(numpy.nanmean(means, axis=1)) * 1e-4)
+      score = numpy.abs(after - before) / (noise[:, None] * numpy.sqrt(1.0 / nbefore + 1.0 / nafter))
+
+    score[(nbefore < minvalues) | (nafter < minvalues) | ~present] = 0
+    score = numpy.nan_to_num(score)
+
+    # Keep only the best build within window of each change
+    peak = score >= threshold
+    for offset in range(1, window + 1):
+      peak[:, offset:] &= score[:, offset:] >= score[:, :-offset]
+      peak[:, :-offset] &= score[:, :-offset] > score[:, offset:]
+
+    rows, columns = numpy.nonzero(peak)
+    ret = []
+    for row, column in zip(rows, columns):
+      build = order[column]
+      ret.append({ 'build': self.buildnames[build],
+                   'time': self.buildtimes[build],
+                   'datapoint': self.names[first + row],
+                   'score': float(score[row, column]),
+                   'before': float(before[row, column]),
+                   'after': float(after[row, column]),
+                   'delta': float(after[row, column] - before[row, column]) })
+    return ret
+
+  # Groups changes by build, ranking builds by their highest scoring change.
+  # Returns [ (build name, time, [ changes ]), ... ]
+  @staticmethod
+  def rank_builds(changes):
+    builds = {}
+    for change in changes:
+      builds.setdefault(change['build'], (change['build'], change['time'], []))[2].append(change)
+    return sorted(builds.values(), key=lambda x: -x[2][0]['score'])
+
+#
+# Main
+#
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='List the builds at which datapoints in a results database changed')
+  parser.add_argument('sqlitedb', help='The results database')
+  parser.add_argument('testname', help='The test whose datapoints to look at')
+  parser.add_argument('--datapoints', help='A SQL LIKE pattern limiting which datapoints are loaded')
+  parser.add_argument('--checkpoint', help='Only use values from checkpoints starting with this')
+  parser.add_argument('--window', type=int, default=5, help='Number of builds either side of a change to compare')
+  parser.add_argument('--threshold', type=float, default=6.0, help='Minimum score, in multiples of a datapoint\'s noise, for a change to be listed')
+  parser.add_argument('--limit', type=int, default=20, help='Number of builds to list')
+  parser.add_argument('--follow', type=int, metavar='SECONDS', help='Keep running, loading new results and listing changes again every SECONDS')
+  args = parser.parse_args()
+
+  sqlite = BenchTester.open_results_db(args.sqlitedb)
+  if not sqlite:
+    sys.exit("No database at %s" % (args.sqlitedb,))
+  detector = ChangeDetector(sqlite, args.testname, args.datapoints, args.checkpoint)
+  while True:
+    loadstart = time.time()
+    loaded = detector.update()
+    _stat("Loaded %u values in %.02fs" % (loaded, time.time() - loadstart))
+    if loaded:
+      detectstart = time.time()
+      changes = detector.detect(args.window, args.threshold)
+      _stat("Scored %u datapoints across %u builds in %.02fs" % (len(detector.names), len(detector.buildnames), time.time() - detectstart))
+      for name, buildtime, buildchanges in ChangeDetector.rank_builds(changes)[:args.limit]:
+        output.write("%s (%s): %u datapoints changed\n" % (name, time.ctime(buildtime), len(buildchanges)))
+        for change in buildchanges[:5]:
+          output.write("  %8.1f  %s: %.0f -> %.0f (%+.0f)\n" % (change['score'], change['datapoint'], change['before'], change['after'], change['delta']))
+    if not args.follow:
+      break
+    time.sleep(args.follow)
@@ -8,19 +8,381 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import BenchTester
+import ProcSampler
 import os
 import re
+import time
+import json
+import math
+import hashlib
+import array
+import shutil
+import tempfile
+import subprocess
+import ConfigParser
+
+# Flattened endurance results, as add_test_results takes them. Rather than a
+# list per row, names and checkpoints are interned and rows are held as name
+# ids and values in typed arrays, with the rows of each checkpoint contiguous.
+# Iterating yields ( name, value, meta ) rows, so the results can be passed
+# around as a list of rows would be, and iterated as many times as needed.
+class EnduranceResults(object):
+  # Endurance adds [i:0, e:5] to checkpoint labels
+  label_re = re.compile(r"^(.+) \[i:(\d+) e:\d+\]$")
+
+  def __init__(self):
+    self.names = []
+    self.metas = []
+    self.name_ids = array.array('i')
+    self.values = array.array('d')
+    # [ (meta index, index of the checkpoint's first row) ]
+    self.checkpoints = []
+    # Memory entry key -> name index, label -> meta
+    self._name_cache = {}
+    self._label_cache = {}
+
+  def __len__(self):
+    return len(self.values)
+
+  def __iter__(self):
+    names = self.names
+    values = self.values
+    name_ids = self.name_ids
+    bounds = [ start for meta, start in self.checkpoints[1:] ] + [ len(values) ]
+    for (meta, start), end in zip(self.checkpoints, bounds):
+      meta = self.metas[meta]
+      for x in xrange(start, end):
+        value = values[x]
+        yield (names[name_ids[x]], int(value) if value.is_integer() else value, meta)
+
+  # Returns the meta of a checkpoint label, "<label>:<iteration>", or None if
+  # it isn't an endurance label
+  def _parse_label(self, label):
+    if label not in self._label_cache:
+      match = self.label_re.match(label)
+      self._label_cache[label] = "%s:%u" % (match.group(1), int(match.group(2))) if match else None
+    return self._label_cache[label]
+
+  def _intern_name(self, key):
+    # Entries with units are stored as "<unit>:<name>"
+    name = "%s:%s" % key if type(key) is tuple else key
+    self._name_cache[key] = len(self.names)
+    self.names.append(name)
+    return self._name_cache[key]
+
+  # Adds a checkpoint's memory entries. Returns False if the label isn't an
+  # endurance checkpoint label, in which case nothing is added.
+  def add_checkpoint(self, label, memory):
+    meta = self._parse_label(label)
+    if meta is None:
+      return False
+    self.checkpoints.append((len(self.metas), len(self.values)))
+    self.metas.append(meta)
+    cache = self._name_cache
+    ids = []
+    values = []
+    for memtype, memval in memory.iteritems():
+      if type(memval) is dict:
+        key = (memval['unit'], memtype)
+        memval = memval['val']
+      else:
+        key = memtype
+      name_id = cache.get(key)
+      if name_id is None:
+        name_id = self._intern_name(key)
+      ids.append(name_id)
+      values.append(memval)
+    self.name_ids.fromlist(ids)
+    self.values.fromlist(values)
+    return True
+
+  # Adds ( name, value, meta ) rows that didn't come from the endurance test,
+  # such as ProcSampler samples. Rows with the same meta should be adjacent.
+  def add_rows(self, rows):
+    cache = self._name_cache
+    for name, value, meta in rows:
+      if not len(self.checkpoints) or self.metas[self.checkpoints[-1][0]] != meta:
+        self.checkpoints.append((len(self.metas), len(self.values)))
+        self.metas.append(meta)
+      name_id = cache.get(name)
+      if name_id is None:
+        name_id = self._intern_name(name)
+      self.name_ids.append(name_id)
+      self.values.append(value)
+
+# Flattens endurance results, as sent by the enduranceResults event or built up
+# from enduranceCheckpoint events, into EnduranceResults with a meta of
+# "<checkpoint label>:<iteration>" for each checkpoint. error, if given, is
+# called with a message for checkpoints it can't parse, which are skipped.
+def flatten_endurance_results(endurance_results, error=None):
+  results = EnduranceResults()
+  for iteration in endurance_results['iterations']:
+    # Iterations might not be in order when passed from enduranceCheckpoint,
+    # so the iteration number comes from the label
+    for checkpoint in iteration['checkpoints']:
+      if not results.add_checkpoint(checkpoint['label'], checkpoint['memory']):
+        if error:
+          error("Checkpoint '%s' doesn't look like an endurance checkpoint!" % checkpoint['label'])
+        continue
+  return results
+
+##
+## Adaptive iterations
+##
+
+# A test's testvars can have an "adaptive" object to stop the test once chosen
+# datapoints have converged, rather than always running the number of
+# iterations it is given:
+#   "adaptive": { "datapoints": [ "explicit", "resident" ],
+#                 "min_iterations": 3,
+#                 "max_iterations": 10,   # the test's "iterations" by default
+#                 "confidence": 0.95,     # one of gTCritical's
+#                 "tolerance": 0.01 }
+# The datapoints have converged when, at every checkpoint, the confidence
+# interval of their mean across iterations is within tolerance of the mean.
+# This needs the checkpoints streamed by enduranceCheckpoint events. The test
+# can't be told to stop, so the harness stops the browser after the last
+# checkpoint of the iteration that converged.
+
+# Two-sided critical values of Student's t distribution by confidence, as
+# [ (degrees of freedom, value) ]. Degrees of freedom that aren't listed use
+# the next lowest, which errs on the side of running longer.
+gTCritical = {
+  0.90: [ (1, 6.314), (2, 2.920), (3, 2.353), (4, 2.132), (5, 2.015), (6, 1.943),
+          (7, 1.895), (8, 1.860), (9, 1.833), (10, 1.812), (15, 1.753), (20, 1.725),
+          (30, 1.697) ],
+  0.95: [ (1, 12.706), (2, 4.303), (3, 3.182), (4, 2.776), (5, 2.571), (6, 2.447),
+          (7, 2.365), (8, 2.306), (9, 2.262), (10, 2.228), (15, 2.131), (20, 2.086),
+          (30, 2.042) ],
+  0.99: [ (1, 63.657), (2, 9.925), (3, 5.841), (4, 4.604), (5, 4.032), (6, 3.707),
+          (7, 3.499), (8, 3.355), (9, 3.250), (10, 3.169), (15, 2.947), (20, 2.845),
+          (30, 2.750) ]
+}
+
+def _t_critical(confidence, df):
+  return [ value for x, value in gTCritical[confidence] if x <= df ][-1]
+
+# Watches the checkpoints of a test as they are streamed, to tell when its
+# datapoints have converged per the "adaptive" testvars above
+class ConvergenceMonitor(object):
+  def __init__(self, config, iterations=None):
+    self.watched = set(config['datapoints'])
+    self.min_iterations = max(2, config.get('min_iterations', 3))
+    self.max_iterations = config.get('max_iterations', iterations)
+    if not self.max_iterations:
+      raise Exception("Adaptive tests need max_iterations, or iterations")
+    self.confidence = config.get('confidence', 0.95)
+    if self.confidence not in gTCritical:
+      raise Exception("Unsupported confidence %s, must be one of %s" % (self.confidence, sorted(gTCritical)))
+    self.tolerance = config.get('tolerance', 0.01)
+    # (datapoint, checkpoint label) -> [ value of each iteration ]
+    self.samples = {}
+    self.iterations = 0
+    # Why the test stopped, once it has
+    self.stop_reason = None
+    self._first_iteration = None
+    self._last_label = None
+    self._final_label = None
+
+  # Adds a streamed checkpoint. Returns True if it completed an iteration
+  # with which the datapoints converged.
+  def add_checkpoint(self, label, memory):
+    match = EnduranceResults.label_re.match(label)
+    if not match:
+      return False
+    label, iteration = match.group(1), int(match.group(2))
+    if self._first_iteration is None:
+      self._first_iteration = iteration
+    elif self._final_label is None and iteration != self._first_iteration:
+      # The first checkpoint of the second iteration, so the first ended with
+      # the previous one
+      self._final_label = self._last_label
+      self.iterations = 1
+    self._last_label = label
+    for name in self.watched:
+      if name in memory:
+        value = memory[name]
+        self.samples.setdefault((name, label), []).append(value['val'] if type(value) is dict else value)
+    if label != self._final_label:
+      return False
+    self.iterations += 1
+    if self.iterations >= self.min_iterations and self.converged():
+      self.stop_reason = 'converged'
+      return True
+    if self.iterations >= self.max_iterations:
+      self.stop_reason = 'max-iterations'
+    return False
+
+  # Returns whether every watched datapoint is within tolerance at every
+  # checkpoint. Datapoints missing from the memory report of all but one
+  # iteration at a checkpoint have no spread to judge, and are left out.
+  def converged(self):
+    judged = False
+    for values in self.samples.itervalues():
+      count = len(values)
+      if count < 2:
+        continue
+      judged = True
+      mean = float(sum(values)) / count
+      stddev = math.sqrt(sum((value - mean) ** 2 for value in values) / (count - 1))
+      halfwidth = _t_critical(self.confidence, count - 1) * stddev / math.sqrt(count)
+      if halfwidth > abs(mean) * self.tolerance:
+        return False
+    return judged
+
+  # Returns datapoints recording the iterations run and why the test stopped,
+  # as add_test_results takes them
+  def datapoints(self):
+    return [ [ 'cnt:adaptive/iterations', self.iterations, 'Adaptive' ],
+             [ 'cnt:adaptive/stopped/%s' % (self.stop_reason or 'finished',), 1, 'Adaptive' ] ]
+
+# Preferences of the profile tests are run with
+gPreferences = { 'startup.homepage_welcome_url': '',
+                 'startup.homepage_override_url': '' }
+# Uncomment to enable jsbridge logging
+#gPreferences['extensions.jsbridge.log'] = True
+
+# Files left in a profile by a running browser, which aren't copied
+gProfileLockFiles = [ 'parent.lock', 'lock', '.parentlock' ]
+
+##
+## Profile templates
+##
+
+# Starting the browser on a new profile pays for first run initialization:
+# creating the profile's databases, caches and extension registry. With
+# --profile-cache, that is done once per browser version and build, in a
+# template profile started once with -silent, and each test then runs on a
+# copy of the template. The template is copied rather than hard linked, as the
+# browser modifies profile files in place.
+#
+# Nearly every build tested has a build ID of its own, so only the templates
+# used most recently are kept (see prune_profile_templates), each template's
+# mtime being updated as it is used.
+
+# Returns a name for the version and build of the browser binary, from the
+# application.ini next to it, or its size and mtime if there isn't one, and the
+# preferences the template is created with
+def _profile_template_key(binary, preferences):
+  prefs = hashlib.sha1(json.dumps(preferences, sort_keys=True)).hexdigest()[:12]
+  config = ConfigParser.RawConfigParser()
+  if config.read(os.path.join(os.path.dirname(binary), 'application.ini')):
+    try:
+      return "%s-%s-%s" % (config.get('App', 'Version'), config.get('App', 'BuildID'), prefs)
+    except ConfigParser.Error:
+      pass
+  stat = os.stat(binary)
+  return "binary-%u-%u-%s" % (stat.st_size, int(stat.st_mtime), prefs)
+
+def _write_user_prefs(profile, preferences):
+  f = open(os.path.join(profile, 'user.js'), 'w')
+  try:
+    for name, value in sorted(preferences.iteritems()):
+      f.write("user_pref(%s, %s);\n" % (json.dumps(name), json.dumps(value)))
+  finally:
+    f.close()
+
+# Returns the path of the template profile for binary in cachedir, creating it
+# if it doesn't exist by starting the browser on it with preferences. log, if
+# given, is called with progress messages.
+def get_profile_template(cachedir, binary, preferences, log=None, timeout=120):
+  template = os.path.join(cachedir, _profile_template_key(binary, preferences))
+  if os.path.exists(template):
+    try:
+      os.utime(template, None)
+    except OSError:
+      # Pruned by another tester since
+      pass
+    else:
+      return template
+  if not os.path.exists(cachedir):
+    os.makedirs(cachedir)
+  if log:
+    log("Creating profile template %s" % (template,))
+  begin = time.time()
+  # Built aside and renamed into place, so concurrent testers never see a
+  # partial template
+  building = tempfile.mkdtemp(prefix='.building-', dir=cachedir)
+  try:
+    _write_user_prefs(building, preferences)
+    proc = subprocess.Popen([ binary, '-no-remote', '-silent', '-profile', building ])
+    while proc.poll() is None:
+      if time.time() - begin > timeout:
+        proc.kill()
+        proc.wait()
+        raise Exception("Browser didn't exit within %us of creating profile" % (timeout,))
+      time.sleep(0.5)
+    for name in gProfileLockFiles:
+      if os.path.lexists(os.path.join(building, name)):
+        os.remove(os.path.join(building, name))
+    try:
+      os.rename(building, template)
+    except OSError:
+      # Another tester got there first
+      if not os.path.exists(template):
+        raise
+  finally:
+    if os.path.exists(building):
+      shutil.rmtree(building, True)
+  if log:
+    log("Created profile template in %.02fs" % (time.time() - begin,))
+  return template
+
+# Removes all but the keep most recently used templates in cachedir. log, if
+# given, is called with the templates removed.
+def prune_profile_templates(cachedir, keep, log=None):
+  templates = []
+  for name in os.listdir(cachedir):
+    path = os.path.join(cachedir, name)
+    # Templates being built or removed start with a period
+    if name.startswith('.') or not os.path.isdir(path):
+      continue
+    try:
+      templates.append((os.stat(path).st_mtime, path))
+    except OSError:
+      continue
+  templates.sort(reverse=True)
+  for mtime, path in templates[keep:]:
+    # Renamed aside first, so no tester starts copying a half removed template
+    removing = os.path.join(cachedir, ".removing-%s" % (os.path.basename(path),))
+    try:
+      os.rename(path, removing)
+    except OSError:
+      continue
+    shutil.rmtree(removing, True)
+    if log:
+      log("Removed profile template %s" % (path,))
+
+# Returns a new copy of a template profile, which the caller removes
+def copy_profile_template(template):
+  profile = tempfile.mkdtemp(prefix='endurance-profile-')
+  os.rmdir(profile)
+  shutil.copytree(template, profile, symlinks=True,
+                  ignore=shutil.ignore_patterns(*gProfileLockFiles))
+  return profile
 
 class EnduranceTest(BenchTester.BenchTest):
   def __init__(self, parent):
     BenchTester.BenchTest.__init__(self, parent)
     self.name = "EnduranceTest"
     self.parent = parent
+    parent.add_argument('--profile-cache', help='Directory to keep template profiles in, one per browser version and build. \
+                                                 Tests run on a copy of the template rather than a new profile')
+    parent.add_argument('--profile-cache-size', type=int, default=3, help='Number of the most recently used template profiles \
+                                                                            to keep in --profile-cache')
+    parent.add_argument('--proc-sample-interval', type=float, help='Sample the resident and proportional set size of the browser\'s \
+                                                                    process tree from /proc every this many seconds during tests, \
+                                                                    recorded as proc/ datapoints under the ProcSample checkpoint')
+    parent.add_argument('--proc-max-samples', type=int, default=1024, help='Samples to keep per test. Longer runs are downsampled \
+                                                                            to fit')
 
   def setup(self):
     self.info("Setting up Endurance module")
     self.ready = True
     self.endurance_results = None
+    self.monitor = None
+    self.mozmillinst = None
+    self.fails = []
 
     return True
 
@@ -37,13 +399,54 @@ class EnduranceTest(BenchTester.BenchTest):
       if not self.endurance_results:
         self.endurance_results = { 'iterations': [] }
       self.endurance_results['iterations'].append(obj)
+      if self.monitor and not self.monitor.stop_reason:
+        for checkpoint in obj['checkpoints']:
+          if self.monitor.add_checkpoint(checkpoint['label'], checkpoint['memory']):
+            self.info("Datapoints converged after %u iterations, stopping test" % (self.monitor.iterations,))
+            try:
+              self.mozmillinst.runner.stop()
+            except Exception, e:
+              self.error("Failed to stop converged test -- %s: %s" % (type(e), e))
+            break
     else:
       self.error("Got endurance checkpoint with no data: %s" % obj)
 
+  # Keeps the failures reported until a converged test is stopped, as
+  # stopping the browser fails the test in ways that aren't its own
+  def endurance_fail(self, obj):
+    if not self.monitor or self.monitor.stop_reason != 'converged':
+      self.fails.append(obj)
+
+  # Returns a copy of the profile template for the binary under test, or None
+  # if there is no profile cache or the template can't be made
+  def _prepare_profile(self):
+    if not self.tester.args.get('profile_cache'):
+      return None
+    begin = time.time()
+    try:
+      template = get_profile_template(self.tester.args['profile_cache'], self.tester.binary,
+                                      gPreferences, self.info)
+      profile = copy_profile_template(template)
+      prune_profile_templates(self.tester.args['profile_cache'],
+                              max(1, self.tester.args.get('profile_cache_size') or 3), self.info)
+    except Exception, e:
+      self.warn("Failed to use profile cache, running with a new profile -- %s: %s" % (type(e), e))
+      return None
+    self.info("Prepared profile from template in %.02fs" % (time.time() - begin,))
+    return profile
+
   def run_test(self, testname, testvars={}):
     if not self.ready:
       return self.error("run_test() called before setup")
 
+    profile = self._prepare_profile()
+    try:
+      return self._run_test(testname, testvars, profile)
+    finally:
+      if profile:
+        shutil.rmtree(profile, True)
+
+  def _run_test(self, testname, testvars, profile):
     self.info("Beginning endurance test '%s'" % testname)
 
     import mozmill
@@ -51,17 +454,26 @@ class EnduranceTest(BenchTester.BenchTest):
     # Setup mozmill
     self.info("Mozmill - setting up.")
 
-    preferences = { 'startup.homepage_welcome_url': '',
-                    'startup.homepage_override_url': '' }
-    # Uncomment to enable jsbridge logging
-    #preferences['extensions.jsbridge.log'] = True
-    profile_args = dict(preferences=preferences)
+    self.monitor = None
+    if testvars.get('adaptive'):
+      try:
+        self.monitor = ConvergenceMonitor(testvars['adaptive'], testvars.get('iterations'))
+      except Exception, e:
+        return self.error("Test '%s' has bad adaptive settings: %s" % (testname, e))
+      testvars = dict(testvars, iterations=self.monitor.max_iterations)
+      self.info("Running %u to %u iterations, until converged" % (self.monitor.min_iterations,
+                                                                  self.monitor.max_iterations))
+
+    profile_args = dict(preferences=gPreferences)
+    if profile:
+      profile_args['profile'] = profile
 
     runner_args = dict(binary=self.tester.binary)
     # Uncomment to enable the browser's jsconsole
     #runner_args['cmdargs'] = ['-jsconsole']
 
     mozmillinst = mozmill.MozMill.create(runner_args=runner_args, profile_args=profile_args)
+    self.mozmillinst = mozmillinst
 
     mozmillinst.persisted['endurance'] = testvars
     mozmillinst.add_listener(self.endurance_event, eventType='mozmill.enduranceResults')
@@ -69,6 +481,8 @@ class EnduranceTest(BenchTester.BenchTest):
     # to avoid keeping everything in the runtime (it records a lot of numbers,
     # which in turn inflate memory usage, which it's trying to measure)
     mozmillinst.add_listener(self.endurance_checkpoint, eventType='mozmill.enduranceCheckpoint')
+    self.fails = []
+    mozmillinst.add_listener(self.endurance_fail, eventType='mozmill.fail')
 
     # Add test
     testpath = os.path.join(*testvars['test'])
@@ -77,11 +491,22 @@ class EnduranceTest(BenchTester.BenchTest):
     # mozmill-2 requires an absolute path
     testpath = os.path.abspath(testpath)
 
+    # The browser is started by mozmill as a child of this process
+    sampler = None
+    if self.tester.args.get('proc_sample_interval'):
+      sampler = ProcSampler.ProcSampler(self.tester.args['proc_sample_interval'],
+                                        self.tester.args.get('proc_max_samples') or 1024)
+      if not sampler.available:
+        self.warn("No /proc to sample, not sampling process memory")
+        sampler = None
+
     # Run test
     self.endurance_results = None
     test_results = None;
     try:
       self.info("Endurance - running test")
+      if sampler:
+        sampler.start()
       mozmillinst.run(tests=[ { "path": testpath } ])
       test_results = mozmillinst.finish()
       successful = len(test_results.fails) == 0
@@ -89,7 +514,12 @@ class EnduranceTest(BenchTester.BenchTest):
       try:
         mozmillinst.finish(fatal=True)
       except: pass
-      return self.error("Endurance test run failed -- %s: %s" % (type(e), e))
+      if not self.monitor or self.monitor.stop_reason != 'converged':
+        return self.error("Endurance test run failed -- %s: %s" % (type(e), e))
+      test_results = None
+    finally:
+      if sampler:
+        sampler.stop()
 
     self.info("Endurance - cleaning up")
     try:
@@ -102,31 +532,26 @@ class EnduranceTest(BenchTester.BenchTest):
     if not self.endurance_results:
       return self.error("Test did not return any endurance data!")
 
-    results = list()
-    for x in range(len(self.endurance_results['iterations'])):
-      iteration = self.endurance_results['iterations'][x]
-      for checkpoint in iteration['checkpoints']:
-        # Endurance adds [i:0, e:5]
-        # Because iterations might not be in order when
-        # passed from enduranceCheckpoint, parse this.
-        label_re = re.match("^(.+) \[i:(\d+) e:\d+\]$", checkpoint['label'])
-        if not label_re:
-          self.error("Checkpoint '%s' doesn't look like an endurance checkpoint!" % checkpoint['label'])
-          next
-        iternum = int(label_re.group(2))
-        label = label_re.group(1)
-        for memtype,memval in checkpoint['memory'].items():
-          if type(memval) is dict:
-            prefix = memval['unit'] + ":"
-            memval = memval['val']
-          else:
-            prefix = ""
-          results.append([ "%s%s" % (prefix, memtype), memval, "%s:%u" % (label, iternum) ])
+    results = flatten_endurance_results(self.endurance_results, self.error)
+    if sampler:
+      self.info("Adding %u process samples, %.01fs apart" % (len(sampler.times), sampler.interval))
+      results.add_rows(sampler.datapoints())
+    if self.monitor:
+      results.add_rows(self.monitor.datapoints())
+      # Stopping the browser cuts the test short, which mozmill reports as a
+      # failure. Only failures from before it was stopped count.
+      if self.monitor.stop_reason == 'converged':
+        successful = not len(self.fails)
+      self.info("Ran %u iterations, stopped: %s" % (self.monitor.iterations,
+                                                    self.monitor.stop_reason or 'finished'))
 
     if not self.tester.add_test_results(testname, results, successful):
       return self.error("Failed to save test results")
     if not successful:
-      fails = [y for x in test_results.fails for y in x['fails']]
+      if test_results and (not self.monitor or self.monitor.stop_reason != 'converged'):
+        fails = [y for x in test_results.fails for y in x['fails']]
+      else:
+        fails = self.fails
       return self.error("%u failures occured during test run: %s" % (len(fails), fails))
     self.info("Test '%s' complete" % testname)
     return True
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012 Mozilla Corporation
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Writing and reading back the files of an incremental export (JSONExport,
+# SeriesExport): an index.json recording how far the export has got, and
+# files that are replaced whole, so readers of the export see either the old
+# or the new version of each.
+
+import os
+import json
+import platform
+
+is_win = platform.system() == "Windows"
+
+# Writes to path by way of a temporary file, with write called with the open
+# file
+def replace_file(path, write):
+  tempfile = os.path.join(os.path.dirname(path), ".%s" % os.path.basename(path))
+  f = open(tempfile, 'wb')
+  try:
+    write(f)
+  finally:
+    f.close()
+  if is_win and os.path.exists(path):
+    os.remove(path) # Can't do atomic renames on windows
+  os.rename(tempfile, path)
+
+def write_json(path, obj):
+  replace_file(path, lambda f: json.dump(obj, f, separators=(',', ':')))
+
+# Returns the index of the export in outdir, or a copy of empty if there isn't
+# one yet. Raises if the index isn't at the version empty has.
+def read_index(outdir, empty):
+  path = os.path.join(outdir, 'index.json')
+  if not os.path.exists(path):
+    return json.loads(json.dumps(empty))
+  f = open(path, 'r')
+  try:
+    index = json.load(f)
+  finally:
+    f.close()
+  if index.get('version') != empty['version']:
+    raise Exception("Export in %s has index version %s, expected %s" % (outdir, index.get('version'), empty['version']))
+  return index
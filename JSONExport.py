@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012 Mozilla Corporation
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Generates the JSON a graphing front-end needs from a results database, split
+# into one shard per month of build time, and keeps it up to date
+# incrementally.
+#
+# Each shard, <outdir>/<YYYY-MM>.json, looks like:
+#   { "month": "2014-03",
+#     "builds": [ { "name": revision, "time": build time }, ... ],
+#     "series": { testname: { checkpoint: { datapoint: [ value, ... ] } } } }
+# where each value list lines up with "builds" (null where a build has no
+# value), and values are the checkpoint medians from benchtester_aggregates for
+# the build's latest successful run of the test.
+#
+# <outdir>/index.json lists the shards and records the highest test id
+# exported. Re-running only regenerates the shards containing builds with tests
+# newer than that, so the cost of an update follows the number of new results
+# rather than the size of the history. Shards and the index are written to a
+# temporary file and renamed into place.
+
+import os
+import sys
+import time
+import datetime
+import argparse
+
+import BenchTester
+import ExportFiles
+
+output = sys.stdout
+
+gIndexVersion = 1
+
+def _stat(msg):
+  output.write("[JSONExport] %s\n" % msg)
+
+def _month(buildtime):
+  return datetime.datetime.utcfromtimestamp(buildtime).strftime('%Y-%m')
+
+# Returns the [start, end) unix timestamps of a YYYY-MM month
+def _month_range(month):
+  year, month = [ int(x) for x in month.split('-') ]
+  start = datetime.datetime(year, month, 1)
+  end = datetime.datetime(year + 1, 1, 1) if month == 12 else datetime.datetime(year, month + 1, 1)
+  epoch = datetime.datetime(1970, 1, 1)
+  return (int((start - epoch).total_seconds()), int((end - epoch).total_seconds()))
+
+# Builds the shard for one month, from tests up to lastid. datapoints is an
+# optional SQL LIKE pattern limiting the datapoints included.
+def _generate_shard(cur, month, lastid, datapoints=None):
+  start, end = _month_range(month)
+  cur.execute("SELECT b.id, b.name, b.time, t.name, MAX(t.id) FROM benchtester_builds b "
+              "JOIN benchtester_tests t ON t.build_id = b.id "
+              "WHERE t.successful AND t.id <= ? AND b.time >= ? AND b.time < ? "
+              "GROUP BY b.id, t.name ORDER BY b.time, b.id",
+              (lastid, start, end))
+  builds = []
+  columns = {}
+  tests = {}
+  for build_id, buildname, buildtime, testname, test_id in cur.fetchall():
+    if build_id not in columns:
+      columns[build_id] = len(builds)
+      builds.append({ 'name': buildname, 'time': buildtime })
+    tests[test_id] = (testname, columns[build_id])
+
+  series = {}
+  testids = tests.keys()
+  # Keep under sqlite's limit on bound parameters
+  for x in range(0, len(testids), 500):
+    chunk = testids[x:x + 500]
+    query = ("SELECT a.test_id, p.name, a.checkpoint, a.median FROM benchtester_aggregates a "
+             "JOIN benchtester_datapoints p ON p.id = a.datapoint_id "
+             "WHERE a.test_id IN (%s)" % (','.join('?' * len(chunk)),))
+    params = list(chunk)
+    if datapoints:
+      query += " AND p.name LIKE ?"
+      params.append(datapoints)
+    cur.execute(query, params)
+    for test_id, datapoint, checkpoint, value in cur.fetchall():
+      testname, column = tests[test_id]
+      values = series.setdefault(testname, {}).setdefault(checkpoint or '', {}).get(datapoint)
+      if values is None:
+        values = series[testname][checkpoint or ''][datapoint] = [ None ] * len(builds)
+      values[column] = value
+
+  return { 'month': month, 'builds': builds, 'series': series }
+
+# Regenerates the shards in outdir affected by tests added since the last
+# export. Returns the list of months regenerated.
+def export(sqlite, outdir, datapoints=None):
+  if not os.path.exists(outdir):
+    os.makedirs(outdir)
+  index = ExportFiles.read_index(outdir, { 'version': gIndexVersion, 'lastid': 0, 'shards': {}, 'builds': {} })
+  cur = sqlite.cursor()
+
+  cur.execute("SELECT MAX(id) FROM benchtester_tests")
+  lastid = cur.fetchone()[0] or 0
+  cur.execute("SELECT DISTINCT b.id, b.time FROM benchtester_tests t "
+              "JOIN benchtester_builds b ON b.id = t.build_id "
+              "WHERE t.id > ? AND t.id <= ?",
+              (index['lastid'], lastid))
+  months = set()
+  for build_id, buildtime in cur.fetchall():
+    month = _month(buildtime)
+    months.add(month)
+    # A build whose time was changed also needs removing from its old shard
+    oldmonth = index['builds'].get(str(build_id))
+    if oldmonth and oldmonth != month:
+      months.add(oldmonth)
+    index['builds'][str(build_id)] = month
+
+  for month in sorted(months):
+    begin = time.time()
+    # Only the month's database shard is needed, making room for it if the
+    # database is sharded
+    start, end = _month_range(month)
+    BenchTester.attach_shards(sqlite, start, end - 1)
+    shard = _generate_shard(cur, month, lastid, datapoints)
+    filename = "%s.json" % (month,)
+    ExportFiles.write_json(os.path.join(outdir, filename), shard)
+    index['shards'][month] = { 'file': filename, 'builds': len(shard['builds']), 'generated': int(time.time()) }
+    _stat("Generated %s with %u builds in %.02fs" % (filename, len(shard['builds']), time.time() - begin))
+
+  index['lastid'] = lastid
+  ExportFiles.write_json(os.path.join(outdir, 'index.json'), index)
+  return sorted(months)
+
+#
+# Main
+#
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Generate or update per-month JSON shards of a results database for graphing')
+  parser.add_argument('sqlitedb', help='The results database')
+  parser.add_argument('outdir', help='Directory to write shards to. Shards already there are only regenerated if they have new results')
+  parser.add_argument('--datapoints', help='A SQL LIKE pattern limiting which datapoints are exported')
+  args = parser.parse_args()
+
+  sqlite = BenchTester.open_results_db(args.sqlitedb)
+  if not sqlite:
+    sys.exit("No database at %s" % (args.sqlitedb,))
+  begin = time.time()
+  months = export(sqlite, args.outdir, args.datapoints)
+  _stat("Regenerated %u shards in %.02fs" % (len(months), time.time() - begin))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012 Mozilla Corporation
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Samples the memory use of a process tree from /proc, from a thread of the
+# harness, so the browser under test does no work of its own to be measured.
+#
+# Each sample is the total resident set size (VmRSS, from /proc/<pid>/status)
+# and proportional set size (Pss, from /proc/<pid>/smaps_rollup where the
+# kernel has it) of every descendant of the root process. At most maxsamples
+# samples are kept: when full, neighbouring samples are averaged in pairs and
+# the interval doubles, so a run of any length ends up as an evenly spaced
+# series of bounded size.
+#
+# Linux only. Samplers elsewhere take no samples.
+
+import os
+import time
+import array
+import threading
+
+gProc = '/proc'
+
+# Returns { pid: parent pid } for all processes
+def _process_parents():
+  ret = {}
+  for name in os.listdir(gProc):
+    if not name.isdigit():
+      continue
+    try:
+      f = open(os.path.join(gProc, name, 'stat'), 'r')
+      try:
+        stat = f.read()
+      finally:
+        f.close()
+    except IOError:
+      # Exited since listing
+      continue
+    # The command name can contain spaces and parentheses, the fields after
+    # its closing parenthesis can't
+    ret[int(name)] = int(stat[stat.rindex(')') + 2:].split(' ', 2)[1])
+  return ret
+
+# Returns the pids of root's descendants
+def descendants(root):
+  children = {}
+  for pid, ppid in _process_parents().iteritems():
+    children.setdefault(ppid, []).append(pid)
+  ret = []
+  pending = list(children.get(root, []))
+  while len(pending):
+    pid = pending.pop()
+    ret.append(pid)
+    pending.extend(children.get(pid, []))
+  return ret
+
+# Returns the value in bytes of a "Name:   1234 kB" field of a /proc file, or
+# None if the file or field doesn't exist
+def _read_kb_field(path, field):
+  try:
+    f = open(path, 'r')
+    try:
+      for line in f:
+        if line.startswith(field):
+          return int(line.split()[1]) * 1024
+    finally:
+      f.close()
+  except (IOError, ValueError, IndexError):
+    pass
+  return None
+
+class ProcSampler(object):
+  # interval - Seconds between samples, until the first downsampling
+  # maxsamples - Samples kept, an even number
+  # root - The process whose descendants are sampled, this one by default
+  def __init__(self, interval=1.0, maxsamples=1024, root=None):
+    self.interval = interval
+    self.maxsamples = max(2, maxsamples - maxsamples % 2)
+    self.root = root or os.getpid()
+    self.available = os.path.exists(os.path.join(gProc, 'self', 'status'))
+    # Sample time (seconds since start), RSS and PSS in bytes, and processes
+    self.times = array.array('d')
+    self.rss = array.array('d')
+    self.pss = array.array('d')
+    self.processes = array.array('i')
+    self.started = None
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    self.started = time.time()
+    if not self.available:
+      return
+    self._thread = threading.Thread(target=self._run, name='ProcSampler')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    if self._thread:
+      self._stop.set()
+      self._thread.join()
+      self._thread = None
+
+  def _run(self):
+    next = time.time()
+    while not self._stop.is_set():
+      self.sample()
+      next += self.interval
+      self._stop.wait(max(0, next - time.time()))
+
+  # Takes one sample of the process tree
+  def sample(self):
+    now = time.time() - self.started
+    rss = pss = 0
+    pids = descendants(self.root)
+    for pid in pids:
+      base = os.path.join(gProc, str(pid))
+      rss += _read_kb_field(os.path.join(base, 'status'), 'VmRSS:') or 0
+      pss += _read_kb_field(os.path.join(base, 'smaps_rollup'), 'Pss:') or 0
+    if len(self.times) == self.maxsamples:
+      self._downsample()
+    self.times.append(now)
+    self.rss.append(rss)
+    self.pss.append(pss)
+    self.processes.append(len(pids))
+
+  def _downsample(self):
+    for column, combine in [ (self.times, lambda a, b: a),
+                             (self.rss, lambda a, b: (a + b) / 2),
+                             (self.pss, lambda a, b: (a + b) / 2),
+                             (self.processes, max) ]:
+      halved = [ combine(column[x], column[x + 1]) for x in xrange(0, len(column) - 1, 2) ]
+      del column[:]
+      column.extend(halved)
+    self.interval *= 2
+
+  # Returns the samples as datapoints, as add_test_results takes them, with a
+  # meta of "<checkpoint>:<milliseconds since start>". PSS is left out if the
+  # kernel doesn't provide smaps_rollup.
+  def datapoints(self, checkpoint='ProcSample'):
+    ret = []
+    havepss = any(self.pss)
+    for x in xrange(len(self.times)):
+      meta = "%s:%u" % (checkpoint, int(self.times[x] * 1000))
+      ret.append([ 'proc/resident', int(self.rss[x]), meta ])
+      if havepss:
+        ret.append([ 'proc/pss', int(self.pss[x]), meta ])
+      ret.append([ 'cnt:proc/processes', self.processes[x], meta ])
+    return ret
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2012 Mozilla Corporation
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Exports the history of each datapoint in a results database as columnar
+# binary files that a graph server can mmap and slice without parsing anything.
+#
+# Each series is one (test name, datapoint) pair, with a row per build and
+# checkpoint holding the median of the datapoint at that checkpoint (from
+# benchtester_aggregates) in the build's latest successful run of the test.
+# Rows are ordered by build time, and each column is its own file of
+# little-endian fixed width values, named <series number>.<column>:
+#   time       - int64, build time
+#   build      - int64, benchtester_builds id
+#   checkpoint - int32, index into the index's 'checkpoints' list
+#   value      - float64
+# index.json maps "test/datapoint" to the series number and its number of
+# rows, and records the highest test id exported. Re-running the export only
+# loads tests newer than that: series whose new rows all come after their last
+# row are appended to, other touched series are rewritten. The index is
+# replaced last, so readers never see rows it doesn't count.
+
+import os
+import sys
+import time
+import argparse
+import numpy
+
+import BenchTester
+import ExportFiles
+
+output = sys.stdout
+
+gColumns = [ ('time', '<i8'), ('build', '<i8'), ('checkpoint', '<i4'), ('value', '<f8') ]
+gIndexVersion = 1
+
+def _stat(msg):
+  output.write("[SeriesExport] %s\n" % msg)
+
+def _series_key(testname, datapoint):
+  return "%s/%s" % (testname, datapoint)
+
+def _read_index(outdir):
+  return ExportFiles.read_index(outdir, { 'version': gIndexVersion, 'lastid': 0, 'checkpoints': [], 'series': {} })
+
+# Given rows of (datapoint id, test name, checkpoint, build id, build time,
+# value) ordered by build time then test id, returns
+# { (test name, datapoint id): [ (time, build, checkpoint, value), ... ] }
+# keeping only the last value of each build and checkpoint
+def _group_rows(rows):
+  series = {}
+  for datapoint_id, testname, checkpoint, build_id, buildtime, value in rows:
+    series.setdefault((testname, datapoint_id), {})[(build_id, checkpoint)] = (buildtime, value)
+  ret = {}
+  for key, values in series.iteritems():
+    ret[key] = sorted((buildtime, build_id, checkpoint, value)
+                      for (build_id, checkpoint), (buildtime, value) in values.iteritems())
+  return ret
+
+# Run through BenchTester.query_results, as the tests read may span more
+# shards of a sharded database than can be attached at once
+gRowQuery = ("SELECT a.datapoint_id, t.name, a.checkpoint, b.id, b.time, a.median "
+             "FROM main.benchtester_aggregates a "
+             "JOIN %%(manifest)s.benchtester_tests t ON t.id = a.test_id "
+             "JOIN %%(manifest)s.benchtester_builds b ON b.id = t.build_id "
+             "WHERE t.successful AND %s "
+             "ORDER BY b.time, t.id")
+
+# Exports any tests added to sqlite since the last export to outdir. Returns
+# (series appended to, series rewritten).
+def export(sqlite, outdir):
+  if not os.path.exists(outdir):
+    os.makedirs(outdir)
+  index = _read_index(outdir)
+  cur = sqlite.cursor()
+
+  cur.execute("SELECT MAX(id) FROM benchtester_tests")
+  lastid = cur.fetchone()[0] or 0
+  changed = _group_rows(BenchTester.query_results(sqlite, gRowQuery % ("t.id > ? AND t.id <= ?",),
+                                                   (index['lastid'], lastid)))
+  if not len(changed):
+    _stat("Nothing new since test %u" % (index['lastid'],))
+    return (0, 0)
+
+  cur.execute("SELECT id, name FROM benchtester_datapoints")
+  names = dict(cur.fetchall())
+  checkpoints = dict((name, x) for x, name in enumerate(index['checkpoints']))
+  def checkpoint_id(name):
+    name = name or ''
+    if name not in checkpoints:
+      checkpoints[name] = len(index['checkpoints'])
+      index['checkpoints'].append(name)
+    return checkpoints[name]
+
+  def columns(rows):
+    return [ numpy.array([ row[x] if name != 'checkpoint' else checkpoint_id(row[x]) for row in rows ], dtype=dtype)
+             for x, (name, dtype) in enumerate(gColumns) ]
+
+  appended = rewritten = 0
+  for (testname, datapoint_id), rows in changed.iteritems():
+    key = _series_key(testname, names[datapoint_id])
+    info = index['series'].get(key)
+    if info is None:
+      info = index['series'][key] = { 'file': len(index['series']), 'length': 0, 'lasttime': None }
+    base = os.path.join(outdir, str(info['file']))
+
+    # Rows can be appended if they're all for new builds after the series'
+    # last build, otherwise the series is re-read in full
+    append = info['length'] == 0 or rows[0][0] >= info['lasttime']
+    if append and info['length']:
+      builds = numpy.memmap("%s.build" % (base,), dtype='<i8', mode='r', shape=(info['length'],))
+      append = not numpy.in1d(numpy.array([ x[1] for x in rows ]), builds).any()
+      del builds
+    if append:
+      for (name, dtype), column in zip(gColumns, columns(rows)):
+        f = open("%s.%s" % (base, name), 'ab')
+        try:
+          # Drop anything past the indexed length left by an interrupted export
+          f.truncate(info['length'] * numpy.dtype(dtype).itemsize)
+          column.tofile(f)
+        finally:
+          f.close()
+      info['length'] += len(rows)
+      appended += 1
+    else:
+      rows = _group_rows(BenchTester.query_results(sqlite, gRowQuery % ("a.datapoint_id = ? AND t.name = ? AND t.id <= ?",),
+                                                   (datapoint_id, testname, lastid)))[(testname, datapoint_id)]
+      for (name, dtype), column in zip(gColumns, columns(rows)):
+        ExportFiles.replace_file("%s.%s" % (base, name), column.tofile)
+      info['length'] = len(rows)
+      rewritten += 1
+    info['lasttime'] = rows[-1][0]
+
+  index['lastid'] = lastid
+  ExportFiles.write_json(os.path.join(outdir, 'index.json'), index)
+  return (appended, rewritten)
+
+# Reads an export. Series are returned as numpy memmaps, which only touch the
+# pages of the files that are actually used.
+class SeriesReader(object):
+  def __init__(self, outdir):
+    self.outdir = outdir
+    self.index = _read_index(outdir)
+
+  def series_names(self):
+    return self.index['series'].keys()
+
+  # Returns { column: array } for the series, or None if it doesn't exist
+  def get(self, testname, datapoint):
+    info = self.index['series'].get(_series_key(testname, datapoint))
+    if not info:
+      return None
+    base = os.path.join(self.outdir, str(info['file']))
+    return dict((name, numpy.memmap("%s.%s" % (base, name), dtype=dtype, mode='r', shape=(info['length'],)))
+                for name, dtype in gColumns)
+
+  # As get(), limited to builds with starttime <= time < endtime, and to the
+  # given checkpoint name if set
+  def get_range(self, testname, datapoint, starttime=None, endtime=None, checkpoint=None):
+    series = self.get(testname, datapoint)
+    if series is None:
+      return None
+    times = series['time']
+    start = numpy.searchsorted(times, starttime, 'left') if starttime is not None else 0
+    end = numpy.searchsorted(times, endtime, 'left') if endtime is not None else len(times)
+    ret = dict((name, column[start:end]) for name, column in series.iteritems())
+    if checkpoint is not None:
+      if checkpoint not in self.index['checkpoints']:
+        return dict((name, column[:0]) for name, column in ret.iteritems())
+      mask = ret['checkpoint'] == self.index['checkpoints'].index(checkpoint)
+      ret = dict((name, column[mask]) for name, column in ret.iteritems())
+    return ret
+
+#
+# Main
+#
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Export or update columnar per-datapoint series files from a results database')
+  parser.add_argument('sqlitedb', help='The results database')
+  parser.add_argument('outdir', help='Directory to export to. An existing export there is updated with tests added since it was made')
+  args = parser.parse_args()
+
+  sqlite = BenchTester.open_results_db(args.sqlitedb)
+  if not sqlite:
+    sys.exit("No database at %s" % (args.sqlitedb,))
+  begin = time.time()
+  appended, rewritten = export(sqlite, args.outdir)
+  _stat("Appended to %u series, rewrote %u, in %.02fs" % (appended, rewritten, time.time() - begin))